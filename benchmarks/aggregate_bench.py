@@ -0,0 +1,113 @@
+"""Benchmark month/category aggregation: one dict per row vs. ExpenseColumns.
+
+    uv run python -m benchmarks.aggregate_bench [--sizes 10000 100000 1000000]
+
+The dict baseline filters a month by its DD.MM.YYYY date string and sums
+categories in a loop, as the sheet-reading code used to. The columnar side
+uses NumPy when it is installed and the stdlib arrays otherwise; the backend
+is printed with the results.
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Any, Callable
+
+from src.services import columns as columns_module
+from src.services.columns import ExpenseColumns
+
+CATEGORIES = ["кофе", "Продукты", "Транспорт", "Кафе", "Дом", "Здоровье", "Подарки", "Разное"]
+END = date(2025, 9, 30)
+
+
+def generate(count: int, seed: int = 0) -> list[tuple[date, str, float, str]]:
+    """`count` rows spread over ten years, newest first like the sheet."""
+    rng = random.Random(seed)
+    span = 3650
+    return [
+        (
+            END - timedelta(days=span * i // count),
+            rng.choice(CATEGORIES),
+            float(rng.randint(50, 5000)),
+            "",
+        )
+        for i in range(count)
+    ]
+
+
+def dict_month_stats(expenses: list[dict[str, Any]], year: int, month: int) -> tuple:
+    suffix = f".{month:02d}.{year}"
+    selected = [e for e in expenses if e["date"].endswith(suffix)]
+    totals: dict[str, float] = defaultdict(float)
+    for e in selected:
+        totals[e["category"]] += e["amount"]
+    categories = sorted(totals.items(), key=lambda x: x[1], reverse=True)
+    return categories, sum(e["amount"] for e in selected), len({e["date"] for e in selected})
+
+
+def dict_range_totals(expenses: list[dict[str, Any]], months: list[tuple[int, int]]) -> dict:
+    totals: dict[tuple[int, int], dict[str, float]] = {key: {} for key in months}
+    for e in expenses:
+        _, m, y = e["date"].split(".")
+        month_totals = totals.get((int(y), int(m)))
+        if month_totals is not None:
+            month_totals[e["category"]] = month_totals.get(e["category"], 0.0) + e["amount"]
+    return totals
+
+
+def best_of(func: Callable[[], object], repeat: int = 3) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def run(size: int) -> None:
+    rows = generate(size)
+    expenses = [
+        {"date": d.strftime("%d.%m.%Y"), "category": c, "amount": a, "comment": comment}
+        for d, c, a, comment in rows
+    ]
+    table = ExpenseColumns.from_rows(rows)
+    months = [(2024, m) for m in range(10, 13)] + [(2025, m) for m in range(1, 10)]
+
+    cases = [
+        (
+            "month stats",
+            lambda: dict_month_stats(expenses, 2025, 9),
+            lambda: table.month_stats(2025, 9),
+        ),
+        (
+            "12-month totals",
+            lambda: dict_range_totals(expenses, months),
+            lambda: table.month_category_totals(months),
+        ),
+        ("top 3 categories", None, lambda: table.top_categories(months[0], months[-1], 3)),
+    ]
+    for name, baseline, columnar in cases:
+        columnar_time = best_of(columnar)
+        line = f"{size:>9,} rows  {name:<17} columns {columnar_time * 1e3:9.2f} ms"
+        if baseline is not None:
+            baseline_time = best_of(baseline)
+            line += f"   dicts {baseline_time * 1e3:9.2f} ms   x{baseline_time / columnar_time:.1f}"
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    print(f"backend: {'numpy' if columns_module.np is not None else 'array (no numpy)'}")
+    for size in args.sizes:
+        run(size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""Load test: Telegram updates through the dispatcher and concurrent /api/stats requests.
+
+    uv run python -m benchmarks.load_bench [--sizes 1000 10000 100000] [--latency-ms 100]
+
+The real bot handlers, outbox, Sheets session and Mini App API run against
+benchmarks.sheets_emulator, without a network; sendMessage is answered
+locally. For every sheet size the workload runs twice: before the local
+store is synced, so reads go to the (emulated) sheet, and after. Expense
+messages, /stats, /recent and /api/stats requests are sent concurrently, and
+throughput and p50/p95/p99 latency are reported for each.
+
+The client-side quota defaults to 6000 requests a minute so the numbers show
+the code rather than Google's limit; pass --requests-per-minute 60 to see
+production pacing.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date
+from pathlib import Path
+from urllib.parse import urlencode
+
+import httpx
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from loguru import logger
+from pydantic import SecretStr
+
+from benchmarks.aggregate_bench import CATEGORIES
+from benchmarks.sheets_emulator import SheetsEmulator
+from src.config import settings
+from src.services import sync
+from src.services.sheets_async import run_sheets_call
+from src.services.tenants import get_registry, use_tenant
+from src.services.write_queue import expense_queue
+from src.telegram.bot import build_dispatcher
+from src.webapp import app
+
+BOT_TOKEN = "123456789:load-bench"
+FIRST_CHAT_ID = 10_000
+
+
+class LocalBot(Bot):
+    """Answers sendMessage itself after `latency_seconds` instead of calling Telegram."""
+
+    def __init__(self, token: str, latency_seconds: float) -> None:
+        super().__init__(token)
+        self.latency = latency_seconds
+        self.sent = 0
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> None:  # type: ignore[override]
+        self.sent += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+def init_data(user_id: int) -> str:
+    """Mini App initData for `user_id`, signed with the benchmark's bot token."""
+    fields = {
+        "auth_date": str(int(time.time())),
+        "user": json.dumps({"id": user_id, "first_name": "Bench"}),
+    }
+    check = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def message_update(bot: Bot, update_id: int, chat_id: int, text: str) -> Update:
+    return Update.model_validate(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                "text": text,
+            },
+        },
+        context={"bot": bot},
+    )
+
+
+def percentiles(samples: list[float]) -> tuple[float, float, float]:
+    if len(samples) < 2:
+        value = samples[0] if samples else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+
+def report(size: int, store: str, kind: str, samples: list[float], elapsed: float) -> None:
+    p50, p95, p99 = percentiles(samples)
+    print(
+        f"{size:>9,}  {store:<6} {kind:<11} {len(samples):>6} {len(samples) / elapsed:>9.1f}"
+        f" {p50 * 1e3:>9.1f} {p95 * 1e3:>9.1f} {p99 * 1e3:>9.1f}"
+    )
+
+
+async def workload(
+    bot: Bot, dispatcher: Dispatcher, chat_id: int, args: argparse.Namespace, ids: itertools.count
+) -> tuple[dict[str, list[float]], dict[str, float]]:
+    """Send updates and API requests concurrently; latencies and elapsed time by kind."""
+    rng = random.Random(chat_id)
+    latencies: dict[str, list[float]] = defaultdict(list)
+    finished: dict[str, float] = {}
+    started = time.perf_counter()
+    updates = iter(range(args.updates))
+    requests = iter(range(args.requests))
+    today = date.today()
+    current = today.year * 12 + today.month - 1
+    months = [(i // 12, i % 12 + 1) for i in range(current - 11, current + 1)]  # the last year
+
+    async def send_updates() -> None:
+        for n in updates:
+            if n % 10 == 3:
+                kind, text = "/stats", "/stats"
+            elif n % 10 == 7:
+                kind, text = "/recent", "/recent"
+            else:
+                kind, text = "expense", f"{rng.randint(50, 5000)} {rng.choice(CATEGORIES)}"
+            update = message_update(bot, next(ids), chat_id, text)
+            sent = time.perf_counter()
+            await dispatcher.feed_update(bot, update)
+            latencies[kind].append(time.perf_counter() - sent)
+        finished["updates"] = time.perf_counter() - started
+
+    async def get_stats(client: httpx.AsyncClient) -> None:
+        auth = init_data(chat_id)
+        for _ in requests:
+            year, month = rng.choice(months)
+            sent = time.perf_counter()
+            response = await client.get(
+                "/api/stats", params={"initData": auth, "year": year, "month": month}
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"/api/stats answered {response.status_code}: {response.text}")
+            latencies["/api/stats"].append(time.perf_counter() - sent)
+        finished["/api/stats"] = time.perf_counter() - started
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await asyncio.gather(
+            *(send_updates() for _ in range(args.concurrency)),
+            *(get_stats(client) for _ in range(args.concurrency)),
+        )
+    elapsed = {
+        kind: finished["/api/stats" if kind == "/api/stats" else "updates"] for kind in latencies
+    }
+    return latencies, elapsed
+
+
+async def drain_outbox(timeout: float = 120) -> float:
+    started = time.perf_counter()
+    while expense_queue.depth() and time.perf_counter() - started < timeout:
+        await asyncio.sleep(0.05)
+    return time.perf_counter() - started
+
+
+async def run_size(
+    bot: Bot,
+    dispatcher: Dispatcher,
+    size: int,
+    index: int,
+    args: argparse.Namespace,
+    ids: itertools.count,
+) -> None:
+    chat_id = FIRST_CHAT_ID + index
+    tenant = get_registry().for_chat(chat_id)
+    emulator = SheetsEmulator.with_expenses(
+        size,
+        spreadsheet_id=tenant.spreadsheet_id,
+        latency_seconds=args.latency_ms / 1000,
+        jitter_seconds=args.jitter_ms / 1000,
+        requests_per_minute=args.quota_per_minute,
+        error_rate=args.error_rate,
+    )
+    with use_tenant(tenant) as state:
+        state.session = emulator.sheets_session(
+            requests_per_minute=args.requests_per_minute,
+            request_burst=max(10, int(args.requests_per_minute // 60)),
+        )
+
+        for store in ("sheet", "store"):
+            if store == "store":
+                await drain_outbox()
+                sync_started = time.perf_counter()
+                mirrored = await run_sheets_call(sync.sync_store, timeout=600)
+                print(
+                    f"{size:>9,}  full sync of {mirrored:,} rows "
+                    f"{(time.perf_counter() - sync_started) * 1e3:.0f} ms"
+                )
+            latencies, elapsed = await workload(bot, dispatcher, chat_id, args, ids)
+            for kind in ("expense", "/stats", "/recent", "/api/stats"):
+                if latencies.get(kind):
+                    report(size, store, kind, latencies[kind], elapsed[kind])
+
+    drained = await drain_outbox()
+    requests = sum(emulator.calls.values())
+    rejected = sum(emulator.rejected.values())
+    print(
+        f"{size:>9,}  outbox drained {drained * 1e3:.0f} ms after the load;"
+        f" {requests} Sheets requests, {rejected} rejected"
+    )
+
+
+def configure(directory: Path, sizes: list[int]) -> None:
+    """Point settings at a scratch directory with one tenant (chat and spreadsheet) per size."""
+    tenants = [
+        {"id": f"bench-{size}", "spreadsheet_id": f"bench-{size}", "chat_ids": [FIRST_CHAT_ID + i]}
+        for i, size in enumerate(sizes)
+    ]
+    tenants_file = directory / "tenants.json"
+    tenants_file.write_text(json.dumps(tenants), encoding="utf-8")
+    settings.tenants_file = str(tenants_file)
+    settings.tenant_data_dir = str(directory)
+    settings.telegram_bot_token = SecretStr(BOT_TOKEN)
+    settings.webapp_url = None
+    settings.trace_slow_ms = 0
+    expense_queue.outbox_path = str(directory / "outbox.sqlite3")
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+
+async def run(args: argparse.Namespace) -> None:
+    bot = LocalBot(BOT_TOKEN, args.telegram_latency_ms / 1000)
+    dispatcher = build_dispatcher()
+    queue = asyncio.create_task(expense_queue.run())
+    ids = itertools.count(1)
+    print(
+        f"{'rows':>9}  {'reads':<6} {'kind':<11} {'count':>6} {'req/s':>9}"
+        f" {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    )
+    try:
+        for index, size in enumerate(args.sizes):
+            await run_size(bot, dispatcher, size, index, args, ids)
+    finally:
+        queue.cancel()
+        await bot.session.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--updates", type=int, default=500, help="Telegram updates per run")
+    parser.add_argument("--requests", type=int, default=500, help="/api/stats requests per run")
+    parser.add_argument("--concurrency", type=int, default=16, help="senders of each kind")
+    parser.add_argument("--latency-ms", type=float, default=100, help="Sheets API latency")
+    parser.add_argument("--jitter-ms", type=float, default=50, help="added at random, up to")
+    parser.add_argument("--quota-per-minute", type=float, default=None, help="emulator 429s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 503 answers")
+    parser.add_argument("--requests-per-minute", type=float, default=6000, help="client quota")
+    parser.add_argument("--telegram-latency-ms", type=float, default=0, help="sendMessage")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="financier-bench-") as directory:
+        configure(Path(directory), args.sizes)
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
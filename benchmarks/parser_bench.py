@@ -0,0 +1,54 @@
+"""Micro-benchmark for the expense message parser.
+
+    uv run python -m benchmarks.parser_bench [--number 200000] [--min-ops 50000]
+
+Exits with status 1 if throughput drops below --min-ops parses per second,
+so it can guard against regressions in CI.
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import timeit
+from datetime import date
+
+from src.telegram.parser import parse_expense
+from src.telegram.utils import get_example_formats
+
+MESSAGES = get_example_formats() + [
+    "450 кофе с молоком",
+    "1200 Продукты 'Пятёрочка' 15/09/2025",
+    "01.09 450 кофе",
+]
+
+
+def run(number: int) -> float:
+    """Return parses per second over the sample messages."""
+    today = date.today()
+    messages = MESSAGES
+
+    def parse_all() -> None:
+        for message in messages:
+            parse_expense(message, today)
+
+    repeat = max(1, number // len(messages))
+    best = min(timeit.repeat(parse_all, number=repeat, repeat=5))
+    return repeat * len(messages) / best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=200_000, help="parses per round")
+    parser.add_argument("--min-ops", type=float, default=0, help="fail below this rate")
+    args = parser.parse_args()
+
+    ops = run(args.number)
+    print(f"parse_expense: {ops:,.0f} messages/s ({1e6 / ops:.2f} µs per message)")
+    if ops < args.min_ops:
+        print(f"below the required {args.min_ops:,.0f} messages/s", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
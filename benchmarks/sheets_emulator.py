@@ -0,0 +1,415 @@
+"""In-process emulator of the Google Sheets API endpoints this project uses.
+
+`SheetsEmulator` keeps a spreadsheet with a `data` and a `service` worksheet
+in memory and answers gspread's requests through a `requests.Session`, so
+`SheetsSession` (throttling, retries, circuit breaker included) runs
+unchanged against it:
+
+    emulator = SheetsEmulator.with_expenses(10_000, latency_seconds=0.1)
+    state.session = emulator.sheets_session()
+
+Supported: spreadsheet metadata, values.get, values.batchGet, values.update,
+values.append and spreadsheets.batchUpdate with insertDimension, which is
+what `insert_rows`, `acell`, `get` and `batch_get` send. Each request can be
+delayed, rejected with 429 above a per-minute quota, or fail with 503 at a
+given rate. The data sheet has a header in row 1 and expenses from row 2,
+newest first; service!B2 holds that first data row.
+"""
+
+from __future__ import annotations
+
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import date, datetime, timedelta, timezone
+from typing import Any
+from urllib.parse import unquote, urlsplit
+
+import requests
+from google.auth.credentials import Credentials
+
+from benchmarks.aggregate_bench import CATEGORIES
+from src.services.resilience import api_method
+from src.services.sheets import SHEETS_EPOCH_ORDINAL, SheetsSession
+
+HEADER = ["Дата", "Категория", "Сумма", "Комментарий"]
+COMMENTS = ["", "", "", "утро", "с друзьями", "доставка"]
+DEFAULT_ROW_COUNT = 1000  # grid size of a new sheet
+COLUMN_COUNT = 26
+
+CELL = re.compile(r"([A-Z]*)(\d*)")
+Cell = str | float | int | date
+
+
+def expense_rows(count: int, end: date | None = None, seed: int = 0) -> list[list[Cell]]:
+    """`count` data rows spread over ten years up to `end` (today), newest first."""
+    rng = random.Random(seed)
+    end = end or date.today()
+    span = 3650
+    return [
+        [
+            end - timedelta(days=span * i // count),
+            rng.choice(CATEGORIES),
+            float(rng.randint(50, 5000)),
+            rng.choice(COMMENTS),
+        ]
+        for i in range(count)
+    ]
+
+
+def _column_index(letters: str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index
+
+
+def _parse_range(label: str) -> tuple[str, tuple[int | None, int | None, int | None, int | None]]:
+    """`'data'!A2:D9` -> ("data", (first row, first column, last row, last column)), 1-based."""
+    sheet, _, cells = label.rpartition("!")
+    if sheet.startswith("'") and sheet.endswith("'"):
+        sheet = sheet[1:-1].replace("''", "'")
+    start, _, end = cells.partition(":")
+    start_col, start_row = CELL.fullmatch(start).groups()
+    end_col, end_row = CELL.fullmatch(end or start).groups()
+    return sheet, (
+        int(start_row) if start_row else None,
+        _column_index(start_col) if start_col else None,
+        int(end_row) if end_row else None,
+        _column_index(end_col) if end_col else None,
+    )
+
+
+def _user_entered(value: Any) -> Cell:
+    """What Sheets makes of a typed-in value: numbers and dates are recognized."""
+    if not isinstance(value, str):
+        return value
+    text = value.strip()
+    try:
+        return float(text.replace(",", "."))
+    except ValueError:
+        pass
+    try:
+        if "." in text:
+            day, month, year = (int(part) for part in text.split("."))
+            return date(year, month, day)
+        return date.fromisoformat(text)
+    except ValueError:
+        return value
+
+
+def _render(value: Cell, unformatted: bool, serial_dates: bool) -> Any:
+    if isinstance(value, date):
+        if unformatted and serial_dates:
+            return value.toordinal() - SHEETS_EPOCH_ORDINAL
+        return value.strftime("%d.%m.%Y")
+    if isinstance(value, float):
+        number = int(value) if value.is_integer() else value
+        return number if unformatted else f"{value:g}"
+    if isinstance(value, int) and not unformatted:
+        return str(value)
+    return value
+
+
+class EmulatorError(Exception):
+    def __init__(self, code: int, status: str, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+        self.status = status
+
+
+class Worksheet:
+    def __init__(self, sheet_id: int, title: str, rows: list[list[Cell]]) -> None:
+        self.id = sheet_id
+        self.title = title
+        self.rows = rows
+        self.row_count = max(DEFAULT_ROW_COUNT, len(rows) + 100)
+
+    def properties(self, index: int) -> dict[str, Any]:
+        return {
+            "sheetId": self.id,
+            "title": self.title,
+            "index": index,
+            "sheetType": "GRID",
+            "gridProperties": {"rowCount": self.row_count, "columnCount": COLUMN_COUNT},
+        }
+
+    def bounds(self, box: tuple[int | None, ...]) -> tuple[int, int, int, int]:
+        first_row, first_col, last_row, last_col = box
+        first_row, first_col = first_row or 1, first_col or 1
+        last_row, last_col = last_row or self.row_count, last_col or COLUMN_COUNT
+        if first_row > self.row_count or last_row < first_row or last_col < first_col:
+            raise EmulatorError(
+                400,
+                "INVALID_ARGUMENT",
+                f"Range ({self.title}!R{first_row}) exceeds grid limits. "
+                f"Max rows: {self.row_count}, max columns: {COLUMN_COUNT}",
+            )
+        return first_row, first_col, min(last_row, self.row_count), last_col
+
+    def read(self, box: tuple[int | None, ...], unformatted: bool, serial: bool) -> list[list]:
+        first_row, first_col, last_row, last_col = self.bounds(box)
+        values = []
+        for row in self.rows[first_row - 1 : last_row]:
+            cells = [_render(c, unformatted, serial) for c in row[first_col - 1 : last_col]]
+            while cells and cells[-1] in ("", None):
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def write(self, first_row: int, first_col: int, values: list[list[Cell]]) -> None:
+        for offset, row_values in enumerate(values):
+            index = first_row - 1 + offset
+            while len(self.rows) <= index:
+                self.rows.append([])
+            row = self.rows[index]
+            needed = first_col - 1 + len(row_values)
+            row.extend([""] * (needed - len(row)))
+            row[first_col - 1 : needed] = row_values
+        self.row_count = max(self.row_count, first_row - 1 + len(values))
+
+    def insert_rows(self, start_index: int, end_index: int) -> None:
+        if start_index > self.row_count:
+            raise EmulatorError(400, "INVALID_ARGUMENT", "insertDimension past the end of grid")
+        while len(self.rows) < start_index:
+            self.rows.append([])
+        self.rows[start_index:start_index] = [[] for _ in range(end_index - start_index)]
+        self.row_count += end_index - start_index
+
+
+class SheetsEmulator:
+    """One emulated spreadsheet; thread-safe, shared by every session made from it."""
+
+    def __init__(
+        self,
+        rows: list[list[Cell]] | None = None,
+        *,
+        spreadsheet_id: str = "emulated",
+        latency_seconds: float = 0.0,
+        jitter_seconds: float = 0.0,
+        requests_per_minute: float | None = None,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.spreadsheet_id = spreadsheet_id
+        self.latency = latency_seconds
+        self.jitter = jitter_seconds
+        self.requests_per_minute = requests_per_minute
+        self.error_rate = error_rate
+        self.sheets = {
+            "data": Worksheet(0, "data", [list(HEADER)] + [list(row) for row in rows or []]),
+            "service": Worksheet(1, "service", [["", ""], ["Первая строка данных", 2]]),
+        }
+        self.calls: Counter[str] = Counter()  # requests by Sheets API method
+        self.rejected: Counter[int] = Counter()  # error responses by status code
+        self._recent: deque[float] = deque()  # request times within the last minute
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def with_expenses(cls, count: int, seed: int = 0, **kwargs: Any) -> SheetsEmulator:
+        return cls(expense_rows(count, seed=seed), seed=seed, **kwargs)
+
+    def http_session(self) -> EmulatedHTTPSession:
+        return EmulatedHTTPSession(self)
+
+    def sheets_session(self, **kwargs: Any) -> SheetsSession:
+        """A SheetsSession talking to this emulator; kwargs as for SheetsSession."""
+        return SheetsSession(
+            "{}",
+            self.spreadsheet_id,
+            credentials=EmulatorCredentials(),
+            http_session=self.http_session(),
+            **kwargs,
+        )
+
+    def data_rows(self) -> list[list[Cell]]:
+        """The data sheet below the header, newest first."""
+        with self._lock:
+            return [list(row) for row in self.sheets["data"].rows[1:]]
+
+    # -- request handling ----------------------------------------------------------
+
+    def handle(
+        self, method: str, url: str, params: dict[str, Any] | None, body: Any
+    ) -> requests.Response:
+        name = api_method(method, url)
+        delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        try:
+            with self._lock:
+                self.calls[name] += 1
+                self._check_quota()
+                if self.error_rate and self._rng.random() < self.error_rate:
+                    raise EmulatorError(503, "UNAVAILABLE", "The service is currently unavailable.")
+                payload = self._dispatch(method.upper(), url, params or {}, body)
+        except EmulatorError as exc:
+            self.rejected[exc.code] += 1
+            error = {"code": exc.code, "message": str(exc), "status": exc.status}
+            return self._response(exc.code, {"error": error}, url)
+        return self._response(200, payload, url)
+
+    def _check_quota(self) -> None:
+        if self.requests_per_minute is None:
+            return
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] >= 60:
+            self._recent.popleft()
+        if len(self._recent) >= self.requests_per_minute:
+            raise EmulatorError(
+                429,
+                "RESOURCE_EXHAUSTED",
+                "Quota exceeded for quota metric 'Read requests' and limit "
+                "'Read requests per minute per user'",
+            )
+        self._recent.append(now)
+
+    @staticmethod
+    def _response(status: int, payload: Any, url: str) -> requests.Response:
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(payload, ensure_ascii=False).encode()
+        response.headers["Content-Type"] = "application/json; charset=UTF-8"
+        response.encoding = "utf-8"
+        response.url = url
+        return response
+
+    def _dispatch(self, method: str, url: str, params: dict[str, Any], body: Any) -> Any:
+        path = urlsplit(url).path
+        _, _, rest = path.partition("/v4/spreadsheets/")
+        spreadsheet_id, values, range_part = rest.partition("/values")
+        spreadsheet_id, _, verb = spreadsheet_id.partition(":")
+        if spreadsheet_id != self.spreadsheet_id:
+            raise EmulatorError(404, "NOT_FOUND", "Requested entity was not found.")
+
+        if not values:
+            if method == "GET" and not verb:
+                return self._metadata()
+            if method == "POST" and verb == "batchUpdate":
+                return self._batch_update(body or {})
+        elif range_part == ":batchGet" and method == "GET":
+            ranges = params.get("ranges") or []
+            ranges = [ranges] if isinstance(ranges, str) else ranges
+            return {
+                "spreadsheetId": self.spreadsheet_id,
+                "valueRanges": [self._get(label, params) for label in ranges],
+            }
+        elif range_part.startswith("/"):
+            label, _, action = range_part[1:].partition(":")
+            label = unquote(label)
+            if method == "GET" and not action:
+                return self._get(label, params)
+            if method == "PUT" and not action:
+                return self._update(label, params, body or {})
+            if method == "POST" and action == "append":
+                return self._append(label, params, body or {})
+        raise EmulatorError(400, "INVALID_ARGUMENT", f"Not emulated: {method} {path}")
+
+    def _metadata(self) -> dict[str, Any]:
+        return {
+            "spreadsheetId": self.spreadsheet_id,
+            "properties": {"title": "Emulated expenses", "locale": "ru_RU"},
+            "sheets": [
+                {"properties": sheet.properties(index)}
+                for index, sheet in enumerate(self.sheets.values())
+            ],
+        }
+
+    def _sheet(self, title: str) -> Worksheet:
+        sheet = self.sheets.get(title)
+        if sheet is None:
+            raise EmulatorError(400, "INVALID_ARGUMENT", f"Unable to parse range: {title}")
+        return sheet
+
+    def _get(self, label: str, params: dict[str, Any]) -> dict[str, Any]:
+        title, box = _parse_range(label)
+        unformatted = params.get("valueRenderOption") == "UNFORMATTED_VALUE"
+        serial = params.get("dateTimeRenderOption", "SERIAL_NUMBER") == "SERIAL_NUMBER"
+        values = self._sheet(title).read(box, unformatted, serial)
+        result: dict[str, Any] = {"range": label, "majorDimension": "ROWS"}
+        if values:
+            result["values"] = values
+        return result
+
+    def _converted(self, params: dict[str, Any], body: dict[str, Any]) -> list[list[Cell]]:
+        values = body.get("values") or []
+        if params.get("valueInputOption") == "USER_ENTERED":
+            return [[_user_entered(value) for value in row] for row in values]
+        return [list(row) for row in values]
+
+    def _update(self, label: str, params: dict[str, Any], body: dict[str, Any]) -> Any:
+        title, box = _parse_range(label)
+        values = self._converted(params, body)
+        self._sheet(title).write(box[0] or 1, box[1] or 1, values)
+        return {
+            "spreadsheetId": self.spreadsheet_id,
+            "updatedRange": label,
+            "updatedRows": len(values),
+        }
+
+    def _append(self, label: str, params: dict[str, Any], body: dict[str, Any]) -> Any:
+        """Write below the table that starts at the range: the first empty row from there."""
+        title, box = _parse_range(label)
+        sheet = self._sheet(title)
+        row = box[0] or 1
+        while row <= len(sheet.rows) and any(
+            cell not in ("", None) for cell in sheet.rows[row - 1]
+        ):
+            row += 1
+        values = self._converted(params, body)
+        sheet.write(row, box[1] or 1, values)
+        return {
+            "spreadsheetId": self.spreadsheet_id,
+            "updates": {"updatedRange": f"{title}!A{row}", "updatedRows": len(values)},
+        }
+
+    def _batch_update(self, body: dict[str, Any]) -> Any:
+        by_id = {sheet.id: sheet for sheet in self.sheets.values()}
+        replies = []
+        for request in body.get("requests", []):
+            insert = request.get("insertDimension")
+            if insert is None or insert["range"].get("dimension") != "ROWS":
+                raise EmulatorError(400, "INVALID_ARGUMENT", f"Not emulated: {list(request)}")
+            target = insert["range"]
+            sheet = by_id.get(target["sheetId"])
+            if sheet is None:
+                raise EmulatorError(
+                    400, "INVALID_ARGUMENT", f"No grid with id: {target['sheetId']}"
+                )
+            sheet.insert_rows(target["startIndex"], target["endIndex"])
+            replies.append({})
+        return {"spreadsheetId": self.spreadsheet_id, "replies": replies}
+
+
+class EmulatedHTTPSession(requests.Session):
+    """requests.Session answering Sheets API URLs from a SheetsEmulator, without a network."""
+
+    def __init__(self, emulator: SheetsEmulator) -> None:
+        super().__init__()
+        self.emulator = emulator
+
+    def request(  # type: ignore[override]
+        self,
+        method: str,
+        url: str,
+        params: dict[str, Any] | None = None,
+        data: Any = None,
+        headers: Any = None,
+        json: Any = None,
+        **kwargs: Any,
+    ) -> requests.Response:
+        return self.emulator.handle(method, url, params, json)
+
+
+class EmulatorCredentials(Credentials):
+    """Credentials that refresh without a round trip to Google's token endpoint."""
+
+    def refresh(self, request: Any) -> None:
+        self.token = "emulated"
+        self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
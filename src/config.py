@@ -7,24 +7,73 @@ class Settings(BaseSettings):
 
     # Telegram
     telegram_bot_token: SecretStr | None = None
+    # Set to receive updates by webhook at WEBAPP_URL + /telegram/webhook instead of polling
+    telegram_webhook_secret: SecretStr | None = None  # 1-256 chars: A-Z, a-z, 0-9, _ and -
+    telegram_webhook_delete_on_shutdown: bool = True  # disable when running several replicas
 
     # Google Sheets
     google_service_account_json: SecretStr | None = None  # inline JSON string
     google_spreadsheet_id: str | None = None
     google_worksheet_name: str = "data"
     google_worksheet_name_service: str = "service"
+    google_token_refresh_margin_seconds: int = 300  # refresh access token this early
+
+    # Sheets I/O (blocking gspread calls run in a bounded thread pool)
+    sheets_max_workers: int = 4
+    sheets_max_concurrency: int = 16  # calls queued or running at once
+    sheets_timeout_seconds: float = 20.0
+    sheets_first_row_ttl_seconds: float = 3600  # cache for the service!B2 pointer
+    sheets_requests_per_minute: float = 60  # client-side limit, the per-user Sheets API quota
+    sheets_request_burst: int = 10
+    sheets_read_attempts: int = 4  # reads are retried on 429/5xx with jittered backoff
+    sheets_breaker_failures: int = 5  # consecutive failures before requests are paused
+    sheets_breaker_reset_seconds: float = 30
+    store_max_workers: int = 2  # threads for local store reads, apart from the Sheets pool
 
     # Access control
     allowed_chat_id: int | None = None
 
+    # Tenants: chats with a spreadsheet of their own (unset: one, from the settings above)
+    tenants_file: str | None = None  # JSON list, see src/services/tenants.py
+    tenant_data_dir: str = "tenants"  # local store file per tenant
+    tenant_pool_size: int = 50  # tenants kept open (Sheets session, store, caches)
+    sheets_tenant_max_concurrency: int = 2  # Sheets calls in flight per tenant, if several
+
     # Webapp (Telegram Mini App)
     webapp_url: str | None = None  # public HTTPS URL for the Mini App
     webapp_init_data_max_age_seconds: int = 300
+    # sha256 of chart.umd.min.js (hex); the CDN fallback is only loaded with a matching hash
+    chart_js_sha256: str | None = None
 
     # Bot Backend
     bot_backend_host: str | None = None
     bot_backend_port: int | None = None
+    # sqlite:///path.db (default financier.sqlite3)
     bot_backend_database_url: SecretStr | None = None
+    bot_serve_webapp: bool = True  # false when `financier-web` serves the Mini App instead
+    web_workers: int = 2  # processes of `financier-web`, sharing the store file with the bot
+    metrics_token: SecretStr | None = None  # if set, /metrics requires Authorization: Bearer <it>
+
+    # Tracing of bot updates and web requests
+    trace_slow_ms: float = 2000  # log the span tree of slower ones (0: never)
+    profile_slow_ms: float | None = None  # set to sample stacks and save profiles of slower ones
+    profile_interval_ms: float = 5
+    profile_dir: str = "profiles"  # folded stacks, for flamegraph.pl or speedscope
+    store_sync_interval_seconds: float = 30  # fetch rows added to the sheet since last sync
+    store_full_sync_interval_seconds: float = 3600  # full re-read to catch edits in the middle
+
+    # Outbox for new expenses, drained to the sheet in the background
+    write_queue_window_seconds: float = 0.5  # coalesce messages arriving within this window
+    write_queue_max_batch: int = 100
+    write_queue_outbox_path: str = "outbox.sqlite3"  # keep it: holds expenses not yet in the sheet
+
+    # /export and /api/export
+    export_page_rows: int = 1000  # rows read and encoded at a time; bounds the memory of an export
+
+    # Per-month stats cache
+    stats_cache_max_months: int = 36
+    stats_cache_current_month_ttl_seconds: float = 60
+    stats_cache_past_month_ttl_seconds: float = 24 * 3600
 
 
 settings = Settings()
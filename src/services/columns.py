@@ -0,0 +1,156 @@
+"""Columnar expense table with vectorized aggregation.
+
+Rows are kept as parallel typed columns: dates as int32 day numbers, months
+as int32 `year * 12 + month - 1`, amounts as float64 and categories as
+dictionary-encoded int32 ids. Aggregations run on NumPy views of the same
+buffers when NumPy is installed, and as plain loops over the arrays otherwise.
+"""
+
+from __future__ import annotations
+
+from array import array
+from datetime import date
+from typing import Iterable
+
+from src.services.stats import MonthStats
+
+try:
+    import numpy as np
+except ImportError:  # optional: the stdlib arrays are aggregated in Python
+    np = None
+
+
+def month_number(year: int, month: int) -> int:
+    return year * 12 + month - 1
+
+
+class ExpenseColumns:
+    def __init__(self) -> None:
+        self.days = array("i")
+        self.months = array("i")
+        self.amounts = array("d")
+        self.categories = array("i")
+        self.category_names: list[str] = []
+        self._category_ids: dict[str, int] = {}
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple[date, str, float, str]]) -> ExpenseColumns:
+        """Build from (date, category, amount, comment) rows."""
+        columns = cls()
+        for expense_date, category, amount, _ in rows:
+            columns.append(expense_date, category, amount)
+        return columns
+
+    def __len__(self) -> int:
+        return len(self.amounts)
+
+    def append(self, expense_date: date, category: str, amount: float) -> None:
+        category_id = self._category_ids.get(category)
+        if category_id is None:
+            category_id = self._category_ids[category] = len(self.category_names)
+            self.category_names.append(category)
+        self.days.append(expense_date.toordinal())
+        self.months.append(month_number(expense_date.year, expense_date.month))
+        self.amounts.append(amount)
+        self.categories.append(category_id)
+
+    def month_category_totals(
+        self, months: list[tuple[int, int]]
+    ) -> dict[tuple[int, int], dict[str, float]]:
+        """Per-category totals of each (year, month) of a contiguous span, empty ones included."""
+        first = month_number(*months[0])
+        sums = self._grouped_sums(first, first + len(months) - 1)
+        return {
+            key: {
+                self.category_names[category_id]: amount
+                for category_id, amount in row.items()
+                if self.category_names[category_id]
+            }
+            for key, row in zip(months, sums)
+        }
+
+    def top_categories(
+        self, start: tuple[int, int], end: tuple[int, int], n: int
+    ) -> list[tuple[str, float]]:
+        """The `n` largest categories over the months start..end, inclusive."""
+        first, last = month_number(*start), month_number(*end)
+        if np is not None:
+            mask = self._mask(first, last)
+            sums = np.bincount(
+                self._np("categories", "i")[mask],
+                weights=self._np("amounts", "d")[mask],
+                minlength=len(self.category_names),
+            )
+            order = np.argsort(-sums, kind="stable")
+            ranked = [(int(i), float(sums[i])) for i in order if sums[i]]
+        else:
+            totals: dict[int, float] = {}
+            for row in self._grouped_sums(first, last):
+                for category_id, amount in row.items():
+                    totals[category_id] = totals.get(category_id, 0.0) + amount
+            ranked = sorted(totals.items(), key=lambda x: x[1], reverse=True)
+        return [(self.category_names[i], a) for i, a in ranked if self.category_names[i]][:n]
+
+    def month_stats(self, year: int, month: int) -> MonthStats:
+        target = month_number(year, month)
+        if np is not None:
+            (sums,) = self._grouped_sums(target, target)
+            mask = self._mask(target, target)
+            total = float(self._np("amounts", "d")[mask].sum())
+            count = int(mask.sum())
+            days = len(np.unique(self._np("days", "i")[mask]))
+        else:
+            sums = {}
+            total, count, day_set = 0.0, 0, set()
+            for day, m, category_id, amount in zip(
+                self.days, self.months, self.categories, self.amounts
+            ):
+                if m == target:
+                    sums[category_id] = sums.get(category_id, 0.0) + amount
+                    total += amount
+                    count += 1
+                    day_set.add(day)
+            days = len(day_set)
+        categories = sorted(
+            (
+                (self.category_names[category_id], amount)
+                for category_id, amount in sums.items()
+                if self.category_names[category_id]
+            ),
+            key=lambda x: x[1],
+            reverse=True,
+        )
+        return MonthStats(year, month, categories, total, count, days)
+
+    def _np(self, column: str, typecode: str) -> np.ndarray:
+        # Zero-copy view of the stdlib array's buffer.
+        values = getattr(self, column)
+        return np.frombuffer(values, dtype=np.dtype(typecode)) if values else np.empty(0, typecode)
+
+    def _mask(self, first: int, last: int) -> np.ndarray:
+        months = self._np("months", "i")
+        return (months >= first) & (months <= last)
+
+    def _grouped_sums(self, first: int, last: int) -> list[dict[int, float]]:
+        """{category id: total} for every month number first..last."""
+        span = last - first + 1
+        if np is not None:
+            mask = self._mask(first, last)
+            width = max(1, len(self.category_names))
+            months = self._np("months", "i")[mask] - first
+            keys = months * width + self._np("categories", "i")[mask]
+            grid = np.bincount(
+                keys, weights=self._np("amounts", "d")[mask], minlength=span * width
+            ).reshape(span, width)
+            counts = np.bincount(keys, minlength=span * width).reshape(span, width)
+            return [
+                {int(i): float(row[i]) for i in np.flatnonzero(present)}
+                for row, present in zip(grid, counts)
+            ]
+
+        sums: list[dict[int, float]] = [{} for _ in range(span)]
+        for month, category_id, amount in zip(self.months, self.categories, self.amounts):
+            if first <= month <= last:
+                row = sums[month - first]
+                row[category_id] = row.get(category_id, 0.0) + amount
+        return sums
@@ -0,0 +1,277 @@
+"""Expense history export as CSV or XLSX, streamed page by page.
+
+Rows come from the local store once it is synced, or from the sheet in
+paged range reads before that. Each page is filtered and encoded before the
+next one is read, so an export holds one page of rows and the encoder's
+buffer no matter how long the history is. `sheets_async.stream_export`
+drives the pipeline from the event loop, a page per worker call.
+
+XLSX is written with the standard library: a zip archive streamed with data
+descriptors, holding a minimal workbook with one inline-string worksheet.
+"""
+
+from __future__ import annotations
+
+import calendar
+import csv
+import io
+import re
+import zipfile
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Callable, Iterable, Iterator
+from xml.sax.saxutils import escape
+
+from src.config import settings
+from src.services import sheets
+from src.services.store import Row
+from src.services.tenants import get_store
+
+HEADER = ("Дата", "Категория", "Сумма", "Комментарий")
+
+
+@dataclass(frozen=True)
+class ExportQuery:
+    start: date | None = None  # inclusive
+    end: date | None = None  # inclusive
+    categories: frozenset[str] = field(default_factory=frozenset)  # casefolded; empty for all
+
+    def matches(self, row: Row) -> bool:
+        expense_date, category = row[0], row[1]
+        if self.start is not None and expense_date < self.start:
+            return False
+        if self.end is not None and expense_date > self.end:
+            return False
+        return not self.categories or category.casefold() in self.categories
+
+
+def build_query(
+    start: date | None = None, end: date | None = None, categories: Iterable[str] = ()
+) -> ExportQuery:
+    if start is not None and end is not None and start > end:
+        raise ValueError("Start date is after end date")
+    names = frozenset(name.strip().casefold() for name in categories if name.strip())
+    return ExportQuery(start, end, names)
+
+
+PERIOD = re.compile(r"(\d{4})(?:-(\d{2}))?(?:-(\d{2}))?")
+
+
+def _period(token: str) -> tuple[date, date] | None:
+    """First and last day of YYYY, YYYY-MM or YYYY-MM-DD; None if `token` is not one."""
+    match = PERIOD.fullmatch(token)
+    if not match:
+        return None
+    year, month, day = (int(part) if part else None for part in match.groups())
+    try:
+        if day is not None:
+            return date(year, month, day), date(year, month, day)
+        if month is not None:
+            return date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1])
+        return date(year, 1, 1), date(year, 12, 31)
+    except ValueError as exc:
+        raise ValueError(f"Invalid date: {token}") from exc
+
+
+def parse_args(args: list[str]) -> tuple[str, ExportQuery]:
+    """
+    Parse `/export [csv|xlsx] [period [period]] [category, ...]`.
+
+    A period is YYYY, YYYY-MM or YYYY-MM-DD: one exports that period, two
+    everything from the start of the first to the end of the second.
+    Categories are comma separated and may contain spaces.
+    """
+    export_format = "csv"
+    periods: list[tuple[date, date]] = []
+    words: list[str] = []
+    for arg in args:
+        period = _period(arg)
+        if arg.lower() in FORMATS:
+            export_format = arg.lower()
+        elif period is not None:
+            periods.append(period)
+        else:
+            words.append(arg)
+    if len(periods) > 2:
+        raise ValueError("At most two dates: from and to")
+    start = periods[0][0] if periods else None
+    end = periods[-1][1] if periods else None
+    return export_format, build_query(start, end, " ".join(words).split(","))
+
+
+def filename(export_format: str, export_query: ExportQuery) -> str:
+    bounds = [d.isoformat() for d in (export_query.start, export_query.end) if d is not None]
+    return "_".join(["expenses", *bounds]) + f".{export_format}"
+
+
+def rows(export_query: ExportQuery, page_rows: int) -> Iterator[list[Row]]:
+    """Matching expenses newest first, a page at a time; pages with no match are skipped."""
+    sheets.refresh_from_store()
+    store = get_store()
+    if store.is_synced():
+        pages = store.pages(export_query.start, export_query.end, page_rows)
+    else:
+        pages = sheets.iter_data_pages(page_rows)
+    for page in pages:
+        matching = [row for row in page if export_query.matches(row)]
+        if matching:
+            yield matching
+
+
+def _amount(value: float) -> str:
+    return f"{value:.15g}"
+
+
+def encode_csv(pages: Iterable[list[Row]]) -> Iterator[bytes]:
+    """UTF-8 with a BOM, which Excel needs to read Cyrillic; dates as YYYY-MM-DD."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(HEADER)
+    for page in pages:
+        writer.writerows((d.isoformat(), c, _amount(a), comment) for d, c, a, comment in page)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():  # nothing matched: just the header
+        yield buffer.getvalue().encode("utf-8")
+
+
+XLSX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" '
+        'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        "</Types>"
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" Type="http://schemas.openxmlformats.org/'
+        'officeDocument/2006/relationships/officeDocument"/>'
+        "</Relationships>"
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Траты" sheetId="1" r:id="rId1"/></sheets>'
+        "</workbook>"
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" Type="http://schemas.'
+        'openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '<Relationship Id="rId2" Target="styles.xml" Type="http://schemas.'
+        'openxmlformats.org/officeDocument/2006/relationships/styles"/>'
+        "</Relationships>"
+    ),
+    # Cell styles: 0 default, 1 a DD.MM.YYYY date, 2 bold for the header.
+    "xl/styles.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="dd.mm.yyyy"/></numFmts>'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+        '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+        '<fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/>'
+        "</cellStyleXfs>"
+        '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+        "</cellXfs></styleSheet>"
+    ),
+}
+SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<cols><col min="1" max="1" width="12" customWidth="1"/>'
+    '<col min="2" max="2" width="20" customWidth="1"/>'
+    '<col min="4" max="4" width="30" customWidth="1"/></cols>'
+    "<sheetData>"
+)
+SHEET_END = "</sheetData></worksheet>"
+
+# Characters XML 1.0 does not allow, even escaped.
+_XML_ILLEGAL = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+
+def _text_cell(value: str, style: int = 0) -> str:
+    text = escape(_XML_ILLEGAL.sub("", value))
+    return f'<c t="inlineStr" s="{style}"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _xlsx_row(row: Row) -> str:
+    expense_date, category, amount, comment = row
+    serial = expense_date.toordinal() - sheets.SHEETS_EPOCH_ORDINAL
+    return (
+        f'<row><c s="1"><v>{serial}</v></c>{_text_cell(category)}'
+        f"<c><v>{_amount(amount)}</v></c>{_text_cell(comment)}</row>"
+    )
+
+
+class _Sink(io.RawIOBase):
+    """Unseekable file collecting what zipfile writes until it is taken."""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def encode_xlsx(pages: Iterable[list[Row]]) -> Iterator[bytes]:
+    """A one-sheet workbook; dates are real dates, amounts numbers."""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, body in XLSX_PARTS.items():
+            archive.writestr(name, body)
+        with archive.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write(SHEET_START.encode())
+            sheet.write(f"<row>{''.join(_text_cell(h, 2) for h in HEADER)}</row>".encode())
+            for page in pages:
+                sheet.write("".join(_xlsx_row(row) for row in page).encode())
+                if chunk := sink.take():  # the compressor may still be holding it all
+                    yield chunk
+            sheet.write(SHEET_END.encode())
+    yield sink.take()
+
+
+FORMATS: dict[str, tuple[Callable[[Iterable[list[Row]]], Iterator[bytes]], str]] = {
+    "csv": (encode_csv, "text/csv; charset=utf-8"),
+    "xlsx": (
+        encode_xlsx,
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ),
+}
+
+
+def encode(export_format: str, export_query: ExportQuery) -> Iterator[bytes]:
+    """The whole pipeline: read pages, filter, encode. Nothing runs until the first next()."""
+    encoder, _ = FORMATS[export_format]
+    return encoder(rows(export_query, settings.export_page_rows))
+
+
+def read_chunk(chunks: Iterator[bytes]) -> bytes | None:
+    """The next encoded chunk, None at the end; run in a Sheets worker."""
+    return next(chunks, None)
@@ -0,0 +1,243 @@
+"""In-process metrics in the Prometheus text format, served at /metrics.
+
+Counters and histograms are plain dicts of floats behind a lock, so recording
+costs a bisect and a few additions; gauges are read from their sources only
+when /metrics is scraped. Every process (bot, each `financier-web` worker)
+exposes its own numbers.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from loguru import logger
+
+# Seconds; from a cached stats lookup to a slow Google Sheets read.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+Labels = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> Labels:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        """Sample lines of the text format, without the HELP and TYPE header."""
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(line + "\n" for line in self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v:g}" for k, v in values]
+
+
+class Gauge(Metric):
+    """Read from `read` at scrape time: a number, or {label values: number}."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        read: Callable[[], float | dict[Labels, float]],
+        labelnames: tuple[str, ...] = (),
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self._read = read
+
+    def samples(self) -> list[str]:
+        try:
+            value = self._read()
+        except Exception as exc:
+            logger.debug(f"Gauge {self.name} unavailable: {exc}")
+            return []
+        values = value.items() if isinstance(value, dict) else [((), value)]
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v:g}" for k, v in values]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        # per label values: [count per bucket..., +Inf count], sum
+        self._series: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels: str) -> int:
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return sum(series[0]) if series else 0
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            series = sorted((k, list(c), s[0]) for k, (c, s) in self._series.items())
+        lines = []
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                labels = _format_labels(self.labelnames, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total:g}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self._metrics.values())
+
+
+registry = Registry()
+
+
+def counter(name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+    metric = Counter(name, help, labelnames)
+    registry.register(metric)
+    return metric
+
+
+def histogram(
+    name: str,
+    help: str,
+    labelnames: tuple[str, ...] = (),
+    buckets: tuple[float, ...] = LATENCY_BUCKETS,
+) -> Histogram:
+    metric = Histogram(name, help, labelnames, buckets)
+    registry.register(metric)
+    return metric
+
+
+def gauge(
+    name: str,
+    help: str,
+    read: Callable[[], float | dict[Labels, float]],
+    labelnames: tuple[str, ...] = (),
+) -> Gauge:
+    metric = Gauge(name, help, read, labelnames)
+    registry.register(metric)
+    return metric
+
+
+handler_seconds = histogram("financier_handler_seconds", "Telegram handler latency", ("handler",))
+http_request_seconds = histogram(
+    "financier_http_request_seconds", "Web request latency by route", ("route", "status")
+)
+sheets_call_seconds = histogram(
+    "financier_sheets_call_seconds",
+    "Sheets operations run in the worker pool, including the wait for a worker",
+    ("call",),
+)
+sheets_request_seconds = histogram(
+    "financier_sheets_request_seconds",
+    "Google Sheets API requests by method, one per attempt",
+    ("method", "status"),
+)
+sheets_retries = counter("financier_sheets_retries_total", "Sheets reads retried after an error")
+cache_lookups = counter(
+    "financier_cache_lookups_total", "Cache lookups by cache and result", ("cache", "result")
+)
+loop_lag_seconds = histogram(
+    "financier_event_loop_lag_seconds",
+    "How late the event loop woke a timer",
+    buckets=LOOP_LAG_BUCKETS,
+)
+
+_loop_monitor: asyncio.Task | None = None
+
+
+async def _monitor_loop(interval_seconds: float) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval_seconds)
+        loop_lag_seconds.observe(max(0.0, loop.time() - started - interval_seconds))
+
+
+def start_loop_monitor(interval_seconds: float = 0.5) -> None:
+    """Sample event-loop lag in the background; once per process."""
+    global _loop_monitor
+    if _loop_monitor is None or _loop_monitor.done():
+        _loop_monitor = asyncio.get_running_loop().create_task(_monitor_loop(interval_seconds))
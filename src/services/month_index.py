@@ -0,0 +1,77 @@
+"""Index of where each month's rows sit in the data sheet."""
+
+from __future__ import annotations
+
+import threading
+from datetime import date
+
+Span = list[int]  # [lowest age, highest age]
+
+
+class MonthIndex:
+    """
+    Maps (year, month) to the spans of rows holding that month's expenses.
+
+    Rows are kept newest first and new ones are inserted at the top, so a
+    row's position is tracked as its age: 0 for the oldest row, count - 1 for
+    the newest. Ages never change on inserts, which keeps updates O(1).
+    Backdated expenses make a month non-contiguous, hence a list of spans.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._spans: dict[tuple[int, int], list[Span]] = {}
+        self.count: int | None = None  # rows covered, incl. ones without a date
+
+    def is_built(self) -> bool:
+        return self.count is not None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._spans = {}
+            self.count = None
+
+    def _add(self, age: int, row_date: date | None) -> None:
+        if row_date is None:
+            return
+        spans = self._spans.setdefault((row_date.year, row_date.month), [])
+        if spans and spans[-1][1] == age - 1:
+            spans[-1][1] = age
+        else:
+            spans.append([age, age])
+
+    def build(self, dates: list[date | None]) -> None:
+        """Build from the dates of all data rows, newest first as in the sheet."""
+        with self._lock:
+            self._spans = {}
+            for age, row_date in enumerate(reversed(dates)):
+                self._add(age, row_date)
+            self.count = len(dates)
+
+    def note_insert(self, row_date: date | None) -> None:
+        """Account for a row inserted at the top of the table."""
+        with self._lock:
+            if self.count is None:
+                return
+            self._add(self.count, row_date)
+            self.count += 1
+
+    def locate(
+        self, year: int, month: int, first_data_row: int
+    ) -> tuple[list[tuple[int, int]], int] | None:
+        """
+        Sheet row ranges (start, end) holding the month, newest first, and
+        the row of the oldest indexed expense; None until built.
+
+        Both come from one look at the index, which another thread may
+        invalidate at any moment.
+        """
+        with self._lock:
+            if self.count is None:
+                return None
+            top = first_data_row + self.count - 1
+            spans = self._spans.get((year, month), [])
+            return [(top - hi, top - lo) for lo, hi in reversed(spans)], top
+
+
+month_index = MonthIndex()
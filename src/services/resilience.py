@@ -0,0 +1,205 @@
+"""Request layer between gspread and Google: quota throttling, retries, circuit breaker.
+
+Every Sheets API request goes through `ResilientHTTPClient`. It waits for a
+token from a bucket sized to the per-minute quota, retries idempotent reads
+on 429/5xx with jittered exponential backoff, and counts consecutive
+failures in a circuit breaker. While the breaker is open requests fail
+immediately with `SheetsUnavailableError`; reads are then served by the
+local store and queued writes stay in the write queue until Google recovers.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any
+from urllib.parse import urlsplit
+
+import requests
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+from loguru import logger
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from src.services.metrics import sheets_request_seconds, sheets_retries
+from src.services.tracing import span
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class SheetsUnavailableError(RuntimeError):
+    """Google Sheets is failing; requests are short-circuited for a while."""
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Quota, server-side and network errors that are worth retrying later."""
+    if isinstance(exc, SheetsUnavailableError):
+        return True
+    if isinstance(exc, APIError):
+        return exc.response.status_code in RETRYABLE_STATUS
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+def api_method(method: str, endpoint: str) -> str:
+    """Sheets API method of a request, e.g. values.get or spreadsheets.batchUpdate."""
+    path = urlsplit(endpoint).path
+    resource = "values" if "/values" in path else "spreadsheets"
+    # Ranges in the path are percent-encoded, so a colon only precedes a custom verb.
+    last = path.rsplit("/", 1)[-1]
+    if ":" in last:
+        return f"{resource}.{last.rsplit(':', 1)[1]}"
+    verbs = {"GET": "get", "PUT": "update", "POST": "create"}
+    return f"{resource}.{verbs.get(method.upper(), method.lower())}"
+
+
+class TokenBucket:
+    """Thread-safe token bucket; `acquire` blocks until a token is available."""
+
+    def __init__(self, rate_per_minute: float, burst: int) -> None:
+        self.rate = rate_per_minute / 60
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited_seconds = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Take the token now, possibly going negative, so waiting callers
+            # are served in arrival order.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.waited_seconds += wait
+        if wait:
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive transient failures.
+
+    After `reset_seconds` one trial request is let through (half-open); its
+    outcome closes the circuit again or re-opens it for another period.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+    def before_request(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0 or self._trial_running:
+                raise SheetsUnavailableError(
+                    f"Google Sheets is unavailable, retrying in {max(remaining, 0):.0f}s"
+                )
+            self._trial_running = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Google Sheets recovered; circuit closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or (
+                self._opened_at is None and self._failures >= self.failure_threshold
+            ):
+                logger.warning(
+                    f"Google Sheets failing ({self._failures} errors in a row); "
+                    f"pausing requests for {self.reset_seconds:.0f}s"
+                )
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class ResilientHTTPClient(HTTPClient):
+    """gspread HTTP client that throttles, retries reads and trips the breaker."""
+
+    def __init__(
+        self,
+        auth: Any,
+        session: requests.Session | None = None,
+        *,
+        bucket: TokenBucket,
+        breaker: CircuitBreaker,
+        read_attempts: int = 4,
+        max_backoff_seconds: float = 8.0,
+    ) -> None:
+        super().__init__(auth, session)
+        self.bucket = bucket
+        self.breaker = breaker
+        self.read_attempts = read_attempts
+        self.max_backoff = max_backoff_seconds
+        self.retries = 0
+
+    def _attempt(self, method: str, endpoint: str, **kwargs: Any) -> requests.Response:
+        name = api_method(method, endpoint)
+        with span(name):  # includes the wait for a quota token
+            self.breaker.before_request()
+            self.bucket.acquire()
+            started = time.perf_counter()
+            try:
+                response = super().request(method, endpoint, **kwargs)
+            except Exception as exc:
+                status = str(exc.response.status_code) if isinstance(exc, APIError) else "error"
+                sheets_request_seconds.observe(
+                    time.perf_counter() - started, method=name, status=status
+                )
+                if is_transient(exc):
+                    self.breaker.record_failure()
+                else:
+                    # Google answered; the request itself was wrong.
+                    self.breaker.record_success()
+                raise
+            sheets_request_seconds.observe(
+                time.perf_counter() - started, method=name, status=str(response.status_code)
+            )
+            self.breaker.record_success()
+            return response
+
+    def _before_retry(self, retry_state: Any) -> None:
+        self.retries += 1
+        sheets_retries.inc()
+        logger.debug(
+            f"Retrying Sheets read after {retry_state.outcome.exception()!r} "
+            f"(attempt {retry_state.attempt_number})"
+        )
+
+    def request(self, method: str, endpoint: str, **kwargs: Any) -> requests.Response:
+        if method.upper() not in IDEMPOTENT_METHODS:
+            # A write that timed out may still have been applied; never repeat it here.
+            return self._attempt(method, endpoint, **kwargs)
+
+        retrying = Retrying(
+            stop=stop_after_attempt(self.read_attempts),
+            wait=wait_random_exponential(multiplier=0.5, max=self.max_backoff),
+            retry=retry_if_exception(
+                lambda exc: is_transient(exc) and not isinstance(exc, SheetsUnavailableError)
+            ),
+            before_sleep=self._before_retry,
+            reraise=True,
+        )
+        return retrying(self._attempt, method, endpoint, **kwargs)
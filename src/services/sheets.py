@@ -2,29 +2,382 @@ from __future__ import annotations
 
 import asyncio
 import json
-from datetime import datetime
-from functools import partial
-from typing import Any, Dict
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache, partial
+from typing import Any, Dict, Iterator
 
 import gspread
+import requests
+from gspread.utils import DateTimeOption, ValueRenderOption
+from google.auth.transport.requests import Request
 from google.oauth2.service_account import Credentials
 from loguru import logger
+from requests.adapters import HTTPAdapter
 
 from src.config import settings
+from src.services.columns import ExpenseColumns
+from src.services.resilience import CircuitBreaker, ResilientHTTPClient, TokenBucket
+from src.services.stats import MonthStats
+from src.services.store import Row, display_date
+from src.services.tenants import current_state, get_month_index, get_stats_cache, get_store
+from src.services.tracing import span
 
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
-def client_from_inline_json(inline_json: str) -> gspread.Client:
+# Data cells are read unformatted: amounts as numbers and dates as serial day
+# numbers, whatever the spreadsheet locale renders. Text cells stay strings.
+DATA_READ_OPTIONS: dict[str, Any] = {
+    "value_render_option": ValueRenderOption.unformatted,
+    "date_time_render_option": DateTimeOption.serial_number,
+}
+SHEETS_EPOCH_ORDINAL = date(1899, 12, 30).toordinal()  # serial day 0
+PAGE_ROWS = 10000  # rows per request when the whole table is read
+
+
+def _utcnow() -> datetime:
+    # google-auth keeps credential expiry as a naive UTC datetime
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def credentials_from_inline_json(inline_json: str) -> Credentials:
     info: dict[str, Any] = json.loads(inline_json)
-    creds = Credentials.from_service_account_info(
-        info, scopes=["https://www.googleapis.com/auth/spreadsheets"]
-    )
-    return gspread.authorize(creds)
+    return Credentials.from_service_account_info(info, scopes=SCOPES)
+
+
+class SheetsSession:
+    """
+    Long-lived Google Sheets session of one spreadsheet (one per tenant).
+
+    Holds one authorized gspread client together with the opened spreadsheet
+    and worksheet handles, so regular operations only pay for the request that
+    does the actual work. The access token is refreshed ahead of its expiry and
+    the underlying requests session keeps HTTP connections alive.
+
+    `saved_requests` counts upstream requests avoided compared to building a
+    fresh client per operation (token fetch, open_by_key, worksheet lookups).
+
+    API requests are throttled to the per-minute quota, idempotent reads are
+    retried on 429/5xx and repeated failures open `breaker` (see resilience).
+    Sessions of different tenants share one `bucket`: the quota belongs to
+    the service account, not to the spreadsheet.
+
+    `credentials` and `http_session` replace the service account and the
+    authorized requests session, e.g. to talk to benchmarks.sheets_emulator.
+    """
+
+    def __init__(
+        self,
+        service_account_json: str,
+        spreadsheet_id: str,
+        token_refresh_margin_seconds: int = 300,
+        http_pool_size: int = 10,
+        http_timeout_seconds: float | None = None,
+        first_row_ttl_seconds: float = 3600,
+        requests_per_minute: float = 60,
+        request_burst: int = 10,
+        read_attempts: int = 4,
+        breaker_failures: int = 5,
+        breaker_reset_seconds: float = 30,
+        bucket: TokenBucket | None = None,
+        data_worksheet_name: str = "data",
+        service_worksheet_name: str = "service",
+        credentials: Credentials | None = None,
+        http_session: requests.Session | None = None,
+    ) -> None:
+        self.spreadsheet_id = spreadsheet_id
+        self.data_worksheet_name = data_worksheet_name
+        self.service_worksheet_name = service_worksheet_name
+        self._service_account_json = service_account_json
+        self._token_refresh_margin = timedelta(seconds=token_refresh_margin_seconds)
+        self._http_pool_size = http_pool_size
+        self._http_timeout = http_timeout_seconds
+        self._lock = threading.RLock()
+        self._credentials: Credentials | None = credentials
+        self._http_session = http_session
+        self._client: gspread.Client | None = None
+        self._spreadsheet: gspread.Spreadsheet | None = None
+        self._worksheets: dict[str, gspread.Worksheet] = {}
+        self._first_row_ttl = first_row_ttl_seconds
+        self._first_data_row: int | None = None
+        self._first_data_row_at = 0.0
+        self.saved_requests = 0
+        self.bucket = bucket or TokenBucket(requests_per_minute, request_burst)
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset_seconds)
+        self._read_attempts = read_attempts
+
+    def _ensure_client(self) -> gspread.Client:
+        if self._client is None:
+            if self._credentials is None:
+                self._credentials = credentials_from_inline_json(self._service_account_json)
+            self._client = gspread.authorize(
+                self._credentials,
+                http_client=partial(
+                    ResilientHTTPClient,
+                    bucket=self.bucket,
+                    breaker=self.breaker,
+                    read_attempts=self._read_attempts,
+                ),
+                session=self._http_session,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=self._http_pool_size, pool_maxsize=self._http_pool_size
+            )
+            self._client.http_client.session.mount("https://", adapter)
+            self._client.set_timeout(self._http_timeout)
+            logger.info("Google Sheets client authorized")
+        return self._client
+
+    def _refresh_token_if_needed(self) -> None:
+        """Refresh the access token before it expires instead of on a failed request."""
+        creds = self._credentials
+        assert creds is not None and self._client is not None
+        expiry = creds.expiry
+        if creds.token and expiry and expiry - _utcnow() > self._token_refresh_margin:
+            self.saved_requests += 1
+            return
+        creds.refresh(Request(self._client.http_client.session))
+        logger.debug("Google Sheets access token refreshed")
+
+    def spreadsheet(self) -> gspread.Spreadsheet:
+        with self._lock:
+            self._ensure_client()
+            self._refresh_token_if_needed()
+            if self._spreadsheet is None:
+                self._spreadsheet = self._client.open_by_key(self.spreadsheet_id)
+            else:
+                self.saved_requests += 1
+            return self._spreadsheet
+
+    def worksheet(self, name: str) -> gspread.Worksheet:
+        with self._lock:
+            spreadsheet = self.spreadsheet()
+            ws = self._worksheets.get(name)
+            if ws is None:
+                ws = spreadsheet.worksheet(name)
+                self._worksheets[name] = ws
+            else:
+                self.saved_requests += 1
+            return ws
+
+    def first_data_row(self, service_worksheet_name: str | None = None) -> int:
+        """
+        Index of the first data row, as stored at service!B2.
+
+        The value only changes when the sheet layout changes, so it is cached
+        for `first_row_ttl_seconds` and refreshed earlier through
+        `invalidate_first_data_row` when an operation notices it is stale.
+        """
+        with self._lock:
+            if (
+                self._first_data_row is not None
+                and time.monotonic() - self._first_data_row_at < self._first_row_ttl
+            ):
+                self.saved_requests += 1
+                return self._first_data_row
+
+            service_ws = self.worksheet(service_worksheet_name or self.service_worksheet_name)
+            first_row_str = service_ws.acell("B2").value
+            if not first_row_str:
+                raise ValueError("service!B2 is empty; cannot determine first data row")
+            try:
+                first_data_row = int(first_row_str)
+            except ValueError as exc:
+                raise ValueError(f"Invalid first data row in service!B2: {first_row_str}") from exc
+
+            self._first_data_row = first_data_row
+            self._first_data_row_at = time.monotonic()
+            return first_data_row
+
+    def invalidate_first_data_row(self) -> None:
+        with self._lock:
+            self._first_data_row = None
+
+    def reset(self) -> None:
+        """Drop cached handles, e.g. after a worksheet was renamed or deleted."""
+        with self._lock:
+            self._spreadsheet = None
+            self._worksheets.clear()
+            self._first_data_row = None
+
+
+_bucket: TokenBucket | None = None
+_bucket_lock = threading.Lock()
+
+
+def _shared_bucket() -> TokenBucket:
+    global _bucket
+    with _bucket_lock:
+        if _bucket is None:
+            _bucket = TokenBucket(
+                settings.sheets_requests_per_minute, settings.sheets_request_burst
+            )
+        return _bucket
+
+
+def get_session() -> SheetsSession:
+    """Return the current tenant's Sheets session, creating it on first use."""
+    state = current_state()
+    tenant = state.tenant
+    with state.lock:
+        if state.session is None:
+            if not settings.google_service_account_json or not tenant.spreadsheet_id:
+                raise RuntimeError("Google Sheets settings are not configured")
+            state.session = SheetsSession(
+                settings.google_service_account_json.get_secret_value(),
+                tenant.spreadsheet_id,
+                token_refresh_margin_seconds=settings.google_token_refresh_margin_seconds,
+                http_pool_size=settings.sheets_max_workers,
+                http_timeout_seconds=settings.sheets_timeout_seconds,
+                first_row_ttl_seconds=settings.sheets_first_row_ttl_seconds,
+                requests_per_minute=settings.sheets_requests_per_minute,
+                request_burst=settings.sheets_request_burst,
+                read_attempts=settings.sheets_read_attempts,
+                breaker_failures=settings.sheets_breaker_failures,
+                breaker_reset_seconds=settings.sheets_breaker_reset_seconds,
+                bucket=_shared_bucket(),
+                data_worksheet_name=tenant.worksheet_name,
+                service_worksheet_name=tenant.service_worksheet_name,
+            )
+        return state.session
+
+
+def _parse_amount(value: Any) -> float:
+    """Parse an amount cell, tolerating locale formatting like "1 200,50"."""
+    return float(str(value).replace(",", ".").replace("\xa0", "").replace(" ", ""))
+
+
+def _parse_sheet_date(value: Any) -> date | None:
+    """Parse a date cell: a serial day number, or text as DD.MM.YYYY, DD.MM.YY or YYYY-MM-DD."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            return date.fromordinal(SHEETS_EPOCH_ORDINAL + int(value))
+        except (ValueError, OverflowError):
+            return None
+    return _parse_date_text(str(value).strip())
+
+
+@lru_cache(maxsize=4096)
+def _parse_date_text(value: str) -> date | None:
+    # Cached: a sheet has a few distinct dates per month repeated on many rows.
+    try:
+        if "." in value:
+            day, month, year = (int(part) for part in value.split("."))
+            if year < 100:
+                year += 2000
+            return date(year, month, day)
+        return date.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def _is_data_row(row: list[Any]) -> bool:
+    """A data row has something in the amount column that parses as a number."""
+    if len(row) < 3:
+        return False
+    try:
+        _parse_amount(row[2])
+    except ValueError:
+        return False
+    return True
+
+
+def parse_data_row(row: list[Any]) -> Row | None:
+    """Parse a raw data row into (date, category, amount, comment), None if it is not one."""
+    if not _is_data_row(row):
+        return None
+    expense_date = _parse_sheet_date(row[0])
+    if expense_date is None:
+        return None
+    comment = str(row[3]).strip() if len(row) > 3 and row[3] else ""
+    return expense_date, str(row[1]).strip(), _parse_amount(row[2]), comment
+
+
+def parse_data_rows(values: list[list[Any]], source: str) -> list[Row | None]:
+    """
+    parse_data_row for each row, reporting the ones that get dropped.
+
+    Blank and header-like rows are expected, but a row with an amount and an
+    unreadable date would silently go missing from every total, so those
+    are counted and logged with an example.
+    """
+    parsed = [parse_data_row(row) for row in values]
+    unreadable = [
+        row for row, result in zip(values, parsed) if result is None and _is_data_row(row)
+    ]
+    if unreadable:
+        logger.warning(
+            f"{source}: skipped {len(unreadable)} rows with an unreadable date, "
+            f"e.g. {unreadable[0][0]!r}"
+        )
+    return parsed
+
+
+def read_data_rows(
+    session: SheetsSession,
+    data_ws: gspread.Worksheet,
+    count: int,
+    service_worksheet_name: str | None = None,
+) -> list[list[Any]]:
+    """
+    Read up to `count` rows starting at the first data row.
+
+    The row right above the first data row (the header) is read in the same
+    request. If it looks like data, or the first row does not, the cached
+    service!B2 pointer is stale: it is dropped and the read is repeated once.
+    """
+    for attempt in range(2):
+        first_data_row = session.first_data_row(service_worksheet_name)
+        last_row = first_data_row + count - 1
+        if first_data_row > 1:
+            values = data_ws.get(f"A{first_data_row - 1}:D{last_row}", **DATA_READ_OPTIONS)
+            header, rows = (values[0] if values else []), values[1:]
+        else:
+            header, rows = [], data_ws.get(f"A1:D{last_row}", **DATA_READ_OPTIONS)
+        if not _is_data_row(header) and (not rows or _is_data_row(rows[0])):
+            return rows
+        if attempt == 0:
+            logger.warning(
+                f"Data rows do not start at cached row {first_data_row}; re-reading service!B2"
+            )
+            session.invalidate_first_data_row()
+    logger.warning(f"Layout check failed at row {first_data_row}; using service!B2 as is")
+    return rows
+
+
+def iter_data_values(
+    data_ws: gspread.Worksheet, start: int, page_rows: int, last_column: str = "D"
+) -> Iterator[list[list[Any]]]:
+    """
+    Raw rows of the data table from row `start` down, `page_rows` per request.
+
+    Reading stops at the first page that comes back short (the Sheets API
+    leaves out trailing empty rows, so that is the end of the table) or at
+    the end of the grid, past which a read would be refused.
+    """
+    while start <= data_ws.row_count:
+        values = data_ws.get(f"A{start}:{last_column}{start + page_rows - 1}", **DATA_READ_OPTIONS)
+        yield values
+        if len(values) < page_rows:
+            return
+        start += page_rows
+
+
+def iter_data_pages(page_rows: int, source: str = "Export read") -> Iterator[list[Row]]:
+    """Every expense in the sheet, newest first, read `page_rows` rows per request."""
+    session = get_session()
+    data_ws = session.worksheet(session.data_worksheet_name)
+    for values in iter_data_values(data_ws, session.first_data_row(), page_rows):
+        rows = [row for row in parse_data_rows(values, source) if row is not None]
+        if rows:
+            yield rows
 
 
 def append_expense(
     expense: Dict[str, Any],
-    data_worksheet_name: str = "data",
-    service_worksheet_name: str = "service",
+    data_worksheet_name: str | None = None,
+    service_worksheet_name: str | None = None,
 ) -> None:
     """
     Insert a new expense row at the top of the data table.
@@ -32,74 +385,146 @@ def append_expense(
     The service sheet stores the index of the first data row at B2.
     We insert a new row at that index so it becomes the new first data row.
     """
-    if not settings.google_service_account_json or not settings.google_spreadsheet_id:
-        raise RuntimeError("Google Sheets settings are not configured")
+    append_expenses([expense], data_worksheet_name, service_worksheet_name)
+
+
+def append_expenses(
+    expenses: list[Dict[str, Any]],
+    data_worksheet_name: str | None = None,
+    service_worksheet_name: str | None = None,
+) -> None:
+    """
+    Insert several expenses at the top of the data table in one request.
+
+    Expenses are given oldest first; the last one ends up as the first data
+    row, exactly as if they had been appended one by one.
+    """
+    if not expenses:
+        return
 
-    client = client_from_inline_json(settings.google_service_account_json.get_secret_value())
-    sh = client.open_by_key(settings.google_spreadsheet_id)
-    data_ws = sh.worksheet(data_worksheet_name)
-    service_ws = sh.worksheet(service_worksheet_name)
+    session = get_session()
+    data_ws = session.worksheet(data_worksheet_name or session.data_worksheet_name)
+    first_data_row = session.first_data_row(service_worksheet_name)
 
-    first_row_str = service_ws.acell("B2").value
-    if not first_row_str:
-        raise ValueError("service!B2 is empty; cannot determine first data row")
+    rows = [
+        [
+            expense["date"],
+            expense["category"],
+            expense["amount"],
+            expense["comment"],
+        ]
+        for expense in reversed(expenses)
+    ]
     try:
-        first_data_row = int(first_row_str)
-    except ValueError as exc:
-        raise ValueError(f"Invalid first data row in service!B2: {first_row_str}") from exc
-
-    row = [
-        expense["date"],
-        expense["category"],
-        expense["amount"],
-        expense["comment"],
+        data_ws.insert_rows(rows, row=first_data_row, value_input_option="USER_ENTERED")
+    except gspread.exceptions.APIError:
+        # A stale pointer can point past the end of the sheet; re-read it and
+        # retry once if the layout really moved.
+        session.invalidate_first_data_row()
+        fresh_first_data_row = session.first_data_row(service_worksheet_name)
+        if fresh_first_data_row == first_data_row:
+            raise
+        data_ws.insert_rows(rows, row=fresh_first_data_row, value_input_option="USER_ENTERED")
+
+    store = get_store()
+    touched_months = set()
+    for expense in expenses:
+        expense_date = date.fromisoformat(expense["date"])
+        get_month_index().note_insert(expense_date)
+        touched_months.add((expense_date.year, expense_date.month))
+        try:
+            store.add(
+                expense_date,
+                expense["category"],
+                float(expense["amount"]),
+                expense["comment"],
+            )
+        except Exception as exc:
+            # The sheet has the row; the next reconciliation brings the store back in line.
+            logger.warning(f"Failed to write expense through to the local store: {exc}")
+    stats_cache = get_stats_cache()
+    for year, month in touched_months:
+        stats_cache.invalidate(year, month)
+
+
+def expenses_at_top(
+    expenses: list[Dict[str, Any]],
+    data_worksheet_name: str | None = None,
+    service_worksheet_name: str | None = None,
+) -> bool:
+    """
+    Whether `expenses` (oldest first) are exactly the newest rows of the sheet.
+
+    Tells whether an insert that failed ambiguously, e.g. timed out, was
+    applied after all, so retrying it would duplicate the rows.
+    """
+    session = get_session()
+    values = read_data_rows(
+        session,
+        session.worksheet(data_worksheet_name or session.data_worksheet_name),
+        len(expenses),
+        service_worksheet_name,
+    )
+    expected = [
+        (
+            date.fromisoformat(expense["date"]),
+            expense["category"],
+            float(expense["amount"]),
+            expense["comment"],
+        )
+        for expense in reversed(expenses)
     ]
-    data_ws.insert_row(row, index=first_data_row, value_input_option="USER_ENTERED")
+    return [parse_data_row(row) for row in values] == expected
+
+
+def refresh_from_store() -> None:
+    """Pick up store writes made by another process and drop the stats they made stale."""
+    changed = get_store().refresh()
+    stats_cache = get_stats_cache()
+    if changed is None:
+        stats_cache.clear()
+        return
+    for year, month in changed:
+        stats_cache.invalidate(year, month)
+
+
+def data_version() -> int | None:
+    """
+    Version of the expense data, changing whenever any expense changes.
+
+    None until the local store has been synced: reads then go to Google
+    Sheets directly and edits made there cannot be noticed.
+    """
+    refresh_from_store()
+    store = get_store()
+    return store.data_version() if store.is_synced() else None
 
 
 def get_recent_expenses(limit: int = 9) -> list[dict[str, Any]]:
-    """Get recent expenses from the data sheet."""
-    if not settings.google_service_account_json or not settings.google_spreadsheet_id:
-        raise RuntimeError("Google Sheets settings are not configured")
-
-    client = client_from_inline_json(settings.google_service_account_json.get_secret_value())
-    sh = client.open_by_key(settings.google_spreadsheet_id)
-    data_ws = sh.worksheet("data")
-    service_ws = sh.worksheet("service")
-
-    # Get the first data row from service sheet
-    first_row_str = service_ws.acell("B2").value
-    if not first_row_str:
-        raise ValueError("service!B2 is empty; cannot determine first data row")
-    try:
-        first_data_row = int(first_row_str)
-    except ValueError as exc:
-        raise ValueError(f"Invalid first data row in service!B2: {first_row_str}") from exc
-
-    # Get data from first_data_row to first_data_row + limit
-    end_row = first_data_row + limit - 1
-    range_name = f"A{first_data_row}:D{end_row}"
-    
+    """Get recent expenses, from the local store once it is synced."""
+    refresh_from_store()
+    store = get_store()
+    if store.is_synced():
+        return store.recent(limit)
+
+    session = get_session()
+    data_ws = session.worksheet(session.data_worksheet_name)
+
     try:
-        values = data_ws.get(range_name)
-        expenses = []
-        for row in values:
-            date = str(row[0]).strip() if row[0] else ""
-            category = str(row[1]).strip() if row[1] else ""
-            amount = str(row[2]).strip() if row[2] else ""
-            comment = str(row[3]).strip() if len(row) > 3 and row[3] else ""
-
-            expenses.append(
-                {
-                    "date": date,
-                    "category": category,
-                    "amount": amount,
-                    "comment": comment,
-                }
-            )
-        return expenses
+        values = read_data_rows(session, data_ws, limit)
     except Exception as exc:
         raise ValueError(f"Failed to get recent expenses: {exc}") from exc
+    return [
+        {
+            "date": display_date(expense_date.isoformat()),
+            "category": category,
+            "amount": f"{amount:g}",
+            "comment": comment,
+        }
+        for expense_date, category, amount, comment in filter(
+            None, parse_data_rows(values, "Recent expenses")
+        )
+    ]
 
 
 def get_current_month_expenses() -> list[dict[str, Any]]:
@@ -109,70 +534,131 @@ def get_current_month_expenses() -> list[dict[str, Any]]:
 
 
 def get_month_expenses(target_year: int, target_month: int) -> list[dict[str, Any]]:
-    """Get all expenses for a specific month from the data sheet."""
+    """Get all expenses for a specific month, from the local store once it is synced."""
     if target_month < 1 or target_month > 12:
         raise ValueError("Month must be between 1 and 12")
 
-    if not settings.google_service_account_json or not settings.google_spreadsheet_id:
-        raise RuntimeError("Google Sheets settings are not configured")
+    refresh_from_store()
+    store = get_store()
+    if store.is_synced():
+        return store.month(target_year, target_month)
+
+    return [
+        {
+            "date": display_date(expense_date.isoformat()),
+            "category": category,
+            "amount": amount,
+            "comment": comment,
+        }
+        for expense_date, category, amount, comment in _read_month_rows(target_year, target_month)
+    ]
 
-    client = client_from_inline_json(settings.google_service_account_json.get_secret_value())
-    sh = client.open_by_key(settings.google_spreadsheet_id)
-    data_ws = sh.worksheet("data")
-    service_ws = sh.worksheet("service")
 
-    # Get the first data row from service sheet
-    first_row_str = service_ws.acell("B2").value
-    if not first_row_str:
-        raise ValueError("service!B2 is empty; cannot determine first data row")
-    try:
-        first_data_row = int(first_row_str)
-    except ValueError as exc:
-        raise ValueError(f"Invalid first data row in service!B2: {first_row_str}") from exc
-
-    # Get all data from first_data_row to the end (assuming max 10000 rows)
-    end_row = first_data_row + 10000
-    range_name = f"A{first_data_row}:D{end_row}"
-    
+def get_month_stats(target_year: int, target_month: int) -> MonthStats:
+    """Totals of a month: precomputed by the local store, or aggregated from the sheet."""
+    if target_month < 1 or target_month > 12:
+        raise ValueError("Month must be between 1 and 12")
+
+    refresh_from_store()
+    store = get_store()
+    if store.is_synced():
+        with span("store.month_stats"):
+            return store.month_stats(target_year, target_month)
+
+    rows = _read_month_rows(target_year, target_month)
+    with span("aggregate"):
+        return ExpenseColumns.from_rows(rows).month_stats(target_year, target_month)
+
+
+def _read_month_rows(target_year: int, target_month: int) -> list[Row]:
+    """Every expense of a month, read through the month index."""
+    session = get_session()
+    data_ws = session.worksheet(session.data_worksheet_name)
+    month_index = get_month_index()
+
     try:
-        values = data_ws.get(range_name)
-        expenses = []
-        for row in values:
-            if not row or len(row) < 3:
+        for attempt in range(2):
+            if not month_index.is_built():
+                _build_month_index(session, data_ws)
+            first_data_row = session.first_data_row()
+            located = month_index.locate(target_year, target_month, first_data_row)
+            if located is None:  # invalidated by a concurrent read that found it shifted
                 continue
-                
-            date_str = str(row[0]).strip() if row[0] else ""
-            category = str(row[1]).strip() if row[1] else ""
-            amount_str = str(row[2]).strip() if row[2] else ""
-            comment = str(row[3]).strip() if len(row) > 3 and row[3] else ""
+            row_ranges, tail_row = located
+            ranges = [f"A{start}:D{end}" for start, end in row_ranges]
+            # The oldest indexed row must still be the last one, otherwise rows
+            # were added or removed behind our back and the index is shifted.
+            *slices, tail = data_ws.batch_get(
+                ranges + [f"A{tail_row}:D{tail_row + 1}"], **DATA_READ_OPTIONS
+            )
 
-            # Parse date in format "DD.MM.YYYY"
-            try:
-                if "." in date_str:
-                    parts = date_str.split(".")
-                    if len(parts) == 3:
-                        day, month, year = int(parts[0]), int(parts[1]), int(parts[2])
-                        # Handle two-digit years
-                        if year < 100:
-                            year += 2000
-                        
-                        # Filter by requested month and year
-                        if month == target_month and year == target_year:
-                            try:
-                                amount = float(amount_str)
-                                expenses.append(
-                                    {
-                                        "date": date_str,
-                                        "category": category,
-                                        "amount": amount,
-                                        "comment": comment,
-                                    }
-                                )
-                            except (ValueError, TypeError):
-                                continue
-            except (ValueError, IndexError):
-                continue
-                
-        return expenses
+            rows = [
+                row
+                for row in parse_data_rows([row for rows in slices for row in rows], "Month read")
+                if row is not None
+            ]
+            shifted = len(tail) != 1 or any(
+                (row[0].year, row[0].month) != (target_year, target_month) for row in rows
+            )
+            if not shifted:
+                return rows
+            logger.info("Month index is out of date; rebuilding")
+            month_index.invalidate()
+        # The sheet keeps changing under the index: read the whole table instead.
+        logger.warning("Month index is still out of date; reading the month from every row")
+        return [
+            row
+            for page in iter_data_pages(PAGE_ROWS, "Month read")
+            for row in page
+            if (row[0].year, row[0].month) == (target_year, target_month)
+        ]
     except Exception as exc:
         raise ValueError(f"Failed to get month expenses: {exc}") from exc
+
+
+def get_range_totals(
+    end_year: int, end_month: int, months: int
+) -> dict[tuple[int, int], dict[str, float]]:
+    """
+    Per-category totals for each of `months` months ending with the given one.
+
+    Read from the store's running totals, or aggregated column-wise from a
+    paged read of the whole sheet until the store is synced. Every month of the
+    span is present in the result, empty ones included.
+    """
+    if end_month < 1 or end_month > 12:
+        raise ValueError("Month must be between 1 and 12")
+    if months < 1:
+        raise ValueError("Range must cover at least one month")
+
+    first_index = end_year * 12 + end_month - 1 - (months - 1)
+    keys = [(i // 12, i % 12 + 1) for i in range(first_index, first_index + months)]
+
+    refresh_from_store()
+    store = get_store()
+    if store.is_synced():
+        return store.totals.category_totals(keys)
+
+    span = set(keys)
+    try:
+        columns = ExpenseColumns.from_rows(
+            row
+            for page in iter_data_pages(PAGE_ROWS, "Range read")
+            for row in page
+            if (row[0].year, row[0].month) in span
+        )
+    except Exception as exc:
+        raise ValueError(f"Failed to get expenses: {exc}") from exc
+    return columns.month_category_totals(keys)
+
+
+def _build_month_index(
+    session: SheetsSession, data_ws: gspread.Worksheet, page_rows: int = PAGE_ROWS
+) -> None:
+    """Build the month index from the date column only, `page_rows` rows per request."""
+    values = [
+        row
+        for page in iter_data_values(data_ws, session.first_data_row(), page_rows, "A")
+        for row in page
+    ]
+    get_month_index().build([_parse_sheet_date(row[0]) if row else None for row in values])
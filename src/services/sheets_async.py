@@ -0,0 +1,252 @@
+"""Non-blocking facade over the synchronous Google Sheets service.
+
+gspread is blocking, and the bot and the Mini App share one event loop, so
+every Sheets call is pushed to a small dedicated thread pool. A semaphore caps
+the number of calls in flight (queued or running) and each call gets a
+timeout, so a slow Google response never stalls polling or other requests.
+
+With several tenants each one may only hold a few of those slots, so one
+tenant with a burst of requests queues behind itself rather than in front of
+everyone else. Calls run in the worker thread for the caller's tenant.
+
+Reads the local store can answer (once it is synced) run on a second small
+pool instead, so they never wait behind slow Google calls.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Dict, TypeVar
+
+from loguru import logger
+
+from src.config import settings
+from src.services import export, sheets, sync
+from src.services.metrics import gauge, sheets_call_seconds
+from src.services.tracing import in_span, span
+from src.services.stats import MonthStats
+from src.services.tenants import (
+    active_tenants,
+    carry_context,
+    current_tenant,
+    get_registry,
+    get_stats_cache,
+    get_store,
+    tenant_pool,
+    use_tenant,
+)
+
+T = TypeVar("T")
+
+_executor = ThreadPoolExecutor(max_workers=settings.sheets_max_workers, thread_name_prefix="sheets")
+_store_executor = ThreadPoolExecutor(
+    max_workers=settings.store_max_workers, thread_name_prefix="store"
+)
+_semaphore = asyncio.Semaphore(settings.sheets_max_concurrency)
+_tenant_semaphores: dict[str, asyncio.Semaphore] = {}
+_in_flight = 0  # calls holding a slot, until their worker thread finishes
+
+gauge(
+    "financier_sheets_calls_in_flight",
+    "Sheets calls queued in or running on the worker pool",
+    lambda: _in_flight,
+)
+
+
+class QueueTimeoutError(TimeoutError):
+    """A Sheets call timed out waiting for a slot in the pool, so it never started."""
+
+
+def _tenant_semaphore() -> asyncio.Semaphore | None:
+    """The current tenant's share of the pool; None when the process serves one tenant."""
+    state = current_tenant.get()
+    if state is None or len(get_registry()) < 2:
+        return None
+    semaphore = _tenant_semaphores.get(state.tenant.id)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(settings.sheets_tenant_max_concurrency)
+        _tenant_semaphores[state.tenant.id] = semaphore
+    return semaphore
+
+
+def _release_slots(tenant_semaphore: asyncio.Semaphore | None) -> None:
+    global _in_flight
+    _in_flight -= 1
+    _semaphore.release()
+    if tenant_semaphore is not None:
+        tenant_semaphore.release()
+
+
+def _release(future: asyncio.Future, tenant_semaphore: asyncio.Semaphore | None) -> None:
+    _release_slots(tenant_semaphore)
+    # The caller may have timed out and stopped waiting; consume the outcome
+    # so asyncio does not log "exception was never retrieved".
+    if not future.cancelled():
+        future.exception()
+
+
+async def _submit(call: Callable[[], T], submitted: asyncio.Event) -> T:
+    tenant_semaphore = _tenant_semaphore()
+    if tenant_semaphore is not None:
+        await tenant_semaphore.acquire()
+    try:
+        await _semaphore.acquire()
+    except BaseException:
+        if tenant_semaphore is not None:
+            tenant_semaphore.release()
+        raise
+    global _in_flight
+    _in_flight += 1
+    try:
+        future = asyncio.get_running_loop().run_in_executor(_executor, carry_context(call))
+    except BaseException:
+        _release_slots(tenant_semaphore)
+        raise
+    submitted.set()  # from here on the call runs even if the caller stops waiting
+    # The slots are held until the worker thread actually finishes, even if the
+    # awaiting handler gives up earlier, so the caps reflect real load.
+    future.add_done_callback(partial(_release, tenant_semaphore=tenant_semaphore))
+    return await asyncio.shield(future)
+
+
+async def run_sheets_call(
+    func: Callable[..., T], *args: Any, timeout: float | None = None, **kwargs: Any
+) -> T:
+    """Run a blocking Sheets function in the pool with a concurrency cap and timeout."""
+    if timeout is None:
+        timeout = settings.sheets_timeout_seconds
+    call = in_span("worker", partial(func, *args, **kwargs))  # the rest is the wait for a slot
+    submitted = asyncio.Event()
+    try:
+        with sheets_call_seconds.time(call=func.__name__), span(f"sheets.{func.__name__}"):
+            return await asyncio.wait_for(_submit(call, submitted), timeout)
+    except TimeoutError as exc:
+        message = f"Google Sheets call {func.__name__} timed out after {timeout:g}s"
+        if not submitted.is_set():
+            raise QueueTimeoutError(f"{message} waiting for a worker") from exc
+        raise TimeoutError(message) from exc
+
+
+async def run_store_call(func: Callable[..., T], *args: Any) -> T:
+    """Run a local store function in the store pool, for the caller's tenant."""
+    call = in_span("worker", partial(func, *args))
+    with span(f"store.{func.__name__}"):
+        return await asyncio.get_running_loop().run_in_executor(
+            _store_executor, carry_context(call)
+        )
+
+
+def _store_is_synced() -> bool:
+    """Open the store if needed and catch up with other processes' writes."""
+    sheets.refresh_from_store()
+    return get_store().is_synced()
+
+
+async def _read(func: Callable[..., T], *args: Any) -> T:
+    """Run a read in the store pool when the store answers it, else as a Sheets call."""
+    if await run_store_call(_store_is_synced):
+        return await run_store_call(func, *args)
+    return await run_sheets_call(func, *args)
+
+
+async def append_expense(expense: Dict[str, Any]) -> None:
+    await run_sheets_call(sheets.append_expense, expense)
+
+
+async def append_expenses(expenses: list[Dict[str, Any]]) -> None:
+    await run_sheets_call(sheets.append_expenses, expenses)
+
+
+async def expenses_at_top(expenses: list[Dict[str, Any]]) -> bool:
+    return await run_sheets_call(sheets.expenses_at_top, expenses)
+
+
+async def get_recent_expenses(limit: int = 9) -> list[dict[str, Any]]:
+    return await _read(sheets.get_recent_expenses, limit)
+
+
+async def get_current_month_expenses() -> list[dict[str, Any]]:
+    return await _read(sheets.get_current_month_expenses)
+
+
+async def get_month_expenses(target_year: int, target_month: int) -> list[dict[str, Any]]:
+    return await _read(sheets.get_month_expenses, target_year, target_month)
+
+
+async def get_range_totals(
+    end_year: int, end_month: int, months: int
+) -> dict[tuple[int, int], dict[str, float]]:
+    return await _read(sheets.get_range_totals, end_year, end_month, months)
+
+
+async def data_version() -> int | None:
+    return await run_store_call(sheets.data_version)
+
+
+async def get_month_stats(target_year: int, target_month: int) -> MonthStats:
+    """Totals of a month, served from the stats cache when possible."""
+    # Opening or reloading the store reads whole tables: not on the event loop.
+    synced = await run_store_call(_store_is_synced)
+    stats_cache = get_stats_cache()
+    cached = stats_cache.get(target_year, target_month)
+    if cached is not None:
+        return cached
+
+    version = stats_cache.version(target_year, target_month)
+    if synced:
+        stats = await run_store_call(sheets.get_month_stats, target_year, target_month)
+    else:
+        stats = await run_sheets_call(sheets.get_month_stats, target_year, target_month)
+    stats_cache.put(stats, version)
+    return stats
+
+
+async def stream_export(
+    export_format: str, export_query: export.ExportQuery
+) -> AsyncIterator[bytes]:
+    """
+    The caller's tenant's expenses, encoded and streamed chunk by chunk.
+
+    Every chunk is read and encoded by a worker call of its own, so a long
+    export takes one slot at a time and queues fairly with other calls.
+    The stream may be consumed by another task (a streaming response), so
+    the tenant is pinned here and selected around each call rather than
+    through use_tenant.
+    """
+    state = current_tenant.get()
+    if state is not None:
+        tenant_pool.pin(state)
+    chunks = export.encode(export_format, export_query)
+    try:
+        while True:
+            token = current_tenant.set(state)
+            try:
+                chunk = await run_sheets_call(export.read_chunk, chunks)
+            finally:
+                current_tenant.reset(token)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        if not chunks.gi_running:  # a timed-out call may still be running it in a worker
+            chunks.close()
+        if state is not None:
+            tenant_pool.release(state)
+
+
+async def keep_store_in_sync(interval_seconds: float) -> None:
+    """Background task reconciling the local stores of active tenants with their sheets."""
+    while True:
+        for tenant in active_tenants():
+            with use_tenant(tenant):
+                try:
+                    synced = await run_sheets_call(
+                        sync.sync_store, timeout=max(60.0, interval_seconds)
+                    )
+                    if synced >= 0:
+                        logger.debug(f"Local store of {tenant.id} synced: {synced} rows")
+                except Exception as e:
+                    logger.warning(f"Local store sync of {tenant.id} failed: {e}")
+        await asyncio.sleep(interval_seconds)
@@ -0,0 +1,211 @@
+"""Per-month expense statistics: running totals and their in-memory cache."""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Iterable
+
+from src.config import settings
+from src.services.metrics import cache_lookups
+
+
+@dataclass(frozen=True, slots=True)
+class MonthStats:
+    year: int
+    month: int
+    categories: list[tuple[str, float]]  # sorted by subtotal, largest first
+    total: float
+    count: int  # number of expenses
+    days: int  # distinct dates with at least one expense
+
+    @property
+    def per_day(self) -> float:
+        return self.total / self.days if self.days else 0.0
+
+
+@dataclass(frozen=True, slots=True)
+class ExpenseRecord:
+    """Compact form of an expense as far as totals are concerned."""
+
+    day: int  # date.toordinal()
+    category_id: int
+    amount: float
+
+
+@dataclass(slots=True)
+class MonthTotals:
+    total: float = 0.0
+    by_category: dict[int, float] = field(default_factory=dict)
+    rows_per_day: dict[int, int] = field(default_factory=dict)
+
+
+class ExpenseTotals:
+    """
+    Running per-month and per-category totals.
+
+    Category names are interned to small ids. Adding an expense is O(1);
+    reading a month only sorts its categories, so neither the bot nor the
+    Mini App walks the month's expenses again.
+    """
+
+    def __init__(self) -> None:
+        self._category_ids: dict[str, int] = {}
+        self._category_names: list[str] = []
+        self._months: dict[tuple[int, int], MonthTotals] = {}
+        self._lock = threading.Lock()
+
+    def _record(self, expense_date: date, category: str, amount: float) -> ExpenseRecord:
+        category_id = self._category_ids.get(category)
+        if category_id is None:
+            category_id = self._category_ids[category] = len(self._category_names)
+            self._category_names.append(category)
+        return ExpenseRecord(expense_date.toordinal(), category_id, amount)
+
+    def add(self, expense_date: date, category: str, amount: float) -> None:
+        self.replace((), [(expense_date, category, amount, "")])
+
+    def add_rows(self, rows: Iterable[tuple[date, str, float, str]]) -> None:
+        """Add (date, category, amount, comment) rows."""
+        self.replace((), rows)
+
+    def _add(self, year: int, month: int, record: ExpenseRecord) -> None:
+        totals = self._months.get((year, month))
+        if totals is None:
+            totals = self._months[(year, month)] = MonthTotals()
+        totals.total += record.amount
+        totals.rows_per_day[record.day] = totals.rows_per_day.get(record.day, 0) + 1
+        if self._category_names[record.category_id]:
+            by_category = totals.by_category
+            by_category[record.category_id] = (
+                by_category.get(record.category_id, 0.0) + record.amount
+            )
+
+    def replace(
+        self, months: Iterable[tuple[int, int]], rows: Iterable[tuple[date, str, float, str]]
+    ) -> None:
+        """Recompute the given (year, month) pairs from `rows`, all of them in those months."""
+        with self._lock:
+            for key in months:
+                self._months.pop(key, None)
+            for expense_date, category, amount, _ in rows:
+                self._add(
+                    expense_date.year,
+                    expense_date.month,
+                    self._record(expense_date, category, amount),
+                )
+
+    def months(self) -> set[tuple[int, int]]:
+        with self._lock:
+            return set(self._months)
+
+    def month(self, year: int, month: int) -> MonthStats:
+        with self._lock:
+            totals = self._months.get((year, month)) or MonthTotals()
+            categories = [
+                (self._category_names[category_id], amount)
+                for category_id, amount in totals.by_category.items()
+            ]
+            count = sum(totals.rows_per_day.values())
+            days = len(totals.rows_per_day)
+            total = totals.total
+        categories.sort(key=lambda x: x[1], reverse=True)
+        return MonthStats(year, month, categories, total, count, days)
+
+    def category_totals(
+        self, months: Iterable[tuple[int, int]]
+    ) -> dict[tuple[int, int], dict[str, float]]:
+        """Per-category totals of every given month, empty ones included."""
+        with self._lock:
+            result = {}
+            for key in months:
+                totals = self._months.get(key)
+                result[key] = (
+                    {
+                        self._category_names[category_id]: amount
+                        for category_id, amount in totals.by_category.items()
+                    }
+                    if totals is not None
+                    else {}
+                )
+            return result
+
+
+class MonthStatsCache:
+    """
+    LRU cache of MonthStats keyed by (year, month).
+
+    Entries for the current (or a future) month expire quickly, past months
+    are kept much longer since they rarely change. Writes invalidate exactly
+    the month they touch; every invalidation bumps a per-month version so a
+    computation that started before it cannot store an outdated result.
+    """
+
+    def __init__(self, max_entries: int, current_ttl_seconds: float, past_ttl_seconds: float):
+        self.max_entries = max_entries
+        self.current_ttl = current_ttl_seconds
+        self.past_ttl = past_ttl_seconds
+        self._entries: OrderedDict[tuple[int, int], tuple[float, MonthStats]] = OrderedDict()
+        self._versions: dict[tuple[int, int], int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _ttl(self, key: tuple[int, int]) -> float:
+        now = datetime.now()
+        return self.current_ttl if key >= (now.year, now.month) else self.past_ttl
+
+    def version(self, year: int, month: int) -> int:
+        with self._lock:
+            return self._versions[(year, month)]
+
+    def get(self, year: int, month: int) -> MonthStats | None:
+        key = (year, month)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[0]:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                cache_lookups.inc(cache="month_stats", result="hit")
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            cache_lookups.inc(cache="month_stats", result="miss")
+            return None
+
+    def put(self, stats: MonthStats, version: int) -> None:
+        key = (stats.year, stats.month)
+        with self._lock:
+            if self._versions[key] != version:
+                return
+            self._entries[key] = (time.monotonic() + self._ttl(key), stats)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, year: int, month: int) -> None:
+        key = (year, month)
+        with self._lock:
+            self._versions[key] += 1
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in set(self._versions) | set(self._entries):
+                self._versions[key] += 1
+            self._entries.clear()
+
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+month_stats_cache = MonthStatsCache(
+    max_entries=settings.stats_cache_max_months,
+    current_ttl_seconds=settings.stats_cache_current_month_ttl_seconds,
+    past_ttl_seconds=settings.stats_cache_past_month_ttl_seconds,
+)
@@ -0,0 +1,446 @@
+"""Local SQLite mirror of the expenses worksheet.
+
+Google Sheets stays the source of truth. The store is written through on
+every append and periodically reconciled with the sheet, so reads for
+/recent, /stats and the Mini App are answered by indexed local queries.
+
+The file can be shared by several processes (the bot and the `financier-web`
+workers). Every write logs the months it changed; the other processes pick
+those up with `refresh()`.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import sys
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+from loguru import logger
+
+from src.config import settings
+from src.services.stats import ExpenseTotals, MonthStats
+
+DEFAULT_DATABASE_URL = "sqlite:///financier.sqlite3"
+
+Row = tuple[date, str, float, str]  # date, category, amount, comment
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS expenses (
+    seq INTEGER PRIMARY KEY,  -- insertion order, the newest row has the largest seq
+    date TEXT NOT NULL,       -- ISO YYYY-MM-DD
+    category TEXT NOT NULL,
+    amount REAL NOT NULL,
+    comment TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS ix_expenses_date ON expenses (date);
+CREATE INDEX IF NOT EXISTS ix_expenses_category ON expenses (category, date);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('data_version', '0');
+CREATE TABLE IF NOT EXISTS changes (
+    version INTEGER NOT NULL,  -- data_version the write produced
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    PRIMARY KEY (version, year, month)
+);
+"""
+
+CHANGE_LOG_VERSIONS = 1000  # how far back other processes can catch up month by month
+
+
+def sqlite_path_from_url(url: str) -> str:
+    """Translate `sqlite:///relative.db`, `sqlite:////abs.db` or `sqlite://:memory:`."""
+    prefix = "sqlite://"
+    if not url.startswith(prefix):
+        raise ValueError(f"Unsupported database URL: {url.split(':', 1)[0]}:// (only sqlite)")
+    path = url[len(prefix) :]
+    if path in ("", ":memory:", "/:memory:"):
+        return ":memory:"
+    return path[1:] if path.startswith("/") else path
+
+
+@dataclass(frozen=True)
+class SyncState:
+    """What the last sync saw in the sheet, used to fetch only what changed."""
+
+    sheet_rows: int  # rows from the first data row to the oldest one, incl. unparseable
+    tail_digest: str  # digest of the raw oldest row
+    full_synced_at: float
+
+
+def display_date(iso_date: str) -> str:
+    """ISO date as the spreadsheet renders it (DD.MM.YYYY)."""
+    year, month, day = iso_date.split("-")
+    return f"{day}.{month}.{year}"
+
+
+class ExpenseStore:
+    def __init__(self, path: str) -> None:
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        # Bumped on every local write; a reconciliation that raced with a
+        # write-through append is discarded instead of dropping that row.
+        self.generation = 0
+        self._data_version = int(self._get_meta("data_version"))
+        self._synced = self._get_meta("synced_at") is not None
+        # Kept up to date with every write, so stats never rescan the rows.
+        self.totals = ExpenseTotals()
+        self.totals.add_rows(self._rows_between(None, None))
+        # Only used to notice commits made by other processes: PRAGMA
+        # data_version changes when any other connection commits to the file.
+        self._watch_lock = threading.Lock()
+        self._watch_conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._seen_commits = self._commit_counter()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+        with self._watch_lock:
+            self._watch_conn.close()
+
+    def _get_meta(self, key: str) -> str | None:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str) -> None:
+        self._conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+    def _rows_between(self, start: date | None, end: date | None) -> Iterable[Row]:
+        query = "SELECT date, category, amount, comment FROM expenses"
+        params: tuple[str, ...] = ()
+        if start is not None and end is not None:
+            query += " WHERE date >= ? AND date < ?"
+            params = (start.isoformat(), end.isoformat())
+        for d, category, amount, comment in self._conn.execute(query + " ORDER BY seq", params):
+            yield date.fromisoformat(d), category, amount, comment
+
+    def is_synced(self) -> bool:
+        """True once the store has been loaded from the sheet at least once."""
+        return self._synced
+
+    def synced_at(self) -> float | None:
+        with self._lock:
+            value = self._get_meta("synced_at")
+        return float(value) if value is not None else None
+
+    def data_version(self) -> int:
+        """Counter bumped whenever the mirrored data actually changes; persisted."""
+        # Read without the lock: callers on the event loop must not wait for a sync.
+        return self._data_version
+
+    def _bump_data_version(self, months: Iterable[tuple[int, int]]) -> None:
+        """Bump the version and log the changed months, inside the write's transaction."""
+        self._conn.execute(
+            "UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'data_version'"
+        )
+        version = int(self._get_meta("data_version"))
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO changes (version, year, month) VALUES (?, ?, ?)",
+            [(version, year, month) for year, month in months],
+        )
+        self._conn.execute(
+            "DELETE FROM changes WHERE version <= ?", (version - CHANGE_LOG_VERSIONS,)
+        )
+        self._data_version = version
+
+    def _commit_counter(self) -> int:
+        return self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def refresh(self) -> set[tuple[int, int]] | None:
+        """
+        Catch up with writes committed by other processes sharing the file.
+
+        Returns the (year, month) pairs they changed (empty if none), or None
+        if the change log no longer reaches back far enough and everything
+        was reloaded. Cheap when nothing changed: one PRAGMA, no table reads.
+        """
+        with self._watch_lock:
+            commits = self._commit_counter()
+            if commits == self._seen_commits:
+                return set()
+            # Callers on the event loop must not wait for a local write; the
+            # commit is picked up on a later call.
+            if not self._lock.acquire(blocking=False):
+                return set()
+            self._seen_commits = commits
+        try:
+            self._synced = self._get_meta("synced_at") is not None
+            version = int(self._get_meta("data_version"))
+            if version <= self._data_version:
+                return set()
+            logged = self._conn.execute(
+                "SELECT version, year, month FROM changes WHERE version > ?",
+                (self._data_version,),
+            ).fetchall()
+            if {v for v, _, _ in logged} != set(range(self._data_version + 1, version + 1)):
+                changed = None
+                self.totals.replace(self.totals.months(), self._rows_between(None, None))
+            else:
+                changed = {(year, month) for _, year, month in logged}
+                self._reload_totals(changed)
+            self._data_version = version
+            self.generation += 1
+        finally:
+            self._lock.release()
+        return changed
+
+    def _reload_totals(self, months: set[tuple[int, int]]) -> None:
+        self.totals.replace(
+            months,
+            (
+                row
+                for year, month in months
+                for row in self._rows_between(
+                    date(year, month, 1), date(year + month // 12, month % 12 + 1, 1)
+                )
+            ),
+        )
+
+    def sync_state(self) -> SyncState | None:
+        with self._lock:
+            sheet_rows = self._get_meta("sheet_rows")
+            tail_digest = self._get_meta("tail_digest")
+            full_synced_at = self._get_meta("full_synced_at")
+        if sheet_rows is None or tail_digest is None or full_synced_at is None:
+            return None
+        return SyncState(int(sheet_rows), tail_digest, float(full_synced_at))
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM expenses").fetchone()[0]
+
+    def newest(self, limit: int) -> list[Row]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT date, category, amount, comment FROM expenses ORDER BY seq DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [
+            (date.fromisoformat(d), category, amount, comment)
+            for d, category, amount, comment in rows
+        ]
+
+    def pages(self, start: date | None, end: date | None, page_rows: int) -> Iterator[list[Row]]:
+        """
+        Rows dated from `start` to `end` inclusive (either may be open), newest
+        first, `page_rows` at a time.
+
+        Every page is a query of its own, resumed after the last row seen, so
+        no cursor or lock is held while the caller works through a page.
+        """
+        conditions = ["seq < ?"]
+        bounds: list[str] = []
+        if start is not None:
+            conditions.append("date >= ?")
+            bounds.append(start.isoformat())
+        if end is not None:
+            conditions.append("date <= ?")
+            bounds.append(end.isoformat())
+        query = (
+            "SELECT seq, date, category, amount, comment FROM expenses "
+            f"WHERE {' AND '.join(conditions)} ORDER BY seq DESC LIMIT ?"
+        )
+        last_seq = sys.maxsize
+        while True:
+            with self._lock:
+                rows = self._conn.execute(query, (last_seq, *bounds, page_rows)).fetchall()
+            if not rows:
+                return
+            last_seq = rows[-1][0]
+            yield [
+                (date.fromisoformat(d), category, amount, comment)
+                for _, d, category, amount, comment in rows
+            ]
+            if len(rows) < page_rows:
+                return
+
+    def add(self, expense_date: date, category: str, amount: float, comment: str = "") -> int:
+        """Record a new expense as the newest row and return its seq."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                cursor = self._conn.execute(
+                    "INSERT INTO expenses (date, category, amount, comment) VALUES (?, ?, ?, ?)",
+                    (expense_date.isoformat(), category, amount, comment),
+                )
+                # The row was inserted at the top of the sheet as well.
+                self._conn.execute(
+                    "UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'sheet_rows'"
+                )
+                self._bump_data_version([(expense_date.year, expense_date.month)])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                self._data_version = int(self._get_meta("data_version"))
+                raise
+            self.generation += 1
+            self.totals.add(expense_date, category, amount)
+            return cursor.lastrowid
+
+    def _month_digests(self) -> dict[tuple[int, int], int]:
+        months: dict[tuple[int, int], list[tuple]] = defaultdict(list)
+        for row in self._conn.execute(
+            "SELECT date, category, amount, comment FROM expenses ORDER BY seq"
+        ):
+            months[(int(row[0][:4]), int(row[0][5:7]))].append(row)
+        return {key: hash(tuple(rows)) for key, rows in months.items()}
+
+    def _write(
+        self,
+        replace: bool,
+        rows: list[Row],
+        meta: dict[str, str],
+        expected_generation: int | None,
+    ) -> set[tuple[int, int]] | None:
+        with self._lock:
+            if expected_generation is not None and expected_generation != self.generation:
+                return None
+            # IMMEDIATE takes the write lock up front, so another process
+            # sharing the file cannot commit between the two digests.
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if replace:
+                    before = self._month_digests()
+                    self._conn.execute("DELETE FROM expenses")
+                    base = 0
+                else:
+                    base = self._conn.execute(
+                        "SELECT coalesce(max(seq), 0) FROM expenses"
+                    ).fetchone()[0]
+                self._conn.executemany(
+                    "INSERT INTO expenses (seq, date, category, amount, comment) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (base + len(rows) - i, d.isoformat(), category, amount, comment)
+                        for i, (d, category, amount, comment) in enumerate(rows)
+                    ),
+                )
+                for key, value in meta.items():
+                    self._set_meta(key, value)
+                self._set_meta("synced_at", str(time.time()))
+                if replace:
+                    after = self._month_digests()
+                    changed = {
+                        key
+                        for key in before.keys() | after.keys()
+                        if before.get(key) != after.get(key)
+                    }
+                else:  # prepended rows only add to their own months
+                    changed = {(d.year, d.month) for d, *_ in rows}
+                if changed:
+                    # Logged in the same transaction, so other processes never
+                    # see the rows without the record of what changed.
+                    self._bump_data_version(changed)
+                self._conn.execute("COMMIT")
+                self._synced = True
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                self._data_version = int(self._get_meta("data_version"))
+                raise
+            self.generation += 1
+            if changed:
+                self._reload_totals(changed)
+        return changed
+
+    def replace_all(
+        self,
+        rows: Iterable[Row],
+        state: SyncState | None = None,
+        expected_generation: int | None = None,
+    ) -> set[tuple[int, int]] | None:
+        """
+        Replace the mirror with `rows`, given newest first as in the sheet.
+
+        Returns the (year, month) pairs whose rows changed, or None without
+        touching anything if a local write happened since `expected_generation`
+        was taken.
+        """
+        meta = {}
+        if state is not None:
+            meta = {
+                "sheet_rows": str(state.sheet_rows),
+                "tail_digest": state.tail_digest,
+                "full_synced_at": str(state.full_synced_at),
+            }
+        return self._write(True, list(rows), meta, expected_generation)
+
+    def mark_synced(self) -> None:
+        """Record a sync that found nothing new."""
+        with self._lock:
+            self._set_meta("synced_at", str(time.time()))
+
+    def prepend(
+        self, rows: Iterable[Row], sheet_rows: int, expected_generation: int | None = None
+    ) -> set[tuple[int, int]] | None:
+        """Add rows found above the already synced ones, given newest first."""
+        return self._write(False, list(rows), {"sheet_rows": str(sheet_rows)}, expected_generation)
+
+    def recent(self, limit: int) -> list[dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT date, category, amount, comment FROM expenses ORDER BY seq DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [
+            {
+                "date": display_date(d),
+                "category": category,
+                "amount": f"{amount:g}",
+                "comment": comment,
+            }
+            for d, category, amount, comment in rows
+        ]
+
+    def month(self, year: int, month: int) -> list[dict[str, Any]]:
+        start = date(year, month, 1)
+        end = date(year + month // 12, month % 12 + 1, 1)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT date, category, amount, comment FROM expenses "
+                "WHERE date >= ? AND date < ? ORDER BY seq DESC",
+                (start.isoformat(), end.isoformat()),
+            ).fetchall()
+        return [
+            {"date": display_date(d), "category": category, "amount": amount, "comment": comment}
+            for d, category, amount, comment in rows
+        ]
+
+    def month_stats(self, year: int, month: int) -> MonthStats:
+        return self.totals.month(year, month)
+
+
+_store: ExpenseStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> ExpenseStore:
+    """Return the default tenant's store, configured by BOT_BACKEND_DATABASE_URL."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            url = (
+                settings.bot_backend_database_url.get_secret_value()
+                if settings.bot_backend_database_url
+                else DEFAULT_DATABASE_URL
+            )
+            _store = ExpenseStore(sqlite_path_from_url(url))
+            logger.info(f"Local expense store at {_store.path}")
+        return _store
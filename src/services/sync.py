@@ -0,0 +1,189 @@
+"""Keeps the local store in step with the data sheet.
+
+New rows are always inserted at the top of the sheet, so rows that were
+already synced only move down. An incremental sync therefore reads a small
+window at the top, finds where the newest known rows start, and checks the
+oldest known row is still where it should be (row count plus a digest of
+that boundary row). Anything unexpected falls back to a full re-read, which
+also runs periodically to pick up edits in the middle of the table.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import time
+from typing import Any
+
+import gspread
+from loguru import logger
+
+from src.config import settings
+from src.services.sheets import (
+    DATA_READ_OPTIONS,
+    get_session,
+    iter_data_values,
+    parse_data_row,
+    parse_data_rows,
+    read_data_rows,
+)
+from src.services.store import ExpenseStore, Row, SyncState
+from src.services.tenants import get_month_index, get_stats_cache, get_store
+
+HEAD_MATCH_ROWS = 20  # newest known rows that must match to locate already synced data
+
+
+def row_digest(row: list[Any]) -> str:
+    return hashlib.sha1(json.dumps(row, ensure_ascii=False).encode()).hexdigest()
+
+
+def _find_known_offset(head: list[list[Any]], known: list[Row]) -> int | None:
+    """
+    Raw offset in `head` where the store's newest rows (`known`) start.
+
+    Unparseable rows are skipped on both sides, as they never reach the store.
+    Returns None if the window does not contain the full `known` sequence.
+    """
+    if not known:
+        return None
+    parsed = [(offset, parse_data_row(row)) for offset, row in enumerate(head)]
+    valid = [(offset, row) for offset, row in parsed if row is not None]
+    for start in range(len(valid) - len(known) + 1):
+        if all(valid[start + i][1] == known[i] for i in range(len(known))):
+            return valid[start][0]
+    return None
+
+
+class SheetSync:
+    def __init__(
+        self,
+        window_rows: int = 100,
+        page_rows: int = 10000,
+        full_sync_interval_seconds: float = 3600,
+    ) -> None:
+        self.window_rows = window_rows
+        self.page_rows = page_rows  # rows per request of a full sync
+        self.full_sync_interval = full_sync_interval_seconds
+
+    def _apply(self, changed_months: set[tuple[int, int]] | None) -> bool:
+        if changed_months is None:
+            logger.info("Store sync raced with a new expense; retrying on the next run")
+            return False
+        stats_cache = get_stats_cache()
+        for year, month in changed_months:
+            stats_cache.invalidate(year, month)
+        return True
+
+    def full_sync(self, store: ExpenseStore) -> int:
+        """Re-read the whole table and replace the store. Returns rows mirrored or -1."""
+        generation = store.generation
+        session = get_session()
+        data_ws = session.worksheet(session.data_worksheet_name)
+        # The first page goes through the layout check; the rest of the table follows.
+        values = read_data_rows(session, data_ws, self.page_rows)
+        if len(values) == self.page_rows:
+            start = session.first_data_row() + self.page_rows
+            for page in iter_data_values(data_ws, start, self.page_rows):
+                values.extend(page)
+        while values and not any(values[-1]):
+            values.pop()
+
+        parsed = parse_data_rows(values, "Store sync")
+        rows = [row for row in parsed if row is not None]
+
+        # The full read is ordered data for free; rebuild the month index from it.
+        get_month_index().build([row[0] if row else None for row in parsed])
+
+        state = SyncState(
+            sheet_rows=len(values),
+            tail_digest=row_digest(values[-1]) if values else "",
+            full_synced_at=time.time(),
+        )
+        if not self._apply(store.replace_all(rows, state, expected_generation=generation)):
+            return -1
+        return len(rows)
+
+    def incremental_sync(self, store: ExpenseStore, state: SyncState) -> int | None:
+        """
+        Fetch only rows added above the synced ones. Returns rows added, -1 if
+        the sync raced with a local write, or None if a full sync is needed.
+        """
+        generation = store.generation
+        session = get_session()
+        data_ws = session.worksheet(session.data_worksheet_name)
+        first_data_row = session.first_data_row()
+        known = store.newest(HEAD_MATCH_ROWS)
+        tail_row = first_data_row + state.sheet_rows - 1
+
+        window = self.window_rows
+        while True:
+            # Speculatively check the boundary assuming nothing new, in the
+            # same request as the head window.
+            head, boundary = data_ws.batch_get(
+                [
+                    f"A{first_data_row}:D{first_data_row + window - 1}",
+                    f"A{tail_row}:D{tail_row + 1}",
+                ],
+                **DATA_READ_OPTIONS,
+            )
+            offset = _find_known_offset(head, known)
+            if offset is not None:
+                break
+            if window >= min(self.page_rows, state.sheet_rows + self.window_rows):
+                logger.info("Synced rows not found at the top of the sheet; doing a full sync")
+                return None
+            window *= 4
+
+        if offset:
+            boundary = data_ws.get(
+                f"A{tail_row + offset}:D{tail_row + offset + 1}", **DATA_READ_OPTIONS
+            )
+        if state.sheet_rows:
+            if not boundary or row_digest(list(boundary[0])) != state.tail_digest:
+                logger.info("Oldest synced row changed or moved; doing a full sync")
+                return None
+            if len(boundary) > 1 and any(boundary[1]):
+                logger.info("Rows found below the oldest synced row; doing a full sync")
+                return None
+
+        if not offset:
+            store.mark_synced()
+            return 0
+        parsed_new = parse_data_rows(head[:offset], "Store sync")
+        new_rows = [row for row in parsed_new if row is not None]
+        month_index = get_month_index()
+        for row in reversed(parsed_new):
+            month_index.note_insert(row[0] if row else None)
+        changed_months = store.prepend(
+            new_rows, state.sheet_rows + offset, expected_generation=generation
+        )
+        if not self._apply(changed_months):
+            return -1
+        return len(new_rows)
+
+    def sync(self) -> int:
+        """Sync the store, incrementally when possible. Returns rows added or mirrored."""
+        store = get_store()
+        state = store.sync_state()
+        if (
+            state is None
+            or not store.is_synced()
+            or time.time() - state.full_synced_at > self.full_sync_interval
+        ):
+            return self.full_sync(store)
+        try:
+            synced = self.incremental_sync(store, state)
+        except gspread.exceptions.APIError as exc:
+            # e.g. a boundary range beyond the end of a shrunk sheet
+            logger.info(f"Incremental sync failed ({exc}); doing a full sync")
+            synced = None
+        if synced is None:
+            return self.full_sync(store)
+        return synced
+
+
+sheet_sync = SheetSync(full_sync_interval_seconds=settings.store_full_sync_interval_seconds)
+
+
+def sync_store() -> int:
+    return sheet_sync.sync()
@@ -0,0 +1,303 @@
+"""Tenants: chats that keep their expenses in a spreadsheet of their own.
+
+Without TENANTS_FILE the process serves a single tenant built from
+GOOGLE_SPREADSHEET_ID and ALLOWED_CHAT_ID, as before. With it, a JSON file
+maps chats and Mini App users to spreadsheets:
+
+    [{"id": "anna", "spreadsheet_id": "1AbC...", "chat_ids": [123456789]},
+     {"id": "team", "spreadsheet_id": "1XyZ...", "chat_ids": [-1001234567890],
+      "user_ids": [111, 222], "worksheet_name": "data", "service_worksheet_name": "service"}]
+
+`user_ids` defaults to `chat_ids`: in a private chat the chat id is the user id.
+
+Everything kept per tenant (Sheets session, local store, month index, stats
+cache) lives in a `TenantState`. States are opened on first use and held in a
+bounded LRU pool, so memory stays flat however many tenants are listed. Code
+runs for a tenant inside `use_tenant`, which sets the context variable read by
+`get_store`, `get_month_index`, `get_stats_cache` and `sheets.get_session`.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterator, TypeVar
+
+from loguru import logger
+
+from src.config import settings
+from src.services.metrics import gauge
+from src.services.month_index import MonthIndex, month_index
+from src.services.stats import MonthStatsCache, month_stats_cache
+from src.services.store import ExpenseStore
+from src.services.store import get_store as get_default_store
+
+T = TypeVar("T")
+
+DEFAULT_TENANT_ID = "default"  # the single tenant configured by the settings; uses the globals
+TENANT_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")  # also the store file name
+
+
+@dataclass(frozen=True)
+class Tenant:
+    id: str
+    spreadsheet_id: str | None
+    chat_ids: frozenset[int] = frozenset()
+    user_ids: frozenset[int] = frozenset()  # Mini App users
+    worksheet_name: str = "data"
+    service_worksheet_name: str = "service"
+
+
+class TenantRegistry:
+    """Looks tenants up by chat id, Mini App user id or tenant id."""
+
+    def __init__(self, tenants: list[Tenant], fallback: Tenant | None = None) -> None:
+        self.fallback = fallback  # serves chats and users not listed anywhere
+        self._by_id: dict[str, Tenant] = {}
+        self._by_chat: dict[int, Tenant] = {}
+        self._by_user: dict[int, Tenant] = {}
+        for tenant in tenants:
+            if not TENANT_ID.fullmatch(tenant.id):
+                raise ValueError(f"Invalid tenant id: {tenant.id!r}")
+            if tenant.id in self._by_id:
+                raise ValueError(f"Duplicate tenant id: {tenant.id}")
+            self._by_id[tenant.id] = tenant
+            for chat_id in tenant.chat_ids:
+                if chat_id in self._by_chat:
+                    raise ValueError(f"Chat {chat_id} belongs to more than one tenant")
+                self._by_chat[chat_id] = tenant
+            for user_id in tenant.user_ids:
+                if user_id in self._by_user:
+                    raise ValueError(f"User {user_id} belongs to more than one tenant")
+                self._by_user[user_id] = tenant
+
+    @classmethod
+    def from_settings(cls) -> TenantRegistry:
+        """The single tenant of ALLOWED_CHAT_ID and GOOGLE_SPREADSHEET_ID."""
+        allowed = settings.allowed_chat_id
+        ids = frozenset({allowed}) if allowed else frozenset()
+        tenant = Tenant(DEFAULT_TENANT_ID, settings.google_spreadsheet_id, ids, ids)
+        return cls([tenant], fallback=None if allowed else tenant)
+
+    @classmethod
+    def from_file(cls, path: str) -> TenantRegistry:
+        entries: list[dict[str, Any]] = json.loads(Path(path).read_text(encoding="utf-8"))
+        tenants = []
+        for entry in entries:
+            chat_ids = frozenset(int(i) for i in entry["chat_ids"])
+            tenants.append(
+                Tenant(
+                    id=str(entry["id"]),
+                    spreadsheet_id=entry["spreadsheet_id"],
+                    chat_ids=chat_ids,
+                    user_ids=frozenset(int(i) for i in entry.get("user_ids", chat_ids)),
+                    worksheet_name=entry.get("worksheet_name", "data"),
+                    service_worksheet_name=entry.get("service_worksheet_name", "service"),
+                )
+            )
+        return cls(tenants)
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[Tenant]:
+        return iter(self._by_id.values())
+
+    def get(self, tenant_id: str) -> Tenant | None:
+        return self._by_id.get(tenant_id)
+
+    def for_chat(self, chat_id: int) -> Tenant | None:
+        return self._by_chat.get(chat_id, self.fallback)
+
+    def for_user(self, user_id: int) -> Tenant | None:
+        return self._by_user.get(user_id, self.fallback)
+
+
+_registry: TenantRegistry | None = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> TenantRegistry:
+    """The tenants of TENANTS_FILE, or the single one from the settings."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            if settings.tenants_file:
+                _registry = TenantRegistry.from_file(settings.tenants_file)
+                logger.info(f"Serving {len(_registry)} tenants from {settings.tenants_file}")
+            else:
+                _registry = TenantRegistry.from_settings()
+        return _registry
+
+
+class TenantState:
+    """Everything kept open for one tenant. Opened lazily, closed on eviction."""
+
+    def __init__(self, tenant: Tenant) -> None:
+        self.tenant = tenant
+        self.is_default = tenant.id == DEFAULT_TENANT_ID
+        self.lock = threading.Lock()
+        self.session: Any = None  # SheetsSession, opened by sheets.get_session
+        self._store: ExpenseStore | None = None
+        self.month_index = month_index if self.is_default else MonthIndex()
+        self.stats_cache = (
+            month_stats_cache
+            if self.is_default
+            else MonthStatsCache(
+                max_entries=settings.stats_cache_max_months,
+                current_ttl_seconds=settings.stats_cache_current_month_ttl_seconds,
+                past_ttl_seconds=settings.stats_cache_past_month_ttl_seconds,
+            )
+        )
+        self.users = 0  # callers inside use_tenant or running in a worker thread
+
+    @property
+    def store(self) -> ExpenseStore:
+        with self.lock:
+            if self._store is None:
+                if self.is_default:
+                    self._store = get_default_store()
+                else:
+                    path = Path(settings.tenant_data_dir) / f"{self.tenant.id}.sqlite3"
+                    self._store = ExpenseStore(str(path))
+            return self._store
+
+    def close(self) -> None:
+        with self.lock:
+            if self._store is not None and not self.is_default:
+                self._store.close()
+            self._store = None
+            self.session = None
+
+
+class TenantPool:
+    """
+    LRU pool of open tenant states, at most `max_size` of them.
+
+    States in use are never evicted (the pool may exceed its size until they
+    are released); the default tenant's state wraps process globals and stays.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._states: OrderedDict[str, TenantState] = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def acquire(self, tenant: Tenant) -> TenantState:
+        with self._lock:
+            state = self._states.get(tenant.id)
+            if state is None or state.tenant != tenant:
+                if state is not None and not state.users:
+                    state.close()  # the tenant was reconfigured; one in use closes on release
+                state = self._states[tenant.id] = TenantState(tenant)
+            self._states.move_to_end(tenant.id)
+            state.users += 1
+            self._evict()
+            return state
+
+    def pin(self, state: TenantState) -> None:
+        with self._lock:
+            state.users += 1
+
+    def release(self, state: TenantState) -> None:
+        with self._lock:
+            state.users -= 1
+            if not state.users and self._states.get(state.tenant.id) is not state:
+                state.close()  # replaced while in use
+            self._evict()
+
+    def _evict(self) -> None:
+        excess = len(self._states) - self.max_size
+        for tenant_id, state in list(self._states.items()):
+            if excess <= 0:
+                break
+            if state.users or state.is_default:
+                continue
+            del self._states[tenant_id]
+            state.close()
+            self.evictions += 1
+            excess -= 1
+            logger.debug(f"Closed idle tenant {tenant_id}")
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def tenants(self) -> list[Tenant]:
+        """Tenants with an open state, least recently used first."""
+        with self._lock:
+            return [state.tenant for state in self._states.values()]
+
+
+tenant_pool = TenantPool(settings.tenant_pool_size)
+
+gauge("financier_tenants_open", "Tenant states kept open in the pool", lambda: len(tenant_pool))
+
+current_tenant: ContextVar[TenantState | None] = ContextVar("current_tenant", default=None)
+
+
+@contextmanager
+def use_tenant(tenant: Tenant) -> Iterator[TenantState]:
+    """Run the block for `tenant`: service getters return its session, store and caches."""
+    state = tenant_pool.acquire(tenant)
+    token = current_tenant.set(state)
+    try:
+        yield state
+    finally:
+        current_tenant.reset(token)
+        tenant_pool.release(state)
+
+
+def current_state() -> TenantState:
+    state = current_tenant.get()
+    if state is not None:
+        return state
+    # Outside use_tenant only the single tenant of the settings can be meant.
+    tenant = get_registry().get(DEFAULT_TENANT_ID)
+    if tenant is None:
+        raise RuntimeError("No tenant selected")
+    with use_tenant(tenant) as state:
+        return state
+
+
+def active_tenants() -> list[Tenant]:
+    """Tenants to keep in sync: the open ones, and the only one of a single-tenant setup."""
+    registry = get_registry()
+    if len(registry) == 1:
+        return list(registry)
+    return tenant_pool.tenants()
+
+
+def carry_context(call: Callable[[], T]) -> Callable[[], T]:
+    """Wrap `call` to run in a worker thread for the caller's tenant, kept open until it returns."""
+    state = current_tenant.get()
+    context = copy_context()
+    if state is None:
+        return lambda: context.run(call)
+    tenant_pool.pin(state)
+
+    def run() -> T:
+        try:
+            return context.run(call)
+        finally:
+            tenant_pool.release(state)
+
+    return run
+
+
+def get_store() -> ExpenseStore:
+    return current_state().store
+
+
+def get_month_index() -> MonthIndex:
+    return current_state().month_index
+
+
+def get_stats_cache() -> MonthStatsCache:
+    return current_state().stats_cache
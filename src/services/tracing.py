@@ -0,0 +1,304 @@
+"""Trace spans for bot updates and web requests, and a profiler for slow ones.
+
+Each Telegram update and HTTP request runs in a trace; `span` marks the steps
+inside it (parsing, Sheets calls and their API requests, formatting, the
+reply). Spans follow the work into the Sheets worker threads through the
+copied context. The trace id is set in the loguru context, so every log line
+of an update carries it. Outside a trace `span` costs one context variable
+lookup.
+
+Traces slower than TRACE_SLOW_MS log their span tree. With PROFILE_SLOW_MS
+set, a sampler thread records the stacks of every running trace, and the
+samples of those slower than the threshold are written to PROFILE_DIR as
+folded stacks, the input of flamegraph.pl, speedscope and inferno.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from types import FrameType
+from typing import Callable, Iterator, TypeVar
+
+from loguru import logger
+
+from src.config import settings
+
+T = TypeVar("T")
+
+LOG_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | "
+    "{extra[trace_id]} | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
+    "<level>{message}</level>"
+)
+MAX_LOGGED_SPANS = 40
+
+
+class Span:
+    __slots__ = ("name", "trace", "started", "duration", "children")
+
+    def __init__(self, name: str, trace: Trace) -> None:
+        self.name = name
+        self.trace = trace
+        self.started = time.perf_counter()
+        self.duration: float | None = None  # seconds, once finished
+        self.children: list[Span] = []
+
+
+class Trace:
+    def __init__(self, name: str) -> None:
+        self.id = uuid.uuid4().hex[:16]
+        self.root = Span(name, self)
+        self.thread = threading.get_ident()
+        try:
+            self.task = asyncio.current_task()
+        except RuntimeError:
+            self.task = None
+        self.threads: dict[int, int] = {}  # other threads inside its spans, and how deep
+        self.samples: Counter[str] = Counter()  # folded stack -> times seen
+        self.profiler: Profiler | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.root.duration is not None
+
+
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+def current_trace_id() -> str | None:
+    current = _current_span.get()
+    if current is None or current.trace.finished:
+        return None
+    return current.trace.id
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Time a step of the current trace; does nothing outside of one."""
+    parent = _current_span.get()
+    if parent is None or parent.trace.finished:
+        yield
+        return
+    trace = parent.trace
+    child = Span(name, trace)
+    parent.children.append(child)
+    profiler = trace.profiler if trace.thread != threading.get_ident() else None
+    if profiler is not None:
+        profiler.enter(trace)
+    token = _current_span.set(child)
+    try:
+        yield
+    finally:
+        child.duration = time.perf_counter() - child.started
+        _current_span.reset(token)
+        if profiler is not None:
+            profiler.leave(trace)
+
+
+def in_span(name: str, call: Callable[[], T]) -> Callable[[], T]:
+    """Wrap `call` to run in a span, e.g. in a worker thread of the caller's trace."""
+
+    def run() -> T:
+        with span(name):
+            return call()
+
+    return run
+
+
+@contextmanager
+def trace(name: str) -> Iterator[str]:
+    """Trace an update or request; inside a running trace this is a span. Yields the trace id."""
+    parent = _current_span.get()
+    if parent is not None and not parent.trace.finished:
+        with span(name):
+            yield parent.trace.id
+        return
+
+    new = Trace(name)
+    profiler = new.profiler = get_profiler()
+    if profiler is not None:
+        profiler.add(new)
+    token = _current_span.set(new.root)
+    try:
+        with logger.contextualize(trace_id=new.id):
+            yield new.id
+    finally:
+        new.root.duration = time.perf_counter() - new.root.started
+        _current_span.reset(token)
+        if profiler is not None:
+            profiler.remove(new)
+        _report(new)
+
+
+def format_tree(root: Span) -> str:
+    """One line per span: name, duration and start offset from the root, indented by depth."""
+    lines: list[str] = []
+
+    def walk(node: Span, depth: int) -> None:
+        if len(lines) >= MAX_LOGGED_SPANS:
+            return
+        took = "unfinished" if node.duration is None else f"{node.duration * 1000:.0f} ms"
+        offset = (node.started - root.started) * 1000
+        lines.append(f"{'  ' * depth}{node.name} {took} @{offset:.0f}")
+        for child in list(node.children):
+            walk(child, depth + 1)
+
+    walk(root, 0)
+    return "\n".join(lines)
+
+
+def _report(finished: Trace) -> None:
+    took_ms = (finished.root.duration or 0.0) * 1000
+    log = logger.bind(trace_id=finished.id)
+    if settings.trace_slow_ms and took_ms >= settings.trace_slow_ms:
+        log.warning(f"Slow {finished.root.name}: {took_ms:.0f} ms\n{format_tree(finished.root)}")
+    threshold = settings.profile_slow_ms
+    if threshold is not None and took_ms >= threshold and finished.samples:
+        try:
+            path = write_profile(finished, Path(settings.profile_dir))
+        except OSError as e:
+            log.error(f"Failed to write profile: {e}")
+        else:
+            log.warning(f"Profile of slow {finished.root.name} written to {path}")
+
+
+def write_profile(finished: Trace, directory: Path) -> Path:
+    """Write the samples as folded stacks: `frame;frame;frame count` per line."""
+    directory.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = directory / f"{stamp}-{finished.id}.folded"
+    lines = [f"{stack} {count}\n" for stack, count in finished.samples.most_common()]
+    path.write_text("".join(lines), encoding="utf-8")
+    return path
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{Path(code.co_filename).stem}.{code.co_qualname}".replace(";", ":")
+
+
+def _await_chain(task: asyncio.Task) -> list[FrameType]:
+    """Frames of the coroutines the task is awaiting, outermost first."""
+    frames = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None)
+        if frame is None:  # a future, or a finished coroutine
+            break
+        frames.append(frame)
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    return frames
+
+
+def _fold(root: str, frames: list[FrameType]) -> str:
+    """Frames outermost first, below the trace name and `root` (the thread or task)."""
+    return ";".join([root] + [_frame_name(frame) for frame in frames])
+
+
+class Profiler:
+    """
+    Samples the stacks of running traces from a daemon thread.
+
+    For a trace started in a task that is the task's chain of awaiting
+    coroutines (where the update is waiting), plus the full stack of every
+    worker thread currently inside one of its spans (what that wait is spent
+    on). The thread sleeps while no trace is running.
+    """
+
+    def __init__(self, interval_seconds: float) -> None:
+        self.interval = interval_seconds
+        self._traces: set[Trace] = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def add(self, running: Trace) -> None:
+        with self._lock:
+            self._traces.add(running)
+            if running.task is None:
+                running.threads[running.thread] = 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def remove(self, finished: Trace) -> None:
+        with self._lock:
+            self._traces.discard(finished)
+
+    def enter(self, running: Trace) -> None:
+        thread = threading.get_ident()
+        with self._lock:
+            running.threads[thread] = running.threads.get(thread, 0) + 1
+
+    def leave(self, running: Trace) -> None:
+        thread = threading.get_ident()
+        with self._lock:
+            depth = running.threads.get(thread, 0) - 1
+            if depth > 0:
+                running.threads[thread] = depth
+            else:
+                running.threads.pop(thread, None)
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._traces:
+                    self._wakeup.clear()
+                    continue
+                self.sample()
+
+    def sample(self) -> None:
+        """Take one sample of every running trace; called with the lock held."""
+        frames = sys._current_frames()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for running in self._traces:
+            prefix = running.root.name
+            if running.task is not None:
+                try:
+                    awaiting = _await_chain(running.task)
+                except Exception:  # the loop moved on while the chain was walked
+                    awaiting = []
+                if awaiting:
+                    running.samples[_fold(f"{prefix};task", awaiting)] += 1
+            for thread in running.threads:
+                frame = frames.get(thread)
+                stack: list[FrameType] = []
+                while frame is not None:
+                    stack.append(frame)
+                    frame = frame.f_back
+                if stack:
+                    name = names.get(thread, str(thread))
+                    running.samples[_fold(f"{prefix};{name}", stack[::-1])] += 1
+
+
+_profiler: Profiler | None = None
+
+
+def get_profiler() -> Profiler | None:
+    """The sampling profiler if PROFILE_SLOW_MS is set; started on first use."""
+    global _profiler
+    if settings.profile_slow_ms is None:
+        return None
+    if _profiler is None:
+        _profiler = Profiler(settings.profile_interval_ms / 1000)
+    return _profiler
+
+
+def configure_logging() -> None:
+    """Log to stderr with the id of the current trace ("-" outside of one)."""
+    logger.configure(
+        handlers=[{"sink": sys.stderr, "format": LOG_FORMAT}],
+        extra={"trace_id": "-"},
+    )
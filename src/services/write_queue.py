@@ -0,0 +1,404 @@
+"""Durable outbox for new expenses, drained to Google Sheets in the background.
+
+Handlers hand parsed expenses to the outbox, which commits them to a local
+SQLite file and returns at once, so replies never wait for Google. A
+background worker drains the outbox in submission order; submissions that
+arrive within a short window are written with one multi-row insert.
+
+Every submission carries an idempotency key (chat and message id for the
+bot), so a redelivered update is not queued twice. When a write fails in a
+way that may still have reached the sheet (timeout, 5xx), the entries are
+flagged and the top of the sheet is checked before their retry so the rows
+are not inserted twice. Failures that never got to Google (429, the breaker
+being open, no free worker) are retried without the check, which would
+otherwise mistake an equal expense written earlier for the retried one.
+Google Sheets outages are retried until they pass; submissions rejected
+outright are kept as failed and reported by /pending.
+
+Each submission belongs to a tenant and is written to that tenant's sheet.
+Tenants are drained in turn, one batch each, and a tenant whose writes fail
+waits out its retry delay without holding up the others.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import requests
+from gspread.exceptions import APIError
+from loguru import logger
+
+from src.config import settings
+from src.services import sheets_async
+from src.services.metrics import gauge
+from src.services.resilience import SheetsUnavailableError, is_transient
+from src.services.tenants import DEFAULT_TENANT_ID, current_state, get_registry, use_tenant
+
+WRITTEN_RETENTION_SECONDS = 7 * 24 * 3600  # keys of written entries are kept to catch redeliveries
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY,  -- submission order
+    key TEXT NOT NULL UNIQUE,  -- idempotency key
+    tenant TEXT NOT NULL DEFAULT 'default',
+    expenses TEXT NOT NULL,  -- JSON list, oldest first
+    created_at REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending | written | failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    uncertain INTEGER NOT NULL DEFAULT 0,  -- a failed write may have reached the sheet
+    error TEXT,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_outbox_status ON outbox (status, seq);
+"""
+ENTRY_COLUMNS = "seq, key, tenant, expenses, created_at, attempts, uncertain, error"
+
+
+def may_have_written(exc: BaseException) -> bool:
+    """Whether a failed insert may still have been applied: timeouts and 5xx, not 429s."""
+    if isinstance(exc, (SheetsUnavailableError, sheets_async.QueueTimeoutError)):
+        return False
+    if isinstance(exc, APIError):
+        return exc.response.status_code >= 500
+    if isinstance(exc, requests.ConnectTimeout):
+        return False
+    return isinstance(exc, (TimeoutError, requests.Timeout, requests.ConnectionError))
+
+
+@dataclass(frozen=True)
+class OutboxEntry:
+    seq: int
+    key: str
+    tenant: str
+    expenses: list[dict[str, Any]]
+    created_at: float
+    attempts: int
+    uncertain: bool
+    error: str | None
+
+
+@dataclass(frozen=True)
+class OutboxStatus:
+    pending: int  # expenses waiting to be written
+    oldest_created_at: float | None
+    failed: list[OutboxEntry]
+    degraded: bool  # the last write attempt failed and will be retried
+
+
+class Outbox:
+    """SQLite table of submissions, written once each and in order."""
+
+    def __init__(self, path: str) -> None:
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Commits survive a crash of the bot; only a power loss can drop the last ones.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")}
+        if "tenant" not in columns:  # outbox of a single-tenant version
+            self._conn.execute(
+                f"ALTER TABLE outbox ADD COLUMN tenant TEXT NOT NULL DEFAULT '{DEFAULT_TENANT_ID}'"
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _entry(row: tuple) -> OutboxEntry:
+        seq, key, tenant, expenses, created_at, attempts, uncertain, error = row
+        return OutboxEntry(
+            seq, key, tenant, json.loads(expenses), created_at, attempts, bool(uncertain), error
+        )
+
+    def add(
+        self, key: str, expenses: list[dict[str, Any]], tenant: str = DEFAULT_TENANT_ID
+    ) -> bool:
+        """Queue a submission; False if one with the same key was already accepted."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO outbox (key, tenant, expenses, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, tenant, json.dumps(expenses, ensure_ascii=False), time.time()),
+            )
+            return cursor.rowcount == 1
+
+    def pending_tenants(self) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT tenant FROM outbox WHERE status = 'pending' ORDER BY tenant"
+            ).fetchall()
+        return [tenant for (tenant,) in rows]
+
+    def pending(self, max_expenses: int, tenant: str) -> list[OutboxEntry]:
+        """A tenant's oldest pending entries, whole, up to `max_expenses` (at least one entry)."""
+        batch: list[OutboxEntry] = []
+        size = 0
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {ENTRY_COLUMNS} FROM outbox "
+                "WHERE status = 'pending' AND tenant = ? ORDER BY seq",
+                (tenant,),
+            )
+            for row in rows:
+                entry = self._entry(row)
+                if batch and size + len(entry.expenses) > max_expenses:
+                    break
+                batch.append(entry)
+                size += len(entry.expenses)
+        return batch
+
+    def _update(
+        self, entries: list[OutboxEntry], status: str, error: str | None, uncertain: bool = False
+    ) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE outbox SET status = ?, error = ?, attempts = attempts + 1, "
+                "uncertain = max(uncertain, ?), updated_at = ? WHERE seq = ?",
+                [(status, error, uncertain, time.time(), entry.seq) for entry in entries],
+            )
+
+    def mark_written(self, entries: list[OutboxEntry]) -> None:
+        self._update(entries, "written", None)
+
+    def mark_retry(self, entries: list[OutboxEntry], error: str, uncertain: bool) -> None:
+        """Keep the entries pending; `uncertain` if the failed write may have been applied."""
+        self._update(entries, "pending", error, uncertain)
+
+    def mark_failed(self, entries: list[OutboxEntry], error: str) -> None:
+        self._update(entries, "failed", error)
+
+    def retry_failed(self, tenant: str) -> int:
+        """Put a tenant's failed entries back in line. Returns how many."""
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE outbox SET status = 'pending' WHERE status = 'failed' AND tenant = ?",
+                (tenant,),
+            ).rowcount
+
+    def failed(self, tenant: str) -> list[OutboxEntry]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {ENTRY_COLUMNS} FROM outbox "
+                "WHERE status = 'failed' AND tenant = ? ORDER BY seq",
+                (tenant,),
+            ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def pending_summary(self, tenant: str | None = None) -> tuple[int, float | None]:
+        """(pending expenses, creation time of the oldest pending entry), all tenants by default."""
+        query = "SELECT expenses, created_at FROM outbox WHERE status = 'pending'"
+        params: tuple[str, ...] = ()
+        if tenant is not None:
+            query += " AND tenant = ?"
+            params = (tenant,)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        count = sum(len(json.loads(expenses)) for expenses, _ in rows)
+        return count, min((created_at for _, created_at in rows), default=None)
+
+    def prune(self, older_than_seconds: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM outbox WHERE status = 'written' AND updated_at < ?",
+                (time.time() - older_than_seconds,),
+            )
+
+
+class WriteBehindQueue:
+    def __init__(
+        self,
+        flush: Callable[[list[dict[str, Any]]], Awaitable[None]],
+        outbox_path: str,
+        window_seconds: float = 0.5,
+        max_batch: int = 100,
+        retry_seconds: float = 30,
+        check_written: Callable[[list[dict[str, Any]]], Awaitable[bool]] | None = None,
+    ) -> None:
+        self._flush = flush
+        self._check_written = check_written
+        self.outbox_path = outbox_path
+        self.window = window_seconds
+        self.max_batch = max_batch
+        self.retry_seconds = retry_seconds
+        self._outbox: Outbox | None = None
+        self._wakeup = asyncio.Event()
+        self._degraded: set[str] = set()  # tenants whose last write failed transiently
+        self._retry_at: dict[str, float] = {}  # monotonic time a failing tenant is retried
+        self._last_tenant = ""  # drained last; the next batch goes to the tenant after it
+
+    @property
+    def outbox(self) -> Outbox:
+        # Opened on first use, so importing the module touches no files.
+        if self._outbox is None:
+            self._outbox = Outbox(self.outbox_path)
+        return self._outbox
+
+    @property
+    def degraded(self) -> bool:
+        """The current tenant's last write attempt failed and will be retried."""
+        return current_state().tenant.id in self._degraded
+
+    def depth(self) -> int:
+        """Expenses of all tenants not yet written to Google Sheets."""
+        return self.outbox.pending_summary()[0]
+
+    def status(self) -> OutboxStatus:
+        """The current tenant's outbox."""
+        tenant = current_state().tenant.id
+        pending, oldest = self.outbox.pending_summary(tenant)
+        return OutboxStatus(pending, oldest, self.outbox.failed(tenant), tenant in self._degraded)
+
+    # -- producer side -----------------------------------------------------------
+
+    def submit(self, expense: dict[str, Any], key: str | None = None) -> bool:
+        return self.submit_many([expense], key)
+
+    def submit_many(self, expenses: list[dict[str, Any]], key: str | None = None) -> bool:
+        """
+        Durably queue expenses (oldest first) for the current tenant's sheet and return at once.
+
+        Returns False if a submission with the same idempotency key was
+        already accepted, in which case nothing is queued.
+        """
+        tenant = current_state().tenant.id
+        added = self.outbox.add(key or uuid.uuid4().hex, list(expenses), tenant)
+        if added:
+            self._wakeup.set()
+        return added
+
+    def retry_failed(self) -> int:
+        retried = self.outbox.retry_failed(current_state().tenant.id)
+        if retried:
+            self._wakeup.set()
+        return retried
+
+    # -- consumer side -----------------------------------------------------------
+
+    def _next_tenant(self, ready_only: bool) -> str | None:
+        """The tenant after the last drained one, skipping tenants waiting out a failure."""
+        now = time.monotonic()
+        tenants = [
+            tenant
+            for tenant in self.outbox.pending_tenants()
+            if not ready_only or self._retry_at.get(tenant, 0.0) <= now
+        ]
+        if not tenants:
+            return None
+        return next((tenant for tenant in tenants if tenant > self._last_tenant), tenants[0])
+
+    async def flush(self, tenant: str | None = None) -> bool:
+        """Write one batch of a tenant's pending expenses. False if it must be retried."""
+        tenant = tenant or self._next_tenant(ready_only=False)
+        if tenant is None:
+            return True
+        self._last_tenant = tenant
+        batch = self.outbox.pending(self.max_batch, tenant)
+        if not batch:
+            return True
+        owner = get_registry().get(tenant)
+        if owner is None:
+            logger.error(f"Queued expenses belong to unknown tenant {tenant}")
+            self.outbox.mark_failed(batch, f"Unknown tenant {tenant}")
+            return True
+        with use_tenant(owner):
+            written = await self._write(tenant, batch)
+        if written:
+            self._degraded.discard(tenant)
+            self._retry_at.pop(tenant, None)
+        else:
+            self._degraded.add(tenant)
+            self._retry_at[tenant] = time.monotonic() + self.retry_seconds
+        return written
+
+    async def _write(self, tenant: str, batch: list[OutboxEntry]) -> bool:
+        expenses = [expense for entry in batch for expense in entry.expenses]
+
+        # Entries whose last insert failed ambiguously (timeout, 5xx) come
+        # first; it may still have reached the sheet, so look before repeating it.
+        uncertain = [entry for entry in batch if entry.uncertain]
+        flushing = False
+        try:
+            if (
+                uncertain
+                and self._check_written is not None
+                and await self._check_written(
+                    [expense for entry in uncertain for expense in entry.expenses]
+                )
+            ):
+                logger.info(f"{len(uncertain)} queued submissions were already written")
+                self.outbox.mark_written(uncertain)
+                return True
+            flushing = True
+            await self._flush(expenses)
+        except Exception as exc:
+            if not is_transient(exc) and not isinstance(exc, TimeoutError):
+                logger.error(f"Google Sheets rejected {len(expenses)} queued expenses: {exc}")
+                self.outbox.mark_failed(batch, str(exc))
+                return True
+            logger.warning(
+                f"Failed to write {len(expenses)} queued expenses of {tenant}, will retry: {exc}"
+            )
+            self.outbox.mark_retry(batch, str(exc), flushing and may_have_written(exc))
+            return False
+
+        self.outbox.mark_written(batch)
+        return True
+
+    async def run(self) -> None:
+        """Background task: drain the outbox shortly after submissions arrive."""
+        self.outbox.prune(WRITTEN_RETENTION_SECONDS)
+        self._wakeup.set()  # entries left over from before a restart
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # Give other messages of the same burst a chance to join.
+            await asyncio.sleep(self.window)
+            while self.depth():
+                tenant = self._next_tenant(ready_only=True)
+                if tenant is None:
+                    # Every tenant with pending expenses is waiting out a failure.
+                    now = time.monotonic()
+                    retry_at = min(
+                        (self._retry_at.get(t, now) for t in self.outbox.pending_tenants()),
+                        default=now,
+                    )
+                    await asyncio.sleep(max(0.0, retry_at - now))
+                    continue
+                await self.flush(tenant)
+
+
+expense_queue = WriteBehindQueue(
+    sheets_async.append_expenses,
+    settings.write_queue_outbox_path,
+    window_seconds=settings.write_queue_window_seconds,
+    max_batch=settings.write_queue_max_batch,
+    check_written=sheets_async.expenses_at_top,
+)
+
+
+def _outbox_depth() -> int:
+    # Only the bot drains the outbox; web workers have no outbox to report.
+    if expense_queue._outbox is None:
+        raise LookupError("outbox not opened in this process")
+    return expense_queue.depth()
+
+
+gauge("financier_outbox_pending", "Expenses queued but not yet in Google Sheets", _outbox_depth)
+gauge(
+    "financier_outbox_degraded_tenants",
+    "Tenants whose last sheet write failed and is being retried",
+    lambda: len(expense_queue._degraded),
+)
@@ -1,12 +1,14 @@
 import asyncio
-import re
-from datetime import datetime
-from typing import Any
+import time
+from datetime import date, datetime
+from typing import Any, AsyncGenerator, AsyncIterator
 
 from aiogram import Bot, Dispatcher
 from aiogram.filters import CommandStart, Command
 from aiogram.types import (
+    InputFile,
     Message,
+    Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     WebAppInfo,
@@ -15,127 +17,102 @@ from aiogram.types import (
 from loguru import logger
 
 from src.config import settings
-from src.services.sheets import append_expense, get_recent_expenses, get_current_month_expenses
-from src.telegram.utils import format_expense_for_display, get_example_formats, format_stats
+from src.services import export, metrics, tracing
+from src.services.sheets_async import (
+    get_recent_expenses,
+    get_month_stats,
+    keep_store_in_sync,
+    stream_export,
+)
+from src.services.tenants import get_registry, use_tenant
+from src.services.write_queue import expense_queue
+from src.telegram.parser import parse_expense
+from src.telegram.utils import (
+    format_expense_for_display,
+    format_pending,
+    format_stats,
+    get_example_formats,
+)
+
+
+class StreamedFile(InputFile):
+    """A document uploaded as its chunks arrive, never held in memory whole."""
+
+    def __init__(self, chunks: AsyncIterator[bytes], filename: str) -> None:
+        super().__init__(filename=filename)
+        self.chunks = chunks
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        async for chunk in self.chunks:
+            yield chunk
 
 
 class Chat:
     def __init__(self, msg: Message):
         self.bot = msg.bot
         self.chat_id = msg.chat.id
+        self.tenant = get_registry().for_chat(self.chat_id)
 
     def _is_allowed(self) -> bool:
-        allowed = settings.allowed_chat_id
-        return allowed is None or self.chat_id == allowed
+        return self.tenant is not None
 
     async def respond(self, text: str, **kwargs) -> None:
-        await self.bot.send_message(self.chat_id, text, **kwargs)
-
-    async def _parse_message(self, message: str) -> dict[str, Any]:
-        """
-        Possible keys:
-        - amount: required
-        - category: required
-        - date: optional
-        - comment: optional
-
-        todo: in future learn to parse 'Транспорт 990 09.09 "такси"'
-        """
-        result = {}
-
-        # Extract comment if present
-        comment_pattern = r'["\'\`<](.*?)["\'\`>]'
-        comment_match = re.search(comment_pattern, message)
-
-        if comment_match:
-            result["comment"] = comment_match.group(1)
-            # Remove the comment from the message for further processing
-            message = re.sub(comment_pattern, "", message).strip()
-        else:
-            result["comment"] = ""
-
-        # Extract date if present
-        date_pattern = r"(\d{1,2}[./-]\d{1,2}(?:[./-]\d{2,4})?)"
-        date_match = re.search(date_pattern, message)
-
-        if date_match:
-            date_str = date_match.group(1)
-            # Remove the date from the message for further processing
-            message = message.replace(date_str, "").strip()
-
-            # Parse the date
-            try:
-                # Handle different date formats
-                if "." in date_str:
-                    parts = date_str.split(".")
-                elif "/" in date_str:
-                    parts = date_str.split("/")
-                elif "-" in date_str:
-                    parts = date_str.split("-")
-                else:
-                    raise ValueError(f"Unsupported date format: {date_str}")
-
-                day = int(parts[0])
-                month = int(parts[1])
-
-                # If year is provided, use it; otherwise use current year
-                current_year = datetime.now().year
-                if len(parts) > 2:
-                    year = int(parts[2])
-                    # Handle two-digit years
-                    if year < 100:
-                        year += 2000
-                else:
-                    year = current_year
-
-                result["date"] = datetime(year, month, day).strftime("%Y-%m-%d")
-            except (ValueError, IndexError):
-                raise ValueError(f"Invalid date format: {date_str}")
-        else:
-            # Use today's date if no date provided
-            result["date"] = datetime.now().strftime("%Y-%m-%d")
-
-        # Split the remaining message into words
-        words = message.split()
-        if len(words) < 2:
-            raise ValueError("Message must contain at least amount and category")
-
-        # First word should be the amount
-        try:
-            result["amount"] = float(words[0])
-        except ValueError:
-            raise ValueError(f"Invalid amount: {words[0]}")
-
-        # The rest is the category
-        result["category"] = " ".join(words[1:])
+        with tracing.span("send_message"):
+            await self.bot.send_message(self.chat_id, text, **kwargs)
 
-        return result
+    async def respond_document(self, document: InputFile, **kwargs) -> None:
+        with tracing.span("send_document"):
+            await self.bot.send_document(self.chat_id, document, **kwargs)
 
+    def _parse_message(self, message: str) -> dict[str, Any]:
+        with tracing.span("parse"):
+            return parse_expense(message)
 
-async def _main() -> None:
-    token = settings.telegram_bot_token.get_secret_value() if settings.telegram_bot_token else None
-    if not token:
-        raise RuntimeError("TELEGRAM_BOT_TOKEN is not set")
+    def _parse_bulk(self, text: str) -> tuple[list[dict[str, Any]], list[str]]:
+        """
+        Parse a message with one expense per line.
 
-    bot = Bot(token=token)
+        Returns the parsed expenses in message order and one error per invalid
+        line; the batch is only meant to be saved when there are no errors.
+        """
+        today = date.today()
+        expenses = []
+        errors = []
+        with tracing.span("parse"):
+            for line_no, line in enumerate(text.splitlines(), 1):
+                if not line.strip():
+                    continue
+                try:
+                    expenses.append(parse_expense(line, today))
+                except ValueError as e:
+                    errors.append(f"Line {line_no}: {e}")
+        return expenses, errors
+
+
+def build_dispatcher() -> Dispatcher:
+    """The bot's middlewares and handlers, ready to be fed updates."""
     dp = Dispatcher()
 
-    if settings.webapp_url:
-        try:
-            menu_button = MenuButtonWebApp(
-                text="Статистика",
-                web_app=WebAppInfo(url=settings.webapp_url),
-            )
-            if settings.allowed_chat_id:
-                await bot.set_chat_menu_button(
-                    chat_id=settings.allowed_chat_id,
-                    menu_button=menu_button,
-                )
-            else:
-                await bot.set_chat_menu_button(menu_button=menu_button)
-            logger.info("Mini App menu button configured")
-        except Exception as e:
-            logger.warning(f"Failed to configure Mini App menu button: {e}")
+    @dp.update.outer_middleware()
+    async def trace_update(handler, update: Update, data: dict[str, Any]) -> Any:
+        """Trace the update from filters to reply; its log lines carry the trace id."""
+        with tracing.trace(f"update {update.event_type}"):
+            return await handler(update, data)
+
+    @dp.message.outer_middleware()
+    async def tenant_scope(handler, msg: Message, data: dict[str, Any]) -> Any:
+        """Handle the message with the sheet, store and caches of its chat's tenant."""
+        tenant = get_registry().for_chat(msg.chat.id)
+        if tenant is None:
+            return await handler(msg, data)
+        with use_tenant(tenant):
+            return await handler(msg, data)
+
+    @dp.message.middleware()
+    async def record_latency(handler, msg: Message, data: dict[str, Any]) -> Any:
+        name = data["handler"].callback.__name__
+        with metrics.handler_seconds.time(handler=name), tracing.span(name):
+            return await handler(msg, data)
 
     def mini_app_markup() -> InlineKeyboardMarkup | None:
         if not settings.webapp_url:
@@ -158,11 +135,14 @@ async def _main() -> None:
             return
         await chat.respond(
             f"Привет! Твой chat_id: {chat.chat_id}.\n"
-            "Пришли сумму и описание: например, '450 кофе'.\n\n"
+            "Пришли сумму и описание: например, '450 кофе'.\n"
+            "Можно прислать несколько трат сразу, по одной на строку.\n\n"
             "Доступные команды:\n"
             "/example - показать примеры ввода\n"
             "/recent - показать последние 10 трат\n"
             "/stats - статистика за текущий месяц\n"
+            "/pending - траты, ещё не записанные в таблицу\n"
+            "/export - выгрузить траты в CSV или XLSX\n"
             "/app - открыть Mini App с диаграммой"
         )
 
@@ -188,7 +168,7 @@ async def _main() -> None:
 
         try:
             # Get recent expenses from Google Sheets
-            expenses = get_recent_expenses()
+            expenses = await get_recent_expenses()
 
             if not expenses:
                 await chat.respond("📊 Нет данных о тратах")
@@ -211,8 +191,10 @@ async def _main() -> None:
             return
 
         try:
-            expenses = get_current_month_expenses()
-            response = format_stats(expenses)
+            now = datetime.now()
+            stats = await get_month_stats(now.year, now.month)
+            with tracing.span("format_stats"):
+                response = format_stats(stats)
             kwargs = {}
             markup = mini_app_markup()
             if markup:
@@ -235,14 +217,89 @@ async def _main() -> None:
 
         await chat.respond("Открой статистику в Mini App:", reply_markup=markup)
 
+    @dp.message(Command("pending"))
+    async def on_pending(msg: Message) -> None:
+        chat = Chat(msg)
+        if not chat._is_allowed():
+            return
+
+        args = (msg.text or "").split()[1:]
+        if args == ["retry"]:
+            retried = expense_queue.retry_failed()
+            await chat.respond(f"🔁 Повторная запись: {retried}")
+            return
+        await chat.respond(format_pending(expense_queue.status(), time.time()))
+
+    @dp.message(Command("export"))
+    async def on_export(msg: Message) -> None:
+        chat = Chat(msg)
+        if not chat._is_allowed():
+            return
+
+        try:
+            export_format, export_query = export.parse_args((msg.text or "").split()[1:])
+        except ValueError as e:
+            await chat.respond(
+                f"❌ {e}\n\n"
+                "Формат: /export [csv|xlsx] [период [период]] [категория, ...]\n"
+                "Период: 2025, 2025-09 или 2025-09-01. Например: /export xlsx 2025-01 2025-06 кофе"
+            )
+            return
+
+        document = StreamedFile(
+            stream_export(export_format, export_query),
+            export.filename(export_format, export_query),
+        )
+        try:
+            await chat.respond_document(document, caption="📤 Выгрузка трат")
+        except Exception as e:
+            logger.error(f"Failed to export expenses: {e}")
+            await chat.respond(f"❌ Ошибка при выгрузке: {str(e)}")
+
+    def queue_expenses(msg: Message, expenses: list[dict[str, Any]]) -> str:
+        """Hand expenses to the outbox and describe the outcome for the reply."""
+        try:
+            with tracing.span("outbox.submit"):
+                added = expense_queue.submit_many(expenses, key=f"{msg.chat.id}:{msg.message_id}")
+        except Exception as e:
+            logger.error(f"Failed to queue {len(expenses)} expenses: {e}")
+            return f"\n\n❌ Failed to save: {str(e)}"
+        if not added:
+            return "\n\n✅ Already saved"
+        if expense_queue.degraded:
+            return (
+                "\n\n⏳ Saved; Google Sheets is unavailable, it will be written when it recovers "
+                "(/pending)"
+            )
+        return "\n\n✅ Saved"
+
+    async def save_bulk(chat: Chat, msg: Message) -> None:
+        expenses, errors = chat._parse_bulk(msg.text or "")
+        if errors:
+            await chat.respond(
+                "❌ Nothing saved, fix these lines and send the message again:\n"
+                + "\n".join(errors)
+            )
+            return
+
+        total = sum(expense["amount"] for expense in expenses)
+        response = f"✅ Parsed {len(expenses)} expenses, total {total:g}"
+        response += queue_expenses(msg, expenses)
+        await chat.respond(response)
+
     @dp.message()
     async def on_message(msg: Message) -> None:
         chat = Chat(msg)
         if not chat._is_allowed():
             return
 
+        text = msg.text or ""
+        if len([line for line in text.splitlines() if line.strip()]) > 1:
+            await save_bulk(chat, msg)
+            return
+
         try:
-            parsed_data = await chat._parse_message(msg.text)
+            parsed_data = chat._parse_message(text)
 
             response = (
                 f"✅ Parsed successfully:\n"
@@ -254,39 +311,100 @@ async def _main() -> None:
             if parsed_data["comment"]:
                 response += f"\n💬 Comment: {parsed_data['comment']}"
 
-            try:
-                append_expense(parsed_data)
-                response += "\n\n✅ Saved to Google Sheets"
-            except Exception as e:
-                logger.error(f"Failed to save to Google Sheets: {e}")
-                response += f"\n\n❌ Failed to save to Google Sheets: {str(e)}"
-
+            response += queue_expenses(msg, [parsed_data])
             await chat.respond(response)
 
         except ValueError as e:
             await chat.respond(f"❌ Error: {str(e)}")
 
-    tasks = []
+    return dp
+
+
+async def _main() -> None:
+    token = settings.telegram_bot_token.get_secret_value() if settings.telegram_bot_token else None
+    if not token:
+        raise RuntimeError("TELEGRAM_BOT_TOKEN is not set")
+
+    bot = Bot(token=token)
+    dp = build_dispatcher()
+    metrics.start_loop_monitor()
 
-    # Start webapp server if configured
     if settings.webapp_url:
-        import uvicorn
-        from src.webapp import app as webapp
+        try:
+            menu_button = MenuButtonWebApp(
+                text="Статистика",
+                web_app=WebAppInfo(url=settings.webapp_url),
+            )
+            if settings.allowed_chat_id and not settings.tenants_file:
+                await bot.set_chat_menu_button(
+                    chat_id=settings.allowed_chat_id,
+                    menu_button=menu_button,
+                )
+            else:
+                await bot.set_chat_menu_button(menu_button=menu_button)
+            logger.info("Mini App menu button configured")
+        except Exception as e:
+            logger.warning(f"Failed to configure Mini App menu button: {e}")
+
+    tasks = [keep_store_in_sync(settings.store_sync_interval_seconds), expense_queue.run()]
+
+    if settings.telegram_webhook_secret:
+        await _serve_webhook(bot, dp, tasks)
+        return
 
-        host = settings.bot_backend_host or "0.0.0.0"
-        port = settings.bot_backend_port or 8000
-        config = uvicorn.Config(webapp, host=host, port=port, log_level="info", access_log=False)
-        server = uvicorn.Server(config)
-        tasks.append(server.serve())
-        logger.info(f"Starting webapp on {host}:{port}")
+    # Start webapp server if configured and not run separately as financier-web
+    if settings.webapp_url and settings.bot_serve_webapp:
+        tasks.append(_webapp_server().serve())
 
+    # getUpdates is refused while a webhook from an earlier webhook-mode run is set.
+    await bot.delete_webhook()
     logger.info("Starting Telegram bot polling")
     tasks.append(dp.start_polling(bot))
     await asyncio.gather(*tasks)
 
 
+def _webapp_server():
+    import uvicorn
+    from src.webapp import app as webapp
+
+    host = settings.bot_backend_host or "0.0.0.0"
+    port = settings.bot_backend_port or 8000
+    config = uvicorn.Config(webapp, host=host, port=port, log_level="info", access_log=False)
+    logger.info(f"Starting webapp on {host}:{port}")
+    return uvicorn.Server(config)
+
+
+async def _serve_webhook(bot: Bot, dp: Dispatcher, tasks: list) -> None:
+    """Receive updates through the webapp instead of long polling."""
+    from src.webapp import WEBHOOK_PATH, attach_dispatcher
+
+    if not settings.webapp_url:
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET is set but WEBAPP_URL is not")
+
+    attach_dispatcher(bot, dp)
+    server = _webapp_server()
+    background = [asyncio.create_task(task) for task in tasks]
+    webhook_url = settings.webapp_url.rstrip("/") + WEBHOOK_PATH
+    await bot.set_webhook(
+        webhook_url,
+        secret_token=settings.telegram_webhook_secret.get_secret_value(),
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logger.info(f"Telegram webhook set to {webhook_url}")
+    try:
+        await server.serve()
+    finally:
+        for task in background:
+            task.cancel()
+        if settings.telegram_webhook_delete_on_shutdown:
+            await bot.delete_webhook()
+            logger.info("Telegram webhook removed")
+        await bot.session.close()
+
+
 def run() -> None:
     """CLI entrypoint: uv run financier-bot"""
+    tracing.configure_logging()
     asyncio.run(_main())
 
 
@@ -0,0 +1,88 @@
+"""Expense message parser shared by the bot handlers and bulk entry.
+
+Grammar: ``<amount> <category words> [<date>] ["comment"]`` where the date
+and the comment may appear anywhere after the amount. The comment is
+enclosed in "", '', `` or <>; the date is DD.MM, DD.MM.YY or DD.MM.YYYY with
+".", "/" or "-" as separators.
+"""
+
+from __future__ import annotations
+
+import re
+from datetime import date
+from typing import Any
+
+_COMMENT_RE = re.compile(r"[\"'`<](.*?)[\"'`>]")
+_DATE_RE = re.compile(r"(\d{1,2})[./-](\d{1,2})(?:[./-](\d{2,4}))?")
+
+
+def _is_number(token: str) -> bool:
+    try:
+        float(token)
+    except ValueError:
+        return False
+    return True
+
+
+def _parse_date(token: str, match: re.Match, today: date) -> str:
+    day, month, year = match.groups()
+    if year is None:
+        year_num = today.year
+    else:
+        year_num = int(year)
+        # Handle two-digit years
+        if year_num < 100:
+            year_num += 2000
+    try:
+        return date(year_num, int(month), int(day)).isoformat()
+    except ValueError:
+        raise ValueError(f"Invalid date format: {token}") from None
+
+
+def parse_expense(message: str, today: date | None = None) -> dict[str, Any]:
+    """
+    Parse one expense message into amount, category, date and comment.
+
+    Possible keys:
+    - amount: required
+    - category: required
+    - date: optional, defaults to `today`; returned as YYYY-MM-DD
+    - comment: optional
+
+    todo: in future learn to parse 'Транспорт 990 09.09 "такси"'
+    """
+    today = today or date.today()
+
+    comment_match = _COMMENT_RE.search(message)
+    if comment_match:
+        comment = comment_match.group(1)
+        message = _COMMENT_RE.sub(" ", message)
+    else:
+        comment = ""
+
+    tokens = message.split()
+    expense_date = None
+    words = []
+    for i, token in enumerate(tokens):
+        if expense_date is None:
+            date_match = _DATE_RE.fullmatch(token)
+            # A leading "1.5" is the amount, unless an amount follows it ("01.09 450 кофе").
+            if date_match and (i > 0 or (len(tokens) > 1 and _is_number(tokens[1]))):
+                expense_date = _parse_date(token, date_match, today)
+                continue
+        words.append(token)
+
+    if len(words) < 2:
+        raise ValueError("Message must contain at least amount and category")
+
+    try:
+        amount = float(words[0])
+    except ValueError:
+        raise ValueError(f"Invalid amount: {words[0]}") from None
+
+    return {
+        "comment": comment,
+        "date": expense_date or today.isoformat(),
+        "amount": amount,
+        "category": " ".join(words[1:]),
+    }
@@ -1,8 +1,10 @@
 """Telegram bot utility functions."""
 
-from collections import defaultdict
 from typing import Any, Dict
 
+from src.services.stats import MonthStats
+from src.services.write_queue import OutboxStatus
+
 
 def format_expense_for_display(expense: Dict[str, Any], index: int = None) -> str:
     """Format an expense for display in chat messages."""
@@ -49,38 +51,40 @@ def get_example_formats() -> list[str]:
     ]
 
 
-def format_stats(expenses: list[dict[str, Any]]) -> str:
+def format_stats(stats: MonthStats) -> str:
     """Format statistics for display in chat messages."""
-    if not expenses:
+    if not stats.count:
         return "📊 Нет данных за текущий месяц"
-    
-    # Calculate total
-    total = sum(exp.get("amount", 0) for exp in expenses)
-    
-    # Calculate per day average
-    # Get unique dates
-    unique_dates = set(exp.get("date", "") for exp in expenses if exp.get("date"))
-    days_count = len(unique_dates) if unique_dates else 1
-    per_day_avg = total / days_count if days_count > 0 else 0
-    
-    # Calculate category subtotals
-    category_totals = defaultdict(float)
-    for exp in expenses:
-        category = exp.get("category", "").strip()
-        amount = exp.get("amount", 0)
-        if category:
-            category_totals[category] += amount
-    
-    # Sort categories by subtotal in descending order
-    sorted_categories = sorted(category_totals.items(), key=lambda x: x[1], reverse=True)
-    
+
     # Format the response
     response = "📈 Статистика за текущий месяц\n\n"
-    response += f"💰 Всего: {total:.0f}\n"
-    response += f"📅 Среднее в день: {per_day_avg:.0f}\n\n"
+    response += f"💰 Всего: {stats.total:.0f}\n"
+    response += f"📅 Среднее в день: {stats.per_day:.0f}\n\n"
     response += "📂 Категории:\n"
-    
-    for category, subtotal in sorted_categories:
+
+    for category, subtotal in stats.categories:
         response += f"• {category} - {subtotal:.0f}\n"
-    
+
     return response
+
+
+def format_pending(status: OutboxStatus, now: float) -> str:
+    """Format the outbox state for the /pending command."""
+    if not status.pending and not status.failed:
+        return "✅ Все траты записаны в таблицу"
+
+    lines = []
+    if status.pending:
+        age = now - (status.oldest_created_at or now)
+        age_str = f"{age:.0f} с" if age < 120 else f"{age / 60:.0f} мин"
+        lines.append(f"⏳ Ожидают записи: {status.pending} (самая старая — {age_str} назад)")
+    if status.degraded:
+        lines.append("⚠️ Google Sheets недоступен, запись повторится автоматически")
+    if status.failed:
+        lines.append("\n❌ Не удалось записать (/pending retry — повторить):")
+        for entry in status.failed:
+            for expense in entry.expenses:
+                lines.append(
+                    f"• {expense['amount']:g} {expense['category']} {expense['date']} — {entry.error}"
+                )
+    return "\n".join(lines)
@@ -1,29 +1,84 @@
-"""Telegram Mini App – expense pie chart."""
+"""Telegram Mini App – expense pie chart, and the bot's webhook endpoint."""
 
+import asyncio
+import base64
+import gzip
 import hashlib
 import hmac
 import json
 import time
 from collections import defaultdict
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from functools import lru_cache
+from pathlib import Path
 from urllib.parse import parse_qsl
 
-from fastapi import FastAPI, HTTPException, Query
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
 from loguru import logger
+from pydantic import ValidationError
 
 from src.config import settings
-from src.services.sheets import get_month_expenses
+from src.services import export, metrics, tracing
+from src.services.metrics import cache_lookups, http_request_seconds
+from src.services.sheets_async import (
+    data_version,
+    get_month_stats,
+    get_range_totals,
+    stream_export,
+)
+from src.services.tenants import Tenant, get_registry, use_tenant
+
+try:
+    import brotli
+except ImportError:  # optional: `br` is served only when brotli is installed
+    brotli = None
+
 
-app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tracing.configure_logging()
+    metrics.start_loop_monitor()
+    yield
+
+
+app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["GET"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Trace-Id"],
 )
+# JSON responses; static assets below are compressed once at startup instead.
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    """Time and trace the request; the trace id is returned in X-Trace-Id."""
+    started = time.perf_counter()
+    status = "500"
+    try:
+        with tracing.trace(f"{request.method} {request.url.path}") as trace_id:
+            response = await call_next(request)
+        response.headers["X-Trace-Id"] = trace_id
+        status = str(response.status_code)
+        return response
+    finally:
+        # The route template, not the URL: query strings and ids would explode the label set.
+        route = request.scope.get("route")
+        http_request_seconds.observe(
+            time.perf_counter() - started,
+            route=getattr(route, "path", "unmatched"),
+            status=status,
+        )
 
 
 # ---------------------------------------------------------------------------
@@ -31,12 +86,55 @@ app.add_middleware(
 # ---------------------------------------------------------------------------
 
 
-def validate_init_data(init_data: str) -> dict:
-    """Validate Telegram WebApp initData using HMAC-SHA256."""
+# Verified initData by its SHA-256, until the initData itself expires.
+_VERIFIED_CACHE_SIZE = 256
+_verified_init_data: dict[str, tuple[float, dict]] = {}
+
+
+@lru_cache(maxsize=4)
+def _webapp_secret_key(bot_token: str) -> bytes:
+    return hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+
+
+@lru_cache(maxsize=4)
+def _session_key(bot_token: str) -> bytes:
+    return hmac.new(_webapp_secret_key(bot_token), b"financier-session", hashlib.sha256).digest()
+
+
+def _bot_token() -> str:
     if not settings.telegram_bot_token:
         raise ValueError("Bot token not configured")
+    return settings.telegram_bot_token.get_secret_value()
+
+
+def _remember_verified(key: str, expires_at: float, parsed: dict) -> None:
+    if len(_verified_init_data) >= _VERIFIED_CACHE_SIZE:
+        now = time.time()
+        for stale in [k for k, (exp, _) in _verified_init_data.items() if exp <= now]:
+            del _verified_init_data[stale]
+        while len(_verified_init_data) >= _VERIFIED_CACHE_SIZE:
+            del _verified_init_data[next(iter(_verified_init_data))]
+    _verified_init_data[key] = (expires_at, parsed)
+
+
+def validate_init_data(init_data: str) -> dict:
+    """
+    Validate Telegram WebApp initData using HMAC-SHA256.
+
+    The Mini App sends the same initData for every request, so a verified one
+    is remembered until it would expire and repeat requests skip the parsing
+    and the HMAC entirely.
+    """
+    token = _bot_token()
+    cache_key = hashlib.sha256(init_data.encode()).hexdigest()
+    cached = _verified_init_data.get(cache_key)
+    if cached is not None:
+        if time.time() < cached[0]:
+            cache_lookups.inc(cache="init_data", result="hit")
+            return dict(cached[1])
+        del _verified_init_data[cache_key]
+    cache_lookups.inc(cache="init_data", result="miss")
 
-    token = settings.telegram_bot_token.get_secret_value()
     parsed = dict(parse_qsl(init_data, keep_blank_values=True))
     received_hash = parsed.pop("hash", None)
     if not received_hash:
@@ -44,9 +142,8 @@ def validate_init_data(init_data: str) -> dict:
 
     data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(parsed.items()))
 
-    secret_key = hmac.new(b"WebAppData", token.encode(), hashlib.sha256).digest()
     computed_hash = hmac.new(
-        secret_key, data_check_string.encode(), hashlib.sha256
+        _webapp_secret_key(token), data_check_string.encode(), hashlib.sha256
     ).hexdigest()
 
     if not hmac.compare_digest(computed_hash, received_hash):
@@ -67,12 +164,136 @@ def validate_init_data(init_data: str) -> dict:
     if now - auth_date > max_age:
         raise ValueError("Expired init data")
 
-    if settings.allowed_chat_id and "user" in parsed:
-        user_data = json.loads(parsed["user"])
-        if user_data.get("id") != settings.allowed_chat_id:
+    if "user" in parsed and get_registry().for_user(_user_id(parsed)) is None:
+        raise ValueError("Access denied")
+
+    _remember_verified(cache_key, auth_date + max_age, parsed)
+    return dict(parsed)
+
+
+def _user_id(parsed: dict) -> int:
+    return json.loads(parsed["user"]).get("id", 0) if "user" in parsed else 0
+
+
+def init_data_expires_at(parsed: dict) -> int:
+    return int(parsed["auth_date"]) + max(1, settings.webapp_init_data_max_age_seconds)
+
+
+def issue_session_token(parsed: dict) -> str:
+    """Sign a compact session token valid as long as the initData it was issued for."""
+    payload = f"{_user_id(parsed)}.{init_data_expires_at(parsed)}"
+    signature = hmac.new(_session_key(_bot_token()), payload.encode(), hashlib.sha256).hexdigest()
+    return f"{payload}.{signature}"
+
+
+def validate_session_token(session_token: str) -> int:
+    """Check a token from issue_session_token and return the user id it was issued to."""
+    try:
+        user_id, expires_at, signature = session_token.split(".")
+        payload = f"{int(user_id)}.{int(expires_at)}"
+    except ValueError as exc:
+        raise ValueError("Malformed session token") from exc
+
+    expected = hmac.new(_session_key(_bot_token()), payload.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, signature):
+        raise ValueError("Invalid session token")
+    if time.time() >= int(expires_at):
+        raise ValueError("Expired session token")
+    return int(user_id)
+
+
+def authenticate(init_data: str | None, authorization: str | None) -> Tenant:
+    """Accept a session token (Authorization: Bearer) or raw initData; return the user's tenant."""
+    try:
+        if authorization and authorization.startswith("Bearer "):
+            user_id = validate_session_token(authorization.removeprefix("Bearer "))
+        elif init_data:
+            user_id = _user_id(validate_init_data(init_data))
+        else:
+            raise ValueError("Missing initData")
+        tenant = get_registry().for_user(user_id)
+        if tenant is None:
             raise ValueError("Access denied")
+    except ValueError as e:
+        logger.warning(f"Mini App auth failed: {e}")
+        raise HTTPException(status_code=403, detail=str(e))
+    return tenant
+
 
-    return parsed
+# ---------------------------------------------------------------------------
+# HTTP caching
+# ---------------------------------------------------------------------------
+
+API_CACHE_CONTROL = "private, no-cache"  # always revalidate, usually with a 304
+PAGE_CACHE_CONTROL = "no-cache"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """Weak comparison, as If-None-Match calls for."""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag.removeprefix("W/") in candidates
+
+
+async def api_etag(*key: object) -> str | None:
+    """
+    ETag for an API response derived from the sheets data version.
+
+    Computed before any data is fetched, so a matching If-None-Match is
+    answered without touching Sheets or the store. None while there is no
+    reliable version (store not synced yet): such responses are not cached.
+    Weak, since the gzip middleware sends the same tag for both encodings.
+    """
+    version = await data_version()
+    if version is None:
+        return None
+    digest = hashlib.sha256(repr((version, key)).encode()).hexdigest()[:32]
+    return f'W/"{digest}"'
+
+
+def not_modified(request: Request, etag: str | None, cache_control: str) -> Response | None:
+    if etag is not None and _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+    return None
+
+
+def set_cache_headers(response: Response, etag: str | None, cache_control: str) -> None:
+    response.headers["Cache-Control"] = cache_control if etag else "no-store"
+    if etag:
+        response.headers["ETag"] = etag
+
+
+class StaticAsset:
+    """In-memory asset precompressed once, served with a strong ETag."""
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str) -> None:
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.encodings = {"identity": body, "gzip": gzip.compress(body, 9)}
+        if brotli is not None:
+            self.encodings["br"] = brotli.compress(body)
+
+    def response(self, request: Request) -> Response:
+        headers = {
+            "ETag": self.etag,
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if _etag_matches(request, self.etag):
+            return Response(status_code=304, headers=headers)
+
+        accepted = request.headers.get("accept-encoding", "")
+        for encoding in ("br", "gzip"):
+            if encoding in self.encodings and encoding in accepted:
+                headers["Content-Encoding"] = encoding
+                return Response(
+                    self.encodings[encoding], media_type=self.media_type, headers=headers
+                )
+        return Response(self.encodings["identity"], media_type=self.media_type, headers=headers)
 
 
 # ---------------------------------------------------------------------------
@@ -80,17 +301,28 @@ def validate_init_data(init_data: str) -> dict:
 # ---------------------------------------------------------------------------
 
 
+@app.get("/api/session")
+async def api_session(initData: str = Query(...)):
+    """Trade initData for a session token that is cheap to verify on later requests."""
+    try:
+        parsed = validate_init_data(initData)
+    except ValueError as e:
+        logger.warning(f"Mini App auth failed: {e}")
+        raise HTTPException(status_code=403, detail=str(e))
+
+    return {"token": issue_session_token(parsed), "expires_at": init_data_expires_at(parsed)}
+
+
 @app.get("/api/stats")
 async def api_stats(
-    initData: str = Query(...),
+    request: Request,
+    response: Response,
+    initData: str | None = Query(default=None),
     year: int | None = Query(default=None),
     month: int | None = Query(default=None),
+    authorization: str | None = Header(default=None),
 ):
-    try:
-        validate_init_data(initData)
-    except ValueError as e:
-        logger.warning(f"Mini App auth failed: {e}")
-        raise HTTPException(status_code=403, detail=str(e))
+    tenant = authenticate(initData, authorization)
 
     now = datetime.now()
     target_year = year or now.year
@@ -100,38 +332,235 @@ async def api_stats(
     if target_year < 2000 or target_year > 2100:
         raise HTTPException(status_code=400, detail="Invalid year")
 
-    try:
-        expenses = get_month_expenses(target_year, target_month)
-    except Exception as e:
-        logger.error(f"Failed to get expenses: {e}")
-        raise HTTPException(status_code=500, detail="Failed to fetch expenses")
+    with use_tenant(tenant):
+        etag = await api_etag("stats", tenant.id, target_year, target_month)
+        if cached := not_modified(request, etag, API_CACHE_CONTROL):
+            return cached
+        set_cache_headers(response, etag, API_CACHE_CONTROL)
 
-    category_totals: dict[str, float] = defaultdict(float)
-    for exp in expenses:
-        category = exp.get("category", "").strip()
-        amount = exp.get("amount", 0)
-        if category:
-            category_totals[category] += amount
-
-    sorted_categories = sorted(category_totals.items(), key=lambda x: x[1], reverse=True)
-    total = sum(amount for _, amount in sorted_categories)
+        try:
+            stats = await get_month_stats(target_year, target_month)
+        except Exception as e:
+            logger.error(f"Failed to get expenses: {e}")
+            raise HTTPException(status_code=500, detail="Failed to fetch expenses")
 
     return {
-        "categories": [{"name": n, "amount": a} for n, a in sorted_categories],
-        "total": total,
+        "categories": [{"name": n, "amount": a} for n, a in stats.categories],
+        "total": stats.total,
         "year": target_year,
         "month": target_month,
     }
 
 
+@app.get("/api/stats/range")
+async def api_stats_range(
+    request: Request,
+    response: Response,
+    initData: str | None = Query(default=None),
+    year: int | None = Query(default=None),
+    month: int | None = Query(default=None),
+    months: int = Query(default=12),
+    authorization: str | None = Header(default=None),
+):
+    """Per-month and per-category totals for `months` months ending with year/month."""
+    tenant = authenticate(initData, authorization)
+
+    now = datetime.now()
+    end_year = year or now.year
+    end_month = month or now.month
+    if end_month < 1 or end_month > 12:
+        raise HTTPException(status_code=400, detail="Invalid month")
+    if end_year < 2000 or end_year > 2100:
+        raise HTTPException(status_code=400, detail="Invalid year")
+    if months < 1 or months > 36:
+        raise HTTPException(status_code=400, detail="Invalid months")
+
+    with use_tenant(tenant):
+        etag = await api_etag("range", tenant.id, end_year, end_month, months)
+        if cached := not_modified(request, etag, API_CACHE_CONTROL):
+            return cached
+        set_cache_headers(response, etag, API_CACHE_CONTROL)
+
+        try:
+            totals = await get_range_totals(end_year, end_month, months)
+        except Exception as e:
+            logger.error(f"Failed to get expenses: {e}")
+            raise HTTPException(status_code=500, detail="Failed to fetch expenses")
+
+    month_items = []
+    range_totals: dict[str, float] = defaultdict(float)
+    for (y, m), categories in sorted(totals.items()):
+        sorted_categories = sorted(categories.items(), key=lambda x: x[1], reverse=True)
+        for name, amount in sorted_categories:
+            range_totals[name] += amount
+        month_items.append(
+            {
+                "categories": [{"name": n, "amount": a} for n, a in sorted_categories],
+                "total": sum(categories.values()),
+                "year": y,
+                "month": m,
+            }
+        )
+
+    sorted_range = sorted(range_totals.items(), key=lambda x: x[1], reverse=True)
+    return {
+        "months": month_items,
+        "categories": [{"name": n, "amount": a} for n, a in sorted_range],
+        "total": sum(range_totals.values()),
+    }
+
+
+@app.get("/api/export")
+async def api_export(
+    initData: str | None = Query(default=None),
+    export_format: str = Query(default="csv", alias="format"),
+    start: date | None = Query(default=None),
+    end: date | None = Query(default=None),
+    category: list[str] = Query(default=[]),
+    authorization: str | None = Header(default=None),
+):
+    """Expenses from `start` to `end` (inclusive) as a CSV or XLSX download, streamed."""
+    tenant = authenticate(initData, authorization)
+    if export_format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid format")
+    try:
+        export_query = export.build_query(start, end, category)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    with use_tenant(tenant):
+        chunks = stream_export(export_format, export_query)
+        try:
+            # Read ahead here, so a failing Sheets read is still an error status
+            # rather than a download that stops short.
+            first = await anext(chunks)
+        except Exception as e:
+            await chunks.aclose()
+            logger.error(f"Failed to export expenses: {e}")
+            raise HTTPException(status_code=500, detail="Failed to export expenses")
+
+    async def body():
+        yield first
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            logger.error(f"Export of {tenant.id} failed midway: {e}")
+            raise
+
+    name = export.filename(export_format, export_query)
+    return StreamingResponse(
+        body(),
+        media_type=export.FORMATS[export_format][1],
+        headers={
+            "Content-Disposition": f'attachment; filename="{name}"',
+            "Cache-Control": "no-store",
+        },
+    )
+
+
+# ---------------------------------------------------------------------------
+# Telegram webhook
+# ---------------------------------------------------------------------------
+
+WEBHOOK_PATH = "/telegram/webhook"
+
+# Updates being handled; referenced so they are not garbage collected mid-flight.
+_webhook_tasks: set[asyncio.Task] = set()
+
+
+def attach_dispatcher(bot: Bot, dispatcher: Dispatcher) -> None:
+    """Route webhook updates received by this app to `dispatcher`."""
+    app.state.telegram = (bot, dispatcher)
+
+
+def _webhook_task_done(task: asyncio.Task) -> None:
+    _webhook_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.opt(exception=task.exception()).error("Failed to handle Telegram update")
+
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(
+    request: Request,
+    x_telegram_bot_api_secret_token: str | None = Header(default=None),
+):
+    """
+    Accept an update from Telegram and handle it in the background.
+
+    Telegram sends the secret given to setWebhook in a header; anything else
+    is rejected. The reply is sent right away so slow handlers never make
+    Telegram retry (and deliver the same update twice).
+    """
+    secret = settings.telegram_webhook_secret
+    telegram = getattr(app.state, "telegram", None)
+    if secret is None or telegram is None:
+        raise HTTPException(status_code=404)
+    if not x_telegram_bot_api_secret_token or not hmac.compare_digest(
+        x_telegram_bot_api_secret_token.encode(), secret.get_secret_value().encode()
+    ):
+        raise HTTPException(status_code=401, detail="Invalid secret token")
+
+    bot, dispatcher = telegram
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except (ValueError, ValidationError):
+        raise HTTPException(status_code=400, detail="Invalid update")
+
+    task = asyncio.create_task(dispatcher.feed_update(bot, update))
+    _webhook_tasks.add(task)
+    task.add_done_callback(_webhook_task_done)
+    return {"ok": True}
+
+
+metrics.gauge(
+    "financier_webhook_updates_in_flight",
+    "Telegram updates accepted by the webhook and still being handled",
+    lambda: len(_webhook_tasks),
+)
+
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+
+@app.get("/metrics")
+async def metrics_endpoint(authorization: str | None = Header(default=None)):
+    """Prometheus text format; each process (bot, every web worker) reports its own."""
+    token = settings.metrics_token
+    if (
+        token
+        and token.get_secret_value()
+        and not hmac.compare_digest(
+            (authorization or "").encode(), f"Bearer {token.get_secret_value()}".encode()
+        )
+    ):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 # ---------------------------------------------------------------------------
 # HTML page
 # ---------------------------------------------------------------------------
 
 
-@app.get("/", response_class=HTMLResponse)
-async def stats_page():
-    return STATS_HTML
+CHART_JS_VERSION = "4.4.7"
+CHART_JS_NAME = f"chart-{CHART_JS_VERSION}.umd.min.js"
+CHART_JS_PATH = Path(__file__).parent / "static" / CHART_JS_NAME
+CHART_JS_CDN = f"https://cdn.jsdelivr.net/npm/chart.js@{CHART_JS_VERSION}/dist/chart.umd.min.js"
+
+
+@app.get("/")
+async def stats_page(request: Request):
+    return stats_page_asset.response(request)
+
+
+@app.get(f"/static/{CHART_JS_NAME}")
+async def chart_js(request: Request):
+    if chart_js_asset is None:
+        raise HTTPException(status_code=404)
+    return chart_js_asset.response(request)
 
 
 STATS_HTML = """\
@@ -142,7 +571,7 @@ STATS_HTML = """\
 <meta name="viewport" content="width=device-width,initial-scale=1.0,maximum-scale=1.0,user-scalable=no">
 <title>Расходы</title>
 <script src="https://telegram.org/js/telegram-web-app.js"></script>
-<script src="https://cdn.jsdelivr.net/npm/chart.js@4/dist/chart.umd.min.js"></script>
+<script __CHART_JS_ATTRS__></script>
 <style>
 *{margin:0;padding:0;box-sizing:border-box}
 body{
@@ -171,6 +600,8 @@ body{
 .month{font-size:13px;color:var(--tg-theme-hint-color,#999);text-transform:uppercase;letter-spacing:.5px}
 .total{font-size:34px;font-weight:700;margin-top:2px}
 .chart-wrap{position:relative;max-width:280px;margin:0 auto 28px}
+.trend-wrap{position:relative;height:160px;margin:28px 0 0}
+.trend-title{font-size:13px;color:var(--tg-theme-hint-color,#999);text-transform:uppercase;letter-spacing:.5px;margin-bottom:8px}
 .legend{list-style:none;padding:0}
 .legend-item{
   display:flex;align-items:center;
@@ -223,26 +654,123 @@ function shiftMonth(delta){
   state.month = m;
 }
 
-async function fetchStats(){
+async function apiError(r){
+  let detail = r.statusText;
+  try{
+    const err = await r.json();
+    if(err && err.detail){
+      detail = typeof err.detail === 'string' ? err.detail : JSON.stringify(err.detail);
+    }
+  }catch(_){}
+  return new Error(detail);
+}
+
+let session = null;
+
+async function sessionToken(){
+  if(session && session.expires_at * 1000 > Date.now()) return session.token;
   const initData = tg.initData;
   if(!initData) throw new Error('Откройте через Telegram');
+  const r = await fetch('/api/session?'+new URLSearchParams({initData: initData}).toString());
+  if(!r.ok) throw await apiError(r);
+  session = await r.json();
+  return session.token;
+}
+
+// Months already fetched, by "year-month"; filled in bulk by /api/stats/range
+// so prev/next navigation rarely has to wait for the network.
+const monthCache = {};
+const pendingRanges = {};
+let trend = [];
+
+function monthKey(y, m){return y+'-'+m}
+
+function addMonths(y, m, delta){
+  const i = y*12 + (m-1) + delta;
+  return [Math.floor(i/12), i%12 + 1];
+}
+
+async function fetchRange(endYear, endMonth, months){
+  const key = monthKey(endYear, endMonth)+'/'+months;
+  if(!pendingRanges[key]){
+    pendingRanges[key] = (async function(){
+      const token = await sessionToken();
+      const params = new URLSearchParams({
+        year: String(endYear),
+        month: String(endMonth),
+        months: String(months),
+      });
+      const r = await fetch('/api/stats/range?'+params.toString(), {
+        headers: {Authorization: 'Bearer '+token},
+      });
+      if(!r.ok) throw await apiError(r);
+      const data = await r.json();
+      data.months.forEach(function(m){monthCache[monthKey(m.year, m.month)] = m});
+      return data.months;
+    })();
+    pendingRanges[key].catch(function(){delete pendingRanges[key]});
+  }
+  return pendingRanges[key];
+}
+
+function prefetchAround(){
+  // Load the previous year in the background when approaching its edge.
+  const prev = addMonths(state.year, state.month, -1);
+  if(!monthCache[monthKey(prev[0], prev[1])]){
+    fetchRange(prev[0], prev[1], 12).catch(function(){});
+  }
+}
+
+async function fetchStats(){
+  const cached = monthCache[monthKey(state.year, state.month)];
+  if(cached) return cached;
+  const token = await sessionToken();
   const params = new URLSearchParams({
-    initData: initData,
     year: String(state.year),
     month: String(state.month),
   });
-  const r = await fetch('/api/stats?'+params.toString());
-  if(!r.ok){
-    let detail = r.statusText;
-    try{
-      const err = await r.json();
-      if(err && err.detail){
-        detail = typeof err.detail === 'string' ? err.detail : JSON.stringify(err.detail);
+  const r = await fetch('/api/stats?'+params.toString(), {
+    headers: {Authorization: 'Bearer '+token},
+  });
+  if(!r.ok) throw await apiError(r);
+  const data = await r.json();
+  monthCache[monthKey(data.year, data.month)] = data;
+  return data;
+}
+
+function renderTrend(){
+  if(!trend.length) return;
+  const selected = monthKey(state.year, state.month);
+  const ctx = document.getElementById('trend').getContext('2d');
+  new Chart(ctx,{
+    type:'bar',
+    data:{
+      labels: trend.map(function(m){return MONTHS[m.month-1].slice(0,3)}),
+      datasets:[{
+        data: trend.map(function(m){return m.total}),
+        backgroundColor: trend.map(function(m){
+          return monthKey(m.year, m.month) === selected ? COLORS[0] : COLORS[0]+'55';
+        }),
+        borderRadius: 4,
+      }]
+    },
+    options:{
+      responsive:true,
+      maintainAspectRatio:false,
+      scales:{x:{grid:{display:false}},y:{display:false}},
+      plugins:{
+        legend:{display:false},
+        tooltip:{callbacks:{label:function(ctx){return fmt(ctx.raw)}}}
+      },
+      onClick:function(_, elements){
+        if(!elements.length) return;
+        const m = trend[elements[0].index];
+        state.year = m.year;
+        state.month = m.month;
+        load();
       }
-    }catch(_){}
-    throw new Error(detail);
-  }
-  return r.json();
+    }
+  });
 }
 
 function render(data){
@@ -262,7 +790,11 @@ function render(data){
 
   if(!cats.length){
     html += '<div class="empty">Нет данных за выбранный месяц</div>';
+    if(trend.length){
+      html += '<div class="trend-wrap"><div class="trend-title">12 месяцев</div><canvas id="trend"></canvas></div>';
+    }
     app.innerHTML = html;
+    renderTrend();
   }else{
     html += '<div class="chart-wrap"><canvas id="chart"></canvas></div>';
     html += '<ul class="legend">';
@@ -277,7 +809,11 @@ function render(data){
       html += '</li>';
     });
     html += '</ul>';
+    if(trend.length){
+      html += '<div class="trend-wrap"><div class="trend-title">12 месяцев</div><canvas id="trend"></canvas></div>';
+    }
     app.innerHTML = html;
+    renderTrend();
 
     const ctx = document.getElementById('chart').getContext('2d');
     new Chart(ctx,{
@@ -321,17 +857,79 @@ function render(data){
 
 async function load(){
   const app = document.getElementById('app');
-  app.innerHTML='<div class="loading">Загрузка…</div>';
+  if(!monthCache[monthKey(state.year, state.month)]){
+    app.innerHTML='<div class="loading">Загрузка…</div>';
+  }
   try{
     const data = await fetchStats();
     render(data);
+    prefetchAround();
   }catch(e){
     app.innerHTML='<div class="error">Ошибка загрузки: '+e.message+'</div>';
   }
 }
 
-load();
+async function init(){
+  try{
+    trend = await fetchRange(state.year, state.month, 12);
+  }catch(_){
+    // The month view still works without the trend chart.
+  }
+  await load();
+}
+
+init();
 </script>
 </body>
 </html>
 """
+
+
+def chart_js_attrs(bundled: bool, sha256: str | None) -> str:
+    """Attributes of the Chart.js <script>: the bundled copy, or the CDN one pinned by hash."""
+    if bundled:
+        return f'src="/static/{CHART_JS_NAME}"'
+    attrs = f'src="{CHART_JS_CDN}" crossorigin="anonymous"'
+    if sha256:
+        integrity = base64.b64encode(bytes.fromhex(sha256)).decode()
+        attrs += f' integrity="sha256-{integrity}"'
+    return attrs
+
+
+# The Docker image bundles Chart.js (see Dockerfile); without it, use the CDN.
+chart_js_asset = (
+    StaticAsset(CHART_JS_PATH.read_bytes(), "text/javascript", IMMUTABLE_CACHE_CONTROL)
+    if CHART_JS_PATH.exists()
+    else None
+)
+stats_page_asset = StaticAsset(
+    STATS_HTML.replace(
+        "__CHART_JS_ATTRS__", chart_js_attrs(chart_js_asset is not None, settings.chart_js_sha256)
+    ).encode(),
+    "text/html; charset=utf-8",
+    PAGE_CACHE_CONTROL,
+)
+
+
+def run() -> None:
+    """
+    CLI entrypoint: uv run financier-web
+
+    Serves the Mini App in WEB_WORKERS processes of its own. They read the
+    store file kept in sync by the bot, so run the bot with
+    BOT_SERVE_WEBAPP=false and the same BOT_BACKEND_DATABASE_URL.
+    """
+    import uvicorn
+
+    uvicorn.run(
+        "src.webapp:app",
+        host=settings.bot_backend_host or "0.0.0.0",
+        port=settings.bot_backend_port or 8000,
+        workers=settings.web_workers,
+        log_level="info",
+        access_log=False,
+    )
+
+
+if __name__ == "__main__":
+    run()
@@ -1,10 +1,56 @@
 import asyncio
-from datetime import datetime
-from unittest.mock import MagicMock
+import base64
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import re
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+from datetime import date, datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+from urllib.parse import urlencode
 
+import gspread
 import pytest
+from fastapi.testclient import TestClient
+from loguru import logger
+from pydantic import SecretStr
 
+from src.services import columns, export, tenants, tracing
+from src.services.columns import ExpenseColumns
+from src.services.metrics import Histogram, Metric, sheets_request_seconds
+from src.services.month_index import MonthIndex, month_index
+from src.services.resilience import (
+    CircuitBreaker,
+    ResilientHTTPClient,
+    SheetsUnavailableError,
+    TokenBucket,
+    api_method,
+)
+from src.services.sheets import (
+    DATA_READ_OPTIONS,
+    SheetsSession,
+    data_version,
+    get_month_expenses,
+    get_range_totals,
+    read_data_rows,
+)
+from src.services.sheets_async import run_sheets_call
+from src.services.stats import ExpenseTotals, MonthStats, MonthStatsCache, month_stats_cache
+from src.services.store import ExpenseStore
+from src.services.sync import SheetSync
+from src.services.tenants import Tenant, TenantPool, TenantRegistry, use_tenant
+from src.services.write_queue import WriteBehindQueue
 from src.telegram.bot import Chat
+from src.telegram.parser import parse_expense
+from src.telegram.utils import format_pending, format_stats
+from src import webapp
+from benchmarks.sheets_emulator import SheetsEmulator
 
 
 class TestChatParsing:
@@ -15,90 +61,81 @@ class TestChatParsing:
         mock_msg.chat.id = 123456
         return Chat(mock_msg)
 
-    @pytest.mark.asyncio
-    async def test_basic_message(self, chat):
+    def test_basic_message(self, chat):
         """Test basic message with amount and category only"""
-        result = await chat._parse_message("450 кофе")
+        result = chat._parse_message("450 кофе")
 
         assert result["amount"] == 450.0
         assert result["category"] == "кофе"
         assert result["comment"] == ""
         assert result["date"] == datetime.now().strftime("%Y-%m-%d")
 
-    @pytest.mark.asyncio
-    async def test_message_with_comment_double_quotes(self, chat):
+    def test_message_with_comment_double_quotes(self, chat):
         """Test message with comment in double quotes"""
-        result = await chat._parse_message('500 Транспорт "Такси"')
+        result = chat._parse_message('500 Транспорт "Такси"')
 
         assert result["amount"] == 500.0
         assert result["category"] == "Транспорт"
         assert result["comment"] == "Такси"
         assert result["date"] == datetime.now().strftime("%Y-%m-%d")
 
-    @pytest.mark.asyncio
-    async def test_message_with_comment_single_quotes(self, chat):
+    def test_message_with_comment_single_quotes(self, chat):
         """Test message with comment in single quotes"""
-        result = await chat._parse_message("500 Транспорт 'Такси'")
+        result = chat._parse_message("500 Транспорт 'Такси'")
 
         assert result["amount"] == 500.0
         assert result["category"] == "Транспорт"
         assert result["comment"] == "Такси"
         assert result["date"] == datetime.now().strftime("%Y-%m-%d")
 
-    @pytest.mark.asyncio
-    async def test_message_with_comment_backticks(self, chat):
+    def test_message_with_comment_backticks(self, chat):
         """Test message with comment in backticks"""
-        result = await chat._parse_message("500 Транспорт `Такси`")
+        result = chat._parse_message("500 Транспорт `Такси`")
 
         assert result["amount"] == 500.0
         assert result["category"] == "Транспорт"
         assert result["comment"] == "Такси"
         assert result["date"] == datetime.now().strftime("%Y-%m-%d")
 
-    @pytest.mark.asyncio
-    async def test_message_with_comment_angle_brackets(self, chat):
+    def test_message_with_comment_angle_brackets(self, chat):
         """Test message with comment in angle brackets"""
-        result = await chat._parse_message("500 Транспорт <Такси>")
+        result = chat._parse_message("500 Транспорт <Такси>")
 
         assert result["amount"] == 500.0
         assert result["category"] == "Транспорт"
         assert result["comment"] == "Такси"
         assert result["date"] == datetime.now().strftime("%Y-%m-%d")
 
-    @pytest.mark.asyncio
-    async def test_message_with_date_dots(self, chat):
+    def test_message_with_date_dots(self, chat):
         """Test message with date in format DD.MM.YY"""
-        result = await chat._parse_message("450 кофе 01.09.25")
+        result = chat._parse_message("450 кофе 01.09.25")
 
         assert result["amount"] == 450.0
         assert result["category"] == "кофе"
         assert result["comment"] == ""
         assert result["date"] == "2025-09-01"
 
-    @pytest.mark.asyncio
-    async def test_message_with_date_slashes(self, chat):
+    def test_message_with_date_slashes(self, chat):
         """Test message with date in format DD/MM/YY"""
-        result = await chat._parse_message("450 кофе 01/09/25")
+        result = chat._parse_message("450 кофе 01/09/25")
 
         assert result["amount"] == 450.0
         assert result["category"] == "кофе"
         assert result["comment"] == ""
         assert result["date"] == "2025-09-01"
 
-    @pytest.mark.asyncio
-    async def test_message_with_date_hyphens(self, chat):
+    def test_message_with_date_hyphens(self, chat):
         """Test message with date in format DD-MM-YY"""
-        result = await chat._parse_message("450 кофе 01-09-25")
+        result = chat._parse_message("450 кофе 01-09-25")
 
         assert result["amount"] == 450.0
         assert result["category"] == "кофе"
         assert result["comment"] == ""
         assert result["date"] == "2025-09-01"
 
-    @pytest.mark.asyncio
-    async def test_message_with_short_date(self, chat):
+    def test_message_with_short_date(self, chat):
         """Test message with short date format DD.MM"""
-        result = await chat._parse_message("450 кофе 01.09")
+        result = chat._parse_message("450 кофе 01.09")
 
         assert result["amount"] == 450.0
         assert result["category"] == "кофе"
@@ -108,53 +145,1474 @@ class TestChatParsing:
         current_year = datetime.now().year
         assert result["date"] == f"{current_year}-09-01"
 
-    @pytest.mark.asyncio
-    async def test_message_with_date_and_comment(self, chat):
+    def test_message_with_date_and_comment(self, chat):
         """Test message with both date and comment"""
-        result = await chat._parse_message('450 кофе 01.09.25 "С коллегой"')
+        result = chat._parse_message('450 кофе 01.09.25 "С коллегой"')
 
         assert result["amount"] == 450.0
         assert result["category"] == "кофе"
         assert result["comment"] == "С коллегой"
         assert result["date"] == "2025-09-01"
 
-    @pytest.mark.asyncio
-    async def test_message_with_comment_and_date(self, chat):
+    def test_message_with_comment_and_date(self, chat):
         """Test message with comment first, then date"""
-        result = await chat._parse_message('450 кофе "С коллегой" 01.09.25')
+        result = chat._parse_message('450 кофе "С коллегой" 01.09.25')
 
         assert result["amount"] == 450.0
         assert result["category"] == "кофе"
         assert result["comment"] == "С коллегой"
         assert result["date"] == "2025-09-01"
 
-    @pytest.mark.asyncio
-    async def test_multi_word_category(self, chat):
+    def test_multi_word_category(self, chat):
         """Test message with multi-word category"""
-        result = await chat._parse_message("450 кофе с молоком")
+        result = chat._parse_message("450 кофе с молоком")
 
         assert result["amount"] == 450.0
         assert result["category"] == "кофе с молоком"
         assert result["comment"] == ""
         assert result["date"] == datetime.now().strftime("%Y-%m-%d")
 
-    @pytest.mark.asyncio
-    async def test_invalid_amount(self, chat):
+    def test_invalid_amount(self, chat):
         """Test message with invalid amount"""
         with pytest.raises(ValueError, match="Invalid amount"):
-            await chat._parse_message("abc кофе")
+            chat._parse_message("abc кофе")
 
-    @pytest.mark.asyncio
-    async def test_invalid_date(self, chat):
+    def test_invalid_date(self, chat):
         """Test message with invalid date"""
         with pytest.raises(ValueError, match="Invalid date format"):
-            await chat._parse_message("450 кофе 32.13.25")
+            chat._parse_message("450 кофе 32.13.25")
 
-    @pytest.mark.asyncio
-    async def test_incomplete_message(self, chat):
+    def test_incomplete_message(self, chat):
         """Test incomplete message with only amount"""
         with pytest.raises(ValueError, match="Message must contain at least amount and category"):
-            await chat._parse_message("450")
+            chat._parse_message("450")
+
+    def test_bulk_message(self, chat):
+        """Test multi-line message parsed one expense per line"""
+        expenses, errors = chat._parse_bulk('450 кофе 01.09.25\n\n500 Транспорт "Такси"\n')
+
+        assert errors == []
+        assert [(e["amount"], e["category"]) for e in expenses] == [
+            (450.0, "кофе"),
+            (500.0, "Транспорт"),
+        ]
+        assert expenses[0]["date"] == "2025-09-01"
+
+    def test_bulk_message_reports_every_bad_line(self, chat):
+        """Test that each invalid line of a bulk message is reported with its number"""
+        expenses, errors = chat._parse_bulk("450 кофе\nabc кофе\n450\n")
+
+        assert len(expenses) == 1
+        assert errors == [
+            "Line 2: Invalid amount: abc",
+            "Line 3: Message must contain at least amount and category",
+        ]
+
+
+PARSER_TODAY = date(2025, 9, 15)
+PARSER_AMOUNTS = [("450", 450.0), ("12.5", 12.5), ("1000", 1000.0)]
+PARSER_CATEGORIES = ["кофе", "кофе с молоком", "Транспорт"]
+PARSER_COMMENTS = [None, '"Такси"', "'Такси'", "`Такси`", "<Такси>", '"С коллегой"']
+PARSER_DATES = [
+    (None, "2025-09-15"),
+    ("01.09.25", "2025-09-01"),
+    ("01/09/25", "2025-09-01"),
+    ("01-09-25", "2025-09-01"),
+    ("1.9.2025", "2025-09-01"),
+    ("01.09", "2025-09-01"),
+    ("31.12.24", "2024-12-31"),
+]
+
+
+class TestExpenseParserProperties:
+    """Every combination of the grammar parts parses back to its parts, in any order"""
+
+    @pytest.mark.parametrize(
+        "amount,category,comment,date_part,comment_first",
+        list(
+            itertools.product(
+                PARSER_AMOUNTS, PARSER_CATEGORIES, PARSER_COMMENTS, PARSER_DATES, [False, True]
+            )
+        ),
+    )
+    def test_round_trip(self, amount, category, comment, date_part, comment_first):
+        tail = [part for part in (date_part[0], comment) if part]
+        if comment_first:
+            tail.reverse()
+        message = " ".join([amount[0], category, *tail])
+
+        result = parse_expense(message, PARSER_TODAY)
+
+        assert result == {
+            "amount": amount[1],
+            "category": category,
+            "date": date_part[1],
+            "comment": comment[1:-1] if comment else "",
+        }
+
+    @pytest.mark.parametrize("date_part", [d for d, _ in PARSER_DATES if d])
+    def test_date_before_amount(self, date_part):
+        result = parse_expense(f"{date_part} 450 кофе", PARSER_TODAY)
+
+        assert (result["amount"], result["category"]) == (450.0, "кофе")
+
+    def test_amount_looking_like_date(self):
+        result = parse_expense("1.5 кофе", PARSER_TODAY)
+
+        assert (result["amount"], result["date"]) == (1.5, "2025-09-15")
+
+    def test_only_date_token_removed(self):
+        """The old replace() also cut the date text out of the category"""
+        result = parse_expense("450 кофе01.09 01.09", PARSER_TODAY)
+
+        assert result["category"] == "кофе01.09"
+        assert result["date"] == "2025-09-01"
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class TestSheetsSession:
+    @pytest.fixture
+    def session(self):
+        creds = MagicMock(token=None, expiry=None)
+
+        def refresh(_request):
+            creds.token = "token"
+            creds.expiry = utcnow() + timedelta(hours=1)
+
+        creds.refresh.side_effect = refresh
+        with (
+            patch("src.services.sheets.credentials_from_inline_json", return_value=creds),
+            patch("src.services.sheets.gspread.authorize") as authorize,
+        ):
+            yield SheetsSession("{}", "sheet-id"), authorize
+
+    def test_client_and_handles_are_reused(self, session):
+        """Test that repeated lookups reuse the client, spreadsheet and worksheets"""
+        sheets, authorize = session
+
+        first = sheets.worksheet("data")
+        second = sheets.worksheet("data")
+
+        assert first is second
+        authorize.assert_called_once()
+        authorize.return_value.open_by_key.assert_called_once_with("sheet-id")
+        # second lookup skips token fetch, open_by_key and worksheet metadata
+        assert sheets.saved_requests == 3
+
+    def test_token_refreshed_before_expiry(self, session):
+        """Test that a token close to expiry is refreshed proactively"""
+        sheets, _ = session
+        sheets.worksheet("data")
+        sheets._credentials.expiry = utcnow() + timedelta(seconds=10)
+
+        sheets.worksheet("data")
+
+        assert sheets._credentials.refresh.call_count == 2
+
+    def test_first_data_row_cached(self, session):
+        """Test that service!B2 is read once and reused until invalidated"""
+        sheets, authorize = session
+        service_ws = authorize.return_value.open_by_key.return_value.worksheet.return_value
+        service_ws.acell.return_value.value = "7"
+
+        assert sheets.first_data_row() == 7
+        assert sheets.first_data_row() == 7
+        service_ws.acell.assert_called_once_with("B2")
+
+        sheets.invalidate_first_data_row()
+        assert sheets.first_data_row() == 7
+        assert service_ws.acell.call_count == 2
+
+    def test_stale_first_data_row_repaired_on_read(self):
+        """Test that a read noticing a moved header re-reads the pointer"""
+        sheets = MagicMock()
+        sheets.first_data_row.side_effect = [7, 8]
+        data_ws = MagicMock()
+        data_ws.get.side_effect = [
+            [["", "", ""], ["Дата", "Категория", "Сумма"], ["01.09.2025", "кофе", "450"]],
+            [["Дата", "Категория", "Сумма"], ["01.09.2025", "кофе", "450"]],
+        ]
+
+        rows = read_data_rows(sheets, data_ws, 2)
+
+        assert rows == [["01.09.2025", "кофе", "450"]]
+        sheets.invalidate_first_data_row.assert_called_once()
+        data_ws.get.assert_called_with("A7:D9", **DATA_READ_OPTIONS)
+
+
+class TestSheetsAsync:
+    @pytest.mark.asyncio
+    async def test_blocking_call_does_not_stall_loop(self):
+        """Test that the event loop keeps running while a Sheets call blocks"""
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(ticker())
+        result = await run_sheets_call(lambda: time.sleep(0.2) or "done")
+        task.cancel()
+
+        assert result == "done"
+        assert ticks >= 5
+
+    @pytest.mark.asyncio
+    async def test_timeout(self):
+        """Test that slow calls raise TimeoutError instead of hanging"""
+
+        def slow_call():
+            time.sleep(0.3)
+
+        with pytest.raises(TimeoutError, match="slow_call timed out"):
+            await run_sheets_call(slow_call, timeout=0.05)
+
+    @pytest.mark.asyncio
+    async def test_store_reads_skip_the_sheets_pool(self):
+        """Test that reads the store answers run off the loop without waiting for Sheets calls"""
+        from src.services import sheets, sheets_async
+
+        store = ExpenseStore(":memory:")
+        store.replace_all([(date(2025, 9, 3), "кофе", 450.0, "")])
+        threads = []
+        month_stats = sheets.get_month_stats
+
+        def get_month_stats(year, month):
+            threads.append(threading.current_thread().name)
+            return month_stats(year, month)
+
+        with (
+            patch("src.services.sheets.get_store", return_value=store),
+            patch("src.services.sheets_async.get_store", return_value=store),
+            patch.object(sheets, "get_month_stats", get_month_stats),
+        ):
+            busy = [
+                asyncio.create_task(run_sheets_call(time.sleep, 0.3))
+                for _ in range(sheets_async.settings.sheets_max_workers)
+            ]
+            await asyncio.sleep(0.05)
+            started = time.monotonic()
+            assert await sheets_async.data_version() == store.data_version()
+            assert (await sheets_async.get_month_stats(2025, 9)).total == 450.0
+            waited = time.monotonic() - started
+            await asyncio.gather(*busy)
+        sheets_async.get_stats_cache().clear()
+        store.close()
+
+        assert waited < 0.2
+        assert threads and all(name.startswith("store") for name in threads)
+
+
+class TestExpenseStore:
+    @pytest.fixture
+    def store(self):
+        store = ExpenseStore(":memory:")
+        store.replace_all(
+            [
+                (date(2025, 9, 2), "кофе", 450.0, ""),
+                (date(2025, 9, 1), "Транспорт", 500.0, "Такси"),
+                (date(2025, 8, 31), "кофе", 300.0, ""),
+            ]
+        )
+        yield store
+        store.close()
+
+    def test_recent_newest_first(self, store):
+        """Test that recent rows come newest first and a new row goes on top"""
+        store.add(date(2025, 8, 15), "еда", 1200.5, "ужин")
+
+        recent = store.recent(2)
+
+        assert recent == [
+            {"date": "15.08.2025", "category": "еда", "amount": "1200.5", "comment": "ужин"},
+            {"date": "02.09.2025", "category": "кофе", "amount": "450", "comment": ""},
+        ]
+
+    def test_month(self, store):
+        """Test that a month query returns only rows of that month"""
+        expenses = store.month(2025, 9)
+
+        assert [e["amount"] for e in expenses] == [450.0, 500.0]
+        assert store.month(2025, 12) == []
+
+    def test_range_totals(self, store):
+        """Test that a span of months is aggregated per month and category"""
+        store.add(date(2025, 9, 3), "кофе", 50.0)
+        with patch("src.services.sheets.get_store", return_value=store):
+            totals = get_range_totals(2025, 10, 3)
+
+        assert totals == {
+            (2025, 8): {"кофе": 300.0},
+            (2025, 9): {"кофе": 500.0, "Транспорт": 500.0},
+            (2025, 10): {},
+        }
+
+    def test_replace_all_skipped_after_concurrent_write(self, store):
+        """Test that a reconciliation snapshot older than a local write is discarded"""
+        generation = store.generation
+        store.add(date(2025, 9, 3), "кофе", 100.0)
+
+        assert store.replace_all([], expected_generation=generation) is None
+        assert len(store.month(2025, 9)) == 3
+
+    def test_replace_all_reports_changed_months(self, store):
+        """Test that reconciliation reports exactly the months whose rows changed"""
+        changed = store.replace_all(
+            [
+                (date(2025, 9, 2), "кофе", 450.0, ""),
+                (date(2025, 9, 1), "Транспорт", 500.0, "Такси"),
+                (date(2025, 8, 31), "кофе", 350.0, ""),
+            ]
+        )
+
+        assert changed == {(2025, 8)}
+        assert store.month_stats(2025, 8).categories == [("кофе", 350.0)]
+        assert store.month_stats(2025, 9).total == 950.0
+
+    def test_refresh_picks_up_writes_of_another_process(self, tmp_path):
+        """Test that a second store on the same file reloads only the months another one changed"""
+        path = str(tmp_path / "store.sqlite3")
+        bot, web = ExpenseStore(path), ExpenseStore(path)
+        try:
+            assert web.refresh() == set()
+            bot.replace_all([(date(2025, 8, 31), "кофе", 300.0, "")])
+            bot.add(date(2025, 9, 2), "кофе", 450.0)
+
+            assert web.refresh() == {(2025, 8), (2025, 9)}
+            assert web.is_synced() and web.data_version() == bot.data_version()
+            assert web.month_stats(2025, 9).total == 450.0
+            assert web.refresh() == set()
+
+            bot.add(date(2025, 9, 3), "кофе", 50.0)
+            with patch("src.services.sheets.get_store", return_value=web):
+                month_stats_cache.put(web.month_stats(2025, 9), month_stats_cache.version(2025, 9))
+                assert data_version() == bot.data_version()
+            assert month_stats_cache.get(2025, 9) is None
+            assert web.month_stats(2025, 9).total == 500.0
+        finally:
+            bot.close()
+            web.close()
+
+
+class TestMonthStatsCache:
+    @pytest.fixture
+    def cache(self):
+        return MonthStatsCache(max_entries=2, current_ttl_seconds=60, past_ttl_seconds=3600)
+
+    @staticmethod
+    def stats(year, month):
+        totals = ExpenseTotals()
+        totals.add_rows(
+            [
+                (date(year, month, 1), "кофе", 450.0, ""),
+                (date(year, month, 1), "Транспорт", 500.0, ""),
+                (date(year, month, 3), "кофе", 100.0, ""),
+                (date(year, month, 3), "", 50.0, ""),
+            ]
+        )
+        return totals.month(year, month)
+
+    def test_totals(self):
+        """Test that category totals are summed and sorted largest first"""
+        stats = self.stats(2025, 9)
+
+        assert stats.categories == [("кофе", 550.0), ("Транспорт", 500.0)]
+        assert (stats.total, stats.count, stats.days, stats.per_day) == (1100.0, 4, 2, 550.0)
+        assert "💰 Всего: 1100" in format_stats(stats)
+        assert "• кофе - 550" in format_stats(stats)
+
+    def test_hit_miss_and_invalidation(self, cache):
+        """Test hit/miss accounting and that invalidation drops only that month"""
+        cache.put(self.stats(2025, 9), cache.version(2025, 9))
+        cache.put(self.stats(2025, 8), cache.version(2025, 8))
+
+        assert cache.get(2025, 9) is not None
+        cache.invalidate(2025, 9)
+        assert cache.get(2025, 9) is None
+        assert cache.get(2025, 8) is not None
+        assert (cache.hits, cache.misses) == (2, 1)
+
+    def test_outdated_put_ignored(self, cache):
+        """Test that a result computed before an invalidation is not stored"""
+        version = cache.version(2025, 9)
+        cache.invalidate(2025, 9)
+
+        cache.put(self.stats(2025, 9), version)
+
+        assert cache.get(2025, 9) is None
+
+    def test_lru_bound(self, cache):
+        """Test that the least recently used month is evicted"""
+        for month in (7, 8, 9):
+            cache.put(self.stats(2025, month), cache.version(2025, month))
+
+        assert cache.get(2025, 7) is None
+        assert cache.get(2025, 9) is not None
+
+
+class FakeDataWorksheet:
+    """Data worksheet kept as a list of rows; header at row 6, data from row 7."""
+
+    def __init__(self, rows):
+        self.rows = [[] for _ in range(5)] + [["Дата", "Категория", "Сумма", "Комментарий"]]
+        self.rows += [list(row) for row in rows]
+        self.requests = 0
+
+    @property
+    def row_count(self):
+        return len(self.rows) + 100  # grid rows, with empty ones below the table
+
+    def _get(self, range_name):
+        start, end = (int(n) for n in re.findall(r"\d+", range_name))
+        values = [list(row) for row in self.rows[start - 1 : end]]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def get(self, range_name, **options):
+        assert options == DATA_READ_OPTIONS
+        self.requests += 1
+        return self._get(range_name)
+
+    def batch_get(self, ranges, **options):
+        assert options == DATA_READ_OPTIONS
+        self.requests += 1
+        return [self._get(r) for r in ranges]
+
+    def insert_top(self, row):
+        self.rows.insert(6, list(row))
+
+
+class TestSheetSync:
+    @pytest.fixture
+    def env(self):
+        data_ws = FakeDataWorksheet(
+            [
+                ["03.09.2025", "кофе", "450", ""],
+                ["02.09.2025", "Транспорт", "500", "Такси"],
+                ["01.09.2025", "кофе", "300"],
+            ]
+        )
+        session = MagicMock()
+        session.worksheet.return_value = data_ws
+        session.first_data_row.return_value = 7
+        store = ExpenseStore(":memory:")
+        with (
+            patch("src.services.sync.get_session", return_value=session),
+            patch("src.services.sync.get_store", return_value=store),
+        ):
+            sync = SheetSync(window_rows=10)
+            sync.sync()
+            data_ws.requests = 0
+            yield sync, data_ws, store
+        store.close()
+
+    def test_unchanged_sheet_costs_one_request(self, env):
+        """Test that a sync with nothing new only reads the head window and boundary"""
+        sync, data_ws, store = env
+
+        version = store.data_version()
+        with patch.object(store, "_month_digests", side_effect=AssertionError("full scan")):
+            assert sync.sync() == 0
+        assert data_ws.requests == 1
+        assert store.count() == 3 and store.data_version() == version
+
+    def test_prepend_changes_only_the_new_rows_months(self, env):
+        """Test that new rows mark their own months changed without hashing the table"""
+        sync, data_ws, store = env
+        data_ws.insert_top(["01.10.2025", "еда", "100", ""])
+
+        with patch.object(store, "_month_digests", side_effect=AssertionError("full scan")):
+            assert sync.sync() == 1
+        assert store.month_stats(2025, 10).total == 100.0
+        assert store.month_stats(2025, 9).total == 1250.0
+
+    def test_new_rows_at_top_are_fetched(self, env):
+        """Test that rows added in the spreadsheet are prepended to the store"""
+        sync, data_ws, store = env
+        data_ws.insert_top(["04.09.2025", "еда", "1 200,50", ""])
+        data_ws.insert_top(["05.09.2025", "кофе", "200", ""])
+
+        assert sync.sync() == 2
+        assert data_ws.requests == 2
+        assert [row[2] for row in store.newest(5)] == [200.0, 1200.5, 450.0, 500.0, 300.0]
+
+    def test_serial_dates_read_and_unreadable_rows_reported(self, env):
+        """Test that unformatted serial dates are understood and bad dates are reported"""
+        sync, data_ws, store = env
+        serial = date(2025, 9, 5).toordinal() - date(1899, 12, 30).toordinal()
+        data_ws.insert_top(["5 сент", "кофе", 100, ""])
+        data_ws.insert_top([serial, "еда", 250.5, ""])
+
+        with patch("src.services.sheets.logger") as log:
+            assert sync.sync() == 1
+
+        assert store.newest(1) == [(date(2025, 9, 5), "еда", 250.5, "")]
+        log.warning.assert_called_once()
+        assert "skipped 1 rows" in log.warning.call_args[0][0]
+
+    def test_written_through_rows_are_not_duplicated(self, env):
+        """Test that a row appended by the bot is not fetched again"""
+        sync, data_ws, store = env
+        data_ws.insert_top(["04.09.2025", "еда", "100", ""])
+        store.add(date(2025, 9, 4), "еда", 100.0)
+
+        assert sync.sync() == 0
+        assert store.count() == 4
+
+    def test_edited_boundary_triggers_full_sync(self, env):
+        """Test that a changed oldest row falls back to a full re-read"""
+        sync, data_ws, store = env
+        data_ws.rows[-1] = ["01.09.2025", "кофе", "350"]
+
+        sync.sync()
+
+        assert [row[2] for row in store.newest(5)] == [450.0, 500.0, 350.0]
+
+
+class TestSheetsEmulator:
+    TENANT = Tenant("bench", "emulated", frozenset({1}))
+
+    @pytest.fixture
+    def tenant(self, tmp_path):
+        with (
+            patch("src.services.tenants.tenant_pool", TenantPool(max_size=1)),
+            patch.object(tenants.settings, "tenant_data_dir", str(tmp_path)),
+            use_tenant(self.TENANT) as state,
+        ):
+            yield state
+        state.close()
+
+    def test_session_round_trip(self, tenant):
+        """Test that reads, inserts and a store sync work unchanged against the emulator"""
+        from src.services import sheets, sync
+
+        emulator = SheetsEmulator(
+            [[date(2025, 9, 2), "кофе", 450.0, ""], [date(2025, 8, 30), "еда", 1200.0, ""]]
+        )
+        tenant.session = emulator.sheets_session()
+
+        assert sheets.get_month_stats(2025, 9).total == 450.0
+        sheets.append_expense(
+            {"date": "2025-09-03", "category": "Транспорт", "amount": 500, "comment": "Такси"}
+        )
+        assert emulator.data_rows()[0] == [date(2025, 9, 3), "Транспорт", 500, "Такси"]
+        assert sheets.get_month_stats(2025, 9).total == 950.0
+        assert emulator.calls["values.append"] == 1
+
+        assert sync.sync_store() == 3
+        assert tenants.get_store().month_stats(2025, 8).total == 1200.0
+
+    def test_sync_pages_through_tables_longer_than_a_page(self, tenant):
+        """Test that a full sync mirrors every row and the next sync stays incremental"""
+        emulator = SheetsEmulator.with_expenses(100, seed=5)
+        tenant.session = emulator.sheets_session()
+        sheet_sync = SheetSync(window_rows=10, page_rows=40)
+        oldest = emulator.data_rows()[-1][0]
+        in_oldest_month = [
+            row
+            for row in emulator.data_rows()
+            if (row[0].year, row[0].month) == (oldest.year, oldest.month)
+        ]
+
+        assert sheet_sync.sync() == 100
+        store = tenants.get_store()
+        assert store.month_stats(oldest.year, oldest.month).count == len(in_oldest_month)
+
+        emulator.sheets["data"].rows.insert(1, [date.today(), "кофе", 450.0, ""])
+        emulator.calls.clear()
+        assert sheet_sync.sync() == 1
+        assert sheet_sync.sync() == 0
+        assert store.count() == 101
+        # head windows in batchGet, one get for the moved boundary: no full re-read
+        assert emulator.calls["values.get"] == 1
+
+    def test_quota_answers_429(self, tenant):
+        """Test that requests over the per-minute quota are rejected like Google does"""
+        from src.services import sheets
+
+        emulator = SheetsEmulator.with_expenses(10, requests_per_minute=1)
+        tenant.session = emulator.sheets_session(read_attempts=1)
+
+        with pytest.raises(gspread.exceptions.APIError, match="429"):
+            sheets.get_recent_expenses()
+        assert emulator.rejected[429] == 1
+
+    def test_export_reads_the_sheet_in_pages(self, tenant):
+        """Test that an export before the store is synced reads the sheet a page at a time"""
+        emulator = SheetsEmulator.with_expenses(10, seed=3)
+        tenant.session = emulator.sheets_session()
+        expected = [row for row in emulator.data_rows() if row[1] == "кофе"]
+
+        with patch.object(export.settings, "export_page_rows", 4):
+            chunks = list(export.encode("csv", export.build_query(categories=["Кофе"])))
+
+        lines = b"".join(chunks).decode("utf-8-sig").splitlines()
+        assert lines[0] == "Дата,Категория,Сумма,Комментарий"
+        assert [line.split(",")[0] for line in lines[1:]] == [r[0].isoformat() for r in expected]
+        assert emulator.calls["values.get"] == 1 + 3  # service!B2, then three pages of four rows
+
+    def test_range_totals_read_past_the_first_page(self, tenant):
+        """Test that range totals before the store is synced cover rows beyond one read"""
+        from src.services import sheets
+
+        emulator = SheetsEmulator.with_expenses(30, seed=5)
+        tenant.session = emulator.sheets_session()
+        rows = emulator.data_rows()
+        newest, oldest = rows[0][0], min(row[0] for row in rows)
+        months = (newest.year - oldest.year) * 12 + newest.month - oldest.month + 1
+        expected = {}
+        for expense_date, category, amount, _ in rows:
+            month = expected.setdefault((expense_date.year, expense_date.month), {})
+            month[category] = month.get(category, 0.0) + amount
+
+        with patch.object(sheets, "PAGE_ROWS", 8):
+            totals = sheets.get_range_totals(newest.year, newest.month, months)
+
+        assert {key: value for key, value in totals.items() if value} == expected
+        assert emulator.calls["values.get"] == 1 + 4  # service!B2, then four pages of eight rows
+
+
+class TestExport:
+    ROWS = [
+        (date(2025, 9, 3), "кофе", 450.0, ""),
+        (date(2025, 9, 2), "Транспорт", 500.0, "Такси, ночью"),
+        (date(2025, 8, 31), "кофе", 300.5, ""),
+        (date(2025, 8, 1), "еда", 1200.0, "<обед> & ужин"),
+    ]
+
+    @pytest.fixture
+    def store(self):
+        store = ExpenseStore(":memory:")
+        store.replace_all(self.ROWS)
+        with (
+            patch("src.services.export.get_store", return_value=store),
+            patch("src.services.sheets.refresh_from_store"),
+            patch.object(export.settings, "export_page_rows", 1),
+        ):
+            yield store
+        store.close()
+
+    def test_parse_args(self):
+        """Test that /export arguments give the format, the period and the categories"""
+        assert export.parse_args([]) == ("csv", export.ExportQuery())
+        assert export.parse_args(["XLSX", "2025-02", "кофе,", "Бытовая", "химия"]) == (
+            "xlsx",
+            export.ExportQuery(
+                date(2025, 2, 1), date(2025, 2, 28), frozenset({"кофе", "бытовая химия"})
+            ),
+        )
+        assert export.parse_args(["2024", "2025-03-05"])[1] == export.ExportQuery(
+            date(2024, 1, 1), date(2025, 3, 5)
+        )
+        with pytest.raises(ValueError, match="after end"):
+            export.parse_args(["2025", "2024"])
+
+    def test_csv_streams_filtered_rows_page_by_page(self, store):
+        """Test that the CSV comes out one chunk per page of matching rows"""
+        query = export.build_query(start=date(2025, 8, 15), categories=["КОФЕ", "транспорт"])
+
+        chunks = list(export.encode("csv", query))
+
+        assert len(chunks) == 3
+        assert b"".join(chunks).decode("utf-8-sig").splitlines() == [
+            "Дата,Категория,Сумма,Комментарий",
+            "2025-09-03,кофе,450,",
+            '2025-09-02,Транспорт,500,"Такси, ночью"',
+            "2025-08-31,кофе,300.5,",
+        ]
+
+    def test_xlsx_is_a_workbook_with_typed_cells(self, store):
+        """Test that the streamed XLSX is a valid zip whose sheet holds dates and numbers"""
+        data = b"".join(export.encode("xlsx", export.build_query(end=date(2025, 8, 31))))
+
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        assert archive.testzip() is None
+        assert "xl/styles.xml" in archive.namelist()
+        ns = {"s": "http://schemas.openxmlformats.org/spreadsheetml/2006/main"}
+        sheet = ET.fromstring(archive.read("xl/worksheets/sheet1.xml"))
+        rows = [
+            [
+                cell.findtext("s:v", namespaces=ns) or cell.findtext("s:is/s:t", namespaces=ns)
+                for cell in row
+            ]
+            for row in sheet.iterfind("s:sheetData/s:row", ns)
+        ]
+        serial = date(2025, 8, 1).toordinal() - date(1899, 12, 30).toordinal()
+        assert rows == [
+            ["Дата", "Категория", "Сумма", "Комментарий"],
+            [str(serial + 30), "кофе", "300.5", ""],
+            [str(serial), "еда", "1200", "<обед> & ужин"],
+        ]
+
+
+class TestExpenseColumns:
+    ROWS = [
+        (date(2025, 9, 2), "кофе", 450.0, ""),
+        (date(2025, 9, 2), "Транспорт", 500.0, "Такси"),
+        (date(2025, 9, 1), "", 50.0, ""),
+        (date(2025, 8, 31), "кофе", 350.0, ""),
+        (date(2025, 6, 10), "Кафе", 900.0, ""),
+        (date(2024, 9, 1), "кофе", 100.0, ""),
+    ]
+
+    @pytest.fixture(params=["numpy", "array"])
+    def table(self, request):
+        if request.param == "numpy" and columns.np is None:
+            pytest.skip("numpy is not installed")
+        backend = columns.np if request.param == "numpy" else None
+        with patch.object(columns, "np", backend):
+            yield ExpenseColumns.from_rows(self.ROWS)
+
+    def test_month_stats_match_running_totals(self, table):
+        """Test that columnar month stats equal the ExpenseTotals ones"""
+        totals = ExpenseTotals()
+        totals.add_rows(self.ROWS)
+
+        for year, month in [(2025, 9), (2025, 8), (2025, 7), (2024, 9)]:
+            assert table.month_stats(year, month) == totals.month(year, month)
+
+    def test_range_and_top_categories(self, table):
+        """Test month-by-category totals over a span and the top-N categories"""
+        months = [(2025, 7), (2025, 8), (2025, 9)]
+
+        assert table.month_category_totals(months) == {
+            (2025, 7): {},
+            (2025, 8): {"кофе": 350.0},
+            (2025, 9): {"кофе": 450.0, "Транспорт": 500.0},
+        }
+        assert table.top_categories((2025, 6), (2025, 9), 2) == [("Кафе", 900.0), ("кофе", 800.0)]
+
+
+class TestMonthIndex:
+    def test_row_ranges(self):
+        """Test that months map to sheet row ranges, including backdated rows"""
+        index = MonthIndex()
+        assert index.locate(2025, 9, first_data_row=7) is None
+        index.build([date(2025, 9, 2), date(2025, 8, 30), date(2025, 9, 1), date(2025, 8, 1)])
+
+        assert index.locate(2025, 9, first_data_row=7) == ([(7, 7), (9, 9)], 10)
+        assert index.locate(2025, 8, first_data_row=7) == ([(8, 8), (10, 10)], 10)
+
+        index.note_insert(date(2025, 9, 3))
+
+        assert index.locate(2025, 9, first_data_row=7) == ([(7, 8), (10, 10)], 11)
+        assert index.locate(2025, 7, first_data_row=7) == ([], 11)
+
+    def test_month_read_fetches_only_its_rows(self):
+        """Test that a month query reads only that month's slice from the sheet"""
+        data_ws = FakeDataWorksheet(
+            [
+                ["02.10.2025", "кофе", "100"],
+                ["03.09.2025", "кофе", "450"],
+                ["02.09.2025", "Транспорт", "500", "Такси"],
+                ["31.08.2025", "кофе", "300"],
+            ]
+        )
+        session = MagicMock()
+        session.worksheet.return_value = data_ws
+        session.first_data_row.return_value = 7
+        month_index.invalidate()
+        with (
+            patch("src.services.sheets.get_session", return_value=session),
+            patch("src.services.sheets.get_store", return_value=ExpenseStore(":memory:")),
+        ):
+            expenses = get_month_expenses(2025, 9)
+            # an expense added outside the bot shifts every row down
+            data_ws.insert_top(["03.10.2025", "кофе", "50"])
+            shifted = get_month_expenses(2025, 9)
+
+        assert [e["amount"] for e in expenses] == [450.0, 500.0]
+        assert shifted == expenses
+        month_index.invalidate()
+
+    def test_month_read_never_returns_misaligned_rows(self):
+        """Test that an index still wrong after a rebuild gives way to a read of every row"""
+        data_ws = FakeDataWorksheet(
+            [
+                ["02.10.2025", "кофе", "100"],
+                ["03.09.2025", "кофе", "450"],
+                ["31.08.2025", "кофе", "300"],
+            ]
+        )
+        session = MagicMock()
+        session.worksheet.return_value = data_ws
+        session.first_data_row.return_value = 7
+        with (
+            patch("src.services.sheets.get_session", return_value=session),
+            patch("src.services.sheets.get_store", return_value=ExpenseStore(":memory:")),
+            # stale on every rebuild: points at the October row
+            patch.object(month_index, "locate", return_value=([(7, 8)], 9)),
+        ):
+            expenses = get_month_expenses(2025, 9)
+
+        assert [e["amount"] for e in expenses] == [450.0]
+        month_index.invalidate()
+
+
+class TestResilience:
+    @staticmethod
+    def response(status):
+        response = MagicMock(ok=status < 400, status_code=status)
+        response.json.return_value = {"error": {"code": status, "message": "x", "status": "X"}}
+        return response
+
+    @pytest.fixture
+    def client(self):
+        return ResilientHTTPClient(
+            MagicMock(),
+            MagicMock(),
+            bucket=TokenBucket(rate_per_minute=6000, burst=100),
+            breaker=CircuitBreaker(failure_threshold=3, reset_seconds=60),
+            read_attempts=3,
+            max_backoff_seconds=0.01,
+        )
+
+    def test_reads_retried_writes_not(self, client):
+        """Test that a GET is retried on 503 while a POST is attempted once"""
+        client.session.request.side_effect = [self.response(503), self.response(200)]
+        assert client.request("get", "https://sheets/values").status_code == 200
+        assert client.retries == 1
+
+        client.session.request.side_effect = [self.response(503)]
+        with pytest.raises(gspread.exceptions.APIError):
+            client.request("post", "https://sheets/batchUpdate")
+        assert client.session.request.call_count == 3
+
+    def test_breaker_opens_and_recovers(self, client):
+        """Test that repeated failures short-circuit requests until a trial succeeds"""
+        client.session.request.return_value = self.response(429)
+        with pytest.raises(gspread.exceptions.APIError):
+            client.request("get", "https://sheets/values")
+        assert client.breaker.is_open
+
+        with pytest.raises(SheetsUnavailableError):
+            client.request("get", "https://sheets/values")
+        assert client.session.request.call_count == 3
+
+        client.session.request.return_value = self.response(200)
+        with patch("src.services.resilience.time.monotonic", return_value=time.monotonic() + 61):
+            client.request("get", "https://sheets/values")
+        assert not client.breaker.is_open
+
+    def test_token_bucket_paces_requests(self):
+        """Test that requests beyond the burst wait for tokens at the configured rate"""
+        bucket = TokenBucket(rate_per_minute=60, burst=2)
+        with patch("src.services.resilience.time.sleep") as sleep:
+            for _ in range(4):
+                bucket.acquire()
+
+        assert [round(c.args[0]) for c in sleep.call_args_list] == [1, 2]
+
+    def test_requests_timed_by_api_method(self, client):
+        """Test that every attempt is recorded under its Sheets API method and status"""
+        base = "https://sheets.googleapis.com/v4/spreadsheets/abc"
+        assert api_method("get", f"{base}/values/data%21A1%3AG9") == "values.get"
+        assert api_method("put", f"{base}/values/data%21A2") == "values.update"
+        assert api_method("get", f"{base}/values:batchGet") == "values.batchGet"
+        assert api_method("post", f"{base}:batchUpdate") == "spreadsheets.batchUpdate"
+        assert api_method("get", base) == "spreadsheets.get"
+
+        before_503 = sheets_request_seconds.count(method="values.get", status="503")
+        before_200 = sheets_request_seconds.count(method="values.get", status="200")
+        client.session.request.side_effect = [self.response(503), self.response(200)]
+        client.request("get", f"{base}/values/data%21A1")
+
+        assert sheets_request_seconds.count(method="values.get", status="503") == before_503 + 1
+        assert sheets_request_seconds.count(method="values.get", status="200") == before_200 + 1
+
+
+class TestMetrics:
+    def test_histogram_renders_cumulative_buckets(self):
+        """Test that histograms render cumulative buckets, sum and count per label set"""
+        histogram = Histogram("t_seconds", "Test", ("handler",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 3.0):
+            histogram.observe(value, handler="on_stats")
+
+        assert histogram.render().splitlines() == [
+            "# HELP t_seconds Test",
+            "# TYPE t_seconds histogram",
+            't_seconds_bucket{handler="on_stats",le="0.1"} 1',
+            't_seconds_bucket{handler="on_stats",le="1"} 3',
+            't_seconds_bucket{handler="on_stats",le="+Inf"} 4',
+            't_seconds_sum{handler="on_stats"} 4.05',
+            't_seconds_count{handler="on_stats"} 4',
+        ]
+
+    def test_metric_without_samples_cannot_be_created(self):
+        """Test that a metric kind missing samples() fails when created, not when scraped"""
+
+        class Summary(Metric):
+            kind = "summary"
+
+        with pytest.raises(TypeError, match="samples"):
+            Summary("t_summary", "Test")
+
+
+class TestTracing:
+    @pytest.mark.asyncio
+    async def test_spans_follow_sheets_calls_into_worker_threads(self):
+        """Test that a Sheets call shows as a span with its worker part, logging the trace id"""
+        records = []
+        sink = logger.add(lambda m: records.append(m.record["extra"].get("trace_id")))
+
+        def read_rows():
+            with tracing.span("values.get"):
+                logger.info("reading")
+
+        finished = []
+        try:
+            with patch("src.services.tracing._report", finished.append):
+                with tracing.trace("update") as trace_id:
+                    with tracing.span("parse"):
+                        pass
+                    await run_sheets_call(read_rows)
+        finally:
+            logger.remove(sink)
+
+        assert records == [trace_id]
+        tree = tracing.format_tree(finished[0].root).splitlines()
+        assert [re.sub(r" \d+ ms @\d+$", "", line) for line in tree] == [
+            "update",
+            "  parse",
+            "  sheets.read_rows",
+            "    worker",
+            "      values.get",
+        ]
+
+    def test_slow_trace_writes_folded_profile(self, tmp_path):
+        """Test that a trace over the profiling threshold leaves a folded-stack profile"""
+
+        def crunch_numbers():
+            deadline = time.perf_counter() + 0.1
+            while time.perf_counter() < deadline:
+                pass
+
+        with (
+            patch.object(tracing.settings, "profile_slow_ms", 50),
+            patch.object(tracing.settings, "profile_interval_ms", 1),
+            patch.object(tracing.settings, "profile_dir", str(tmp_path)),
+        ):
+            with tracing.trace("fast"):
+                pass
+            with tracing.trace("slow") as trace_id:
+                crunch_numbers()
+
+        [profile] = tmp_path.iterdir()
+        assert trace_id in profile.name
+        lines = profile.read_text().splitlines()
+        assert all(re.fullmatch(r"slow;\S.* \d+", line) for line in lines)
+        assert any(".crunch_numbers " in line for line in lines)
+
+
+class TestWriteBehindQueue:
+    @staticmethod
+    def expense(amount):
+        return {"date": "2025-09-01", "category": "кофе", "amount": amount, "comment": ""}
+
+    @staticmethod
+    async def drain(queue):
+        worker = asyncio.create_task(queue.run())
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if not queue.depth():
+                break
+        worker.cancel()
+
+    @pytest.mark.asyncio
+    async def test_burst_is_coalesced(self, tmp_path):
+        """Test that submissions return at once and are written together with one sheet call"""
+        calls = []
+
+        async def flush(expenses):
+            calls.append([e["amount"] for e in expenses])
+
+        queue = WriteBehindQueue(flush, str(tmp_path / "outbox.sqlite3"), window_seconds=0.02)
+
+        assert all(queue.submit(self.expense(a)) for a in (1.0, 2.0, 3.0))
+        assert calls == [] and queue.depth() == 3
+        await self.drain(queue)
+
+        assert calls == [[1.0, 2.0, 3.0]]
+        assert queue.depth() == 0
+
+    @pytest.mark.asyncio
+    async def test_duplicate_key_queued_once(self, tmp_path):
+        """Test that a redelivered submission with the same key is ignored, even once written"""
+        calls = []
+
+        async def flush(expenses):
+            calls.append([e["amount"] for e in expenses])
+
+        queue = WriteBehindQueue(flush, str(tmp_path / "outbox.sqlite3"), window_seconds=0.01)
+
+        assert queue.submit(self.expense(1.0), key="42:7")
+        assert not queue.submit(self.expense(1.0), key="42:7")
+        await self.drain(queue)
+        assert not queue.submit(self.expense(1.0), key="42:7")
+
+        assert calls == [[1.0]]
+
+    @pytest.mark.asyncio
+    async def test_ambiguous_failure_checked_before_retry(self, tmp_path):
+        """Test that a timed-out insert that did land is not written a second time"""
+        calls = []
+
+        async def flush(expenses):
+            calls.append([e["amount"] for e in expenses])
+            raise TimeoutError("Google Sheets call append_expenses timed out after 20s")
+
+        async def check_written(expenses):
+            return [e["amount"] for e in expenses] == [1.0]
+
+        queue = WriteBehindQueue(
+            flush,
+            str(tmp_path / "outbox.sqlite3"),
+            window_seconds=0.01,
+            retry_seconds=0.01,
+            check_written=check_written,
+        )
+        queue.submit(self.expense(1.0))
+        await self.drain(queue)
+
+        assert calls == [[1.0]]
+        assert queue.depth() == 0 and not queue.degraded
+
+    @pytest.mark.asyncio
+    async def test_failures_before_google_retried_without_check(self, tmp_path):
+        """Test that a 429 or an open breaker never makes an equal earlier row count as the retry"""
+        response = TestResilience.response(429)
+        failures = [
+            gspread.exceptions.APIError(response),
+            SheetsUnavailableError("Google Sheets is unavailable"),
+        ]
+        calls = []
+        check_written = AsyncMock(return_value=True)  # an equal expense is already on top
+
+        async def flush(expenses):
+            calls.append([e["amount"] for e in expenses])
+            if failures:
+                raise failures.pop(0)
+
+        queue = WriteBehindQueue(
+            flush,
+            str(tmp_path / "outbox.sqlite3"),
+            window_seconds=0.01,
+            retry_seconds=0.01,
+            check_written=check_written,
+        )
+        queue.submit(self.expense(1.0))
+        await self.drain(queue)
+
+        assert calls == [[1.0], [1.0], [1.0]]
+        check_written.assert_not_awaited()
+        assert queue.depth() == 0
+
+    @pytest.mark.asyncio
+    async def test_outage_retried_and_rejection_reported(self, tmp_path):
+        """Test that outages are retried in order while rejected writes are kept as failed"""
+        outage = [True]
+        calls = []
+
+        async def flush(expenses):
+            calls.append([e["amount"] for e in expenses])
+            if outage[0]:
+                raise SheetsUnavailableError("Google Sheets is unavailable")
+            if any(e["amount"] == 3.0 for e in expenses):
+                raise ValueError("Invalid value")
+
+        queue = WriteBehindQueue(flush, str(tmp_path / "outbox.sqlite3"))
+        queue.submit(self.expense(1.0))
+        assert await queue.flush() is False
+        assert queue.degraded and queue.status().pending == 1
+
+        outage[0] = False
+        queue.submit(self.expense(2.0))
+        assert await queue.flush() is True
+        queue.submit(self.expense(3.0))
+        assert await queue.flush() is True
+
+        status = queue.status()
+        assert calls == [[1.0], [1.0, 2.0], [3.0]]
+        assert status.pending == 0 and not status.degraded
+        assert [(e.expenses[0]["amount"], e.error) for e in status.failed] == [
+            (3.0, "Invalid value")
+        ]
+        assert "❌ Не удалось записать" in format_pending(status, time.time())
+
+    @pytest.mark.asyncio
+    async def test_outbox_survives_restart(self, tmp_path):
+        """Test that submissions accepted before a restart are written on start"""
+        path = str(tmp_path / "outbox.sqlite3")
+        calls = []
+
+        async def flush(expenses):
+            calls.append([e["amount"] for e in expenses])
+
+        accepted = WriteBehindQueue(flush, path)
+        accepted.submit(self.expense(4.0))
+        accepted.submit(self.expense(5.0))
+        queue = WriteBehindQueue(flush, path, window_seconds=0.01)
+        await self.drain(queue)
+
+        assert calls == [[4.0, 5.0]]
+
+
+class TestTenants:
+    ANNA = Tenant("anna", "sheet-a", frozenset({1}), frozenset({1}))
+    TEAM = Tenant("team", "sheet-t", frozenset({-100}), frozenset({2, 3}))
+
+    def test_registry_from_file(self, tmp_path):
+        """Test that chats and Mini App users map to tenants and unknown ones to none"""
+        path = tmp_path / "tenants.json"
+        path.write_text(
+            json.dumps(
+                [
+                    {"id": "anna", "spreadsheet_id": "sheet-a", "chat_ids": [1]},
+                    {
+                        "id": "team",
+                        "spreadsheet_id": "sheet-t",
+                        "chat_ids": [-100],
+                        "user_ids": [2, 3],
+                        "worksheet_name": "Траты",
+                    },
+                ]
+            )
+        )
+        registry = TenantRegistry.from_file(str(path))
+
+        assert registry.for_chat(1).spreadsheet_id == "sheet-a"
+        assert registry.for_user(1).id == "anna"
+        assert registry.for_user(3).worksheet_name == "Траты"
+        assert registry.for_chat(2) is None and registry.for_user(4) is None
+        with pytest.raises(ValueError, match="more than one tenant"):
+            TenantRegistry([self.ANNA, Tenant("anna2", "sheet-b", frozenset({1}))])
+
+    def test_pool_evicts_least_recently_used_idle_state(self, tmp_path):
+        """Test that the pool stays bounded, keeps states in use and isolates stores"""
+        pool = TenantPool(max_size=1)
+        with (
+            patch("src.services.tenants.tenant_pool", pool),
+            patch.object(tenants.settings, "tenant_data_dir", str(tmp_path)),
+        ):
+            with use_tenant(self.ANNA):
+                tenants.get_store().add(date(2025, 9, 1), "кофе", 450.0)
+                with use_tenant(self.TEAM) as team:
+                    assert tenants.get_store().month_stats(2025, 9).total == 0
+                    assert pool.tenants() == [self.ANNA, self.TEAM]
+                # over the limit: the idle tenant goes, the one still in use stays
+                assert pool.tenants() == [self.ANNA] and team.session is None
+
+            with use_tenant(self.ANNA):
+                assert tenants.get_store().month_stats(2025, 9).total == 450.0
+            with use_tenant(self.TEAM):
+                pass
+            assert pool.tenants() == [self.TEAM] and pool.evictions == 2
+            with use_tenant(self.ANNA) as anna:
+                # reopened from its own file
+                assert tenants.get_store().month_stats(2025, 9).total == 450.0
+            anna.close()
+
+    def test_pool_closes_replaced_state(self, tmp_path):
+        """Test that a reconfigured tenant's old store and session are closed"""
+        pool = TenantPool(max_size=2)
+        moved = Tenant("anna", "sheet-b", frozenset({1}), frozenset({1}))
+        with (
+            patch("src.services.tenants.tenant_pool", pool),
+            patch.object(tenants.settings, "tenant_data_dir", str(tmp_path)),
+        ):
+            with use_tenant(self.ANNA) as idle:
+                store = tenants.get_store()
+                idle.session = MagicMock()
+            with use_tenant(moved):
+                assert idle.session is None
+                with pytest.raises(sqlite3.ProgrammingError, match="closed"):
+                    store.count()
+
+            with use_tenant(self.ANNA):
+                store = tenants.get_store()
+                with use_tenant(moved) as latest:
+                    pass
+                store.count()  # still open for the caller using it
+            with pytest.raises(sqlite3.ProgrammingError, match="closed"):
+                store.count()
+            latest.close()
+
+    @pytest.mark.asyncio
+    async def test_heavy_tenant_does_not_take_every_worker(self):
+        """Test that a burst of one tenant leaves Sheets workers free for the others"""
+        registry = TenantRegistry([self.ANNA, self.TEAM])
+        with patch("src.services.sheets_async.get_registry", return_value=registry):
+            with use_tenant(self.TEAM):
+                burst = [
+                    asyncio.create_task(run_sheets_call(time.sleep, 0.3)) for _ in range(6)
+                ]
+            await asyncio.sleep(0.05)
+            started = time.monotonic()
+            with use_tenant(self.ANNA):
+                await run_sheets_call(lambda: tenants.current_state().tenant.id)
+            waited = time.monotonic() - started
+            await asyncio.gather(*burst)
+
+        assert waited < 0.2
+
+    @pytest.mark.asyncio
+    async def test_outbox_drains_tenants_in_turn(self, tmp_path):
+        """Test that tenants are written in turn and one failing tenant does not block another"""
+        calls = []
+
+        async def flush(expenses):
+            tenant = tenants.current_state().tenant.id
+            calls.append((tenant, [e["amount"] for e in expenses]))
+            if tenant == "team":
+                raise SheetsUnavailableError("Google Sheets is unavailable")
+
+        queue = WriteBehindQueue(flush, str(tmp_path / "outbox.sqlite3"), max_batch=1)
+        with use_tenant(self.TEAM):
+            queue.submit(TestWriteBehindQueue.expense(1.0))
+        with use_tenant(self.ANNA):
+            queue.submit(TestWriteBehindQueue.expense(2.0))
+            queue.submit(TestWriteBehindQueue.expense(3.0))
+
+        registry = TenantRegistry([self.ANNA, self.TEAM])
+        with patch("src.services.write_queue.get_registry", return_value=registry):
+            assert await queue.flush(queue._next_tenant(ready_only=True)) is True
+            assert await queue.flush(queue._next_tenant(ready_only=True)) is False
+            assert queue._next_tenant(ready_only=True) == "anna"
+            assert await queue.flush(queue._next_tenant(ready_only=True)) is True
+
+        assert calls == [("anna", [2.0]), ("team", [1.0]), ("anna", [3.0])]
+        with use_tenant(self.TEAM):
+            assert queue.degraded and queue.status().pending == 1
+        with use_tenant(self.ANNA):
+            assert not queue.degraded and queue.status().pending == 0
+
+
+class TestMiniAppAuth:
+    BOT_TOKEN = "123456:test-token"
+
+    @pytest.fixture(autouse=True)
+    def configured(self):
+        webapp._verified_init_data.clear()
+        with (
+            patch.object(webapp.settings, "telegram_bot_token", SecretStr(self.BOT_TOKEN)),
+            patch.object(webapp.settings, "allowed_chat_id", None),
+            patch("src.webapp.data_version", return_value=None),
+        ):
+            yield
+
+    def init_data(self, auth_date=None):
+        fields = {
+            "auth_date": str(auth_date or int(time.time())),
+            "user": json.dumps({"id": 42}),
+        }
+        check = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+        secret = hmac.new(b"WebAppData", self.BOT_TOKEN.encode(), hashlib.sha256).digest()
+        fields["hash"] = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+        return urlencode(fields)
+
+    def test_repeat_validation_is_cached(self):
+        """Test that the same initData is only parsed and verified once"""
+        init_data = self.init_data()
+
+        with patch("src.webapp.parse_qsl", wraps=webapp.parse_qsl) as parse:
+            first = webapp.validate_init_data(init_data)
+            second = webapp.validate_init_data(init_data)
+
+        assert first == second
+        assert parse.call_count == 1
+
+    def test_cached_validation_expires_with_init_data(self):
+        """Test that a cached initData is rejected once it is older than the max age"""
+        init_data = self.init_data(auth_date=int(time.time()) - 299)
+        webapp.validate_init_data(init_data)
+
+        with patch("src.webapp.time.time", return_value=time.time() + 5):
+            with pytest.raises(ValueError, match="Expired init data"):
+                webapp.validate_init_data(init_data)
+
+    def test_tampered_init_data_rejected(self):
+        """Test that a changed field invalidates the hash"""
+        with pytest.raises(ValueError, match="Invalid hash"):
+            webapp.validate_init_data(self.init_data().replace("42", "43"))
+
+    def test_session_token(self):
+        """Test that a session token round-trips and a forged one is rejected"""
+        token = webapp.issue_session_token(webapp.validate_init_data(self.init_data()))
+
+        assert webapp.validate_session_token(token) == 42
+        user_id, expires_at, signature = token.split(".")
+        with pytest.raises(ValueError, match="Invalid session token"):
+            webapp.validate_session_token(f"{user_id}.{int(expires_at) + 3600}.{signature}")
+
+    def test_range_endpoint(self):
+        """Test that /api/stats/range returns per-month and span totals"""
+        client = TestClient(webapp.app)
+        token = client.get("/api/session", params={"initData": self.init_data()}).json()["token"]
+        totals = {(2025, 8): {"кофе": 300.0}, (2025, 9): {"кофе": 500.0, "Транспорт": 600.0}}
+
+        with patch("src.webapp.get_range_totals", return_value=totals) as get_totals:
+            response = client.get(
+                "/api/stats/range",
+                params={"year": 2025, "month": 9, "months": 2},
+                headers={"Authorization": f"Bearer {token}"},
+            )
+
+        get_totals.assert_called_once_with(2025, 9, 2)
+        assert response.json() == {
+            "months": [
+                {
+                    "categories": [{"name": "кофе", "amount": 300.0}],
+                    "total": 300.0,
+                    "year": 2025,
+                    "month": 8,
+                },
+                {
+                    "categories": [
+                        {"name": "Транспорт", "amount": 600.0},
+                        {"name": "кофе", "amount": 500.0},
+                    ],
+                    "total": 1100.0,
+                    "year": 2025,
+                    "month": 9,
+                },
+            ],
+            "categories": [
+                {"name": "кофе", "amount": 800.0},
+                {"name": "Транспорт", "amount": 600.0},
+            ],
+            "total": 1400.0,
+        }
+
+    def test_stats_not_modified(self):
+        """Test that a repeat request with the ETag gets a 304 without fetching"""
+        client = TestClient(webapp.app)
+        params = {"initData": self.init_data(), "year": 2025, "month": 9}
+        stats = MonthStats(2025, 9, [("кофе", 100.0)], total=100.0, count=1, days=1)
+
+        with (
+            patch("src.webapp.data_version", return_value=7),
+            patch("src.webapp.get_month_stats", return_value=stats) as get_stats,
+        ):
+            first = client.get("/api/stats", params=params)
+            again = client.get(
+                "/api/stats", params=params, headers={"If-None-Match": first.headers["etag"]}
+            )
+            with patch("src.webapp.data_version", return_value=8):
+                changed = client.get(
+                    "/api/stats", params=params, headers={"If-None-Match": first.headers["etag"]}
+                )
+
+        assert first.status_code == 200 and first.headers["etag"].startswith('W/"')
+        assert again.status_code == 304
+        assert changed.status_code == 200
+        assert get_stats.call_count == 2
+
+    def test_webhook_requires_secret_and_feeds_dispatcher(self):
+        """Test that webhook updates need the secret token and are fed to the dispatcher"""
+        client = TestClient(webapp.app)
+        dispatcher = MagicMock()
+        dispatcher.feed_update = AsyncMock()
+        bot = MagicMock()
+        update = {
+            "update_id": 1,
+            "message": {
+                "message_id": 7,
+                "date": 0,
+                "chat": {"id": 42, "type": "private"},
+                "text": "450 кофе",
+            },
+        }
+
+        with (
+            patch.object(webapp.settings, "telegram_webhook_secret", SecretStr("s3cret")),
+            patch.object(webapp.app.state, "telegram", (bot, dispatcher), create=True),
+        ):
+            rejected = client.post(webapp.WEBHOOK_PATH, json=update)
+            accepted = client.post(
+                webapp.WEBHOOK_PATH,
+                json=update,
+                headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"},
+            )
+
+        assert rejected.status_code == 401
+        assert accepted.status_code == 200
+        dispatcher.feed_update.assert_awaited_once()
+        fed_bot, fed_update = dispatcher.feed_update.await_args.args
+        assert fed_bot is bot and fed_update.message.text == "450 кофе"
+
+    def test_export_streams_attachment(self):
+        """Test that /api/export sends a filtered CSV download and rejects bad parameters"""
+        client = TestClient(webapp.app)
+        store = ExpenseStore(":memory:")
+        store.replace_all(TestExport.ROWS)
+        params = {"initData": self.init_data(), "start": "2025-09-01", "category": "кофе"}
+
+        with (
+            patch("src.services.export.get_store", return_value=store),
+            patch("src.services.sheets.refresh_from_store"),
+        ):
+            response = client.get("/api/export", params=params)
+            bad_format = client.get("/api/export", params={**params, "format": "pdf"})
+            reversed_range = client.get("/api/export", params={**params, "end": "2025-01-01"})
+        store.close()
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "text/csv; charset=utf-8"
+        assert 'filename="expenses_2025-09-01.csv"' in response.headers["content-disposition"]
+        assert response.content.decode("utf-8-sig").splitlines()[1:] == ["2025-09-03,кофе,450,"]
+        assert bad_format.status_code == 400 and reversed_range.status_code == 400
+
+    def test_chart_js_cdn_fallback_is_pinned(self):
+        """Test that the CDN copy of Chart.js is loaded with its hash, the bundled one as is"""
+        digest = hashlib.sha256(b"chart").hexdigest()
+
+        assert webapp.chart_js_attrs(True, digest) == f'src="/static/{webapp.CHART_JS_NAME}"'
+        attrs = webapp.chart_js_attrs(False, digest)
+        assert f'src="{webapp.CHART_JS_CDN}" crossorigin="anonymous"' in attrs
+        assert 'integrity="sha256-' + base64.b64encode(bytes.fromhex(digest)).decode() in attrs
+
+    def test_page_is_compressed_and_revalidated(self):
+        """Test that the page is served gzipped with an ETag and answers 304 on a match"""
+        client = TestClient(webapp.app)
+
+        page = client.get("/", headers={"Accept-Encoding": "gzip"})
+        cached = client.get("/", headers={"If-None-Match": page.headers["etag"]})
+
+        assert page.headers["content-encoding"] == "gzip"
+        assert page.headers["cache-control"] == "no-cache"
+        assert "Chart" in page.text
+        assert cached.status_code == 304
+
+    def test_metrics_report_route_latency(self):
+        """Test that /metrics lists request latency by route template and honours its token"""
+        client = TestClient(webapp.app)
+        stats = MonthStats(2025, 9, [("кофе", 100.0)], total=100.0, count=1, days=1)
+        with (
+            patch("src.webapp.data_version", return_value=7),
+            patch("src.webapp.get_month_stats", return_value=stats),
+        ):
+            client.get("/api/stats", params={"initData": self.init_data()})
+
+        body = client.get("/metrics").text
+        assert re.search(
+            r'financier_http_request_seconds_count\{route="/api/stats",status="200"\} [1-9]', body
+        )
+        assert 'financier_cache_lookups_total{cache="init_data",result="miss"}' in body
+
+        with patch.object(webapp.settings, "metrics_token", SecretStr("m3trics")):
+            assert client.get("/metrics").status_code == 401
+            authorized = client.get("/metrics", headers={"Authorization": "Bearer m3trics"})
+        assert authorized.status_code == 200
+
+        # METRICS_TOKEN= in the environment leaves the endpoint open, like an unset one
+        with patch.object(webapp.settings, "metrics_token", SecretStr("")):
+            assert client.get("/metrics").status_code == 200
 
 
 if __name__ == "__main__":